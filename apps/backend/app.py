@@ -2,6 +2,8 @@
 # Licensed under the MIT License.
 
 import sys
+import time
+import asyncio
 import traceback
 from datetime import datetime
 
@@ -16,8 +18,8 @@ from botbuilder.core import (
 from botbuilder.core.integration import aiohttp_error_middleware
 from botbuilder.schema import Activity, ActivityTypes
 
-from bot import MyBot
 from config import DefaultConfig
+from metrics import Counter, render
 
 CONFIG = DefaultConfig()
 
@@ -57,8 +59,45 @@ async def on_error(context: TurnContext, error: Exception):
 
 ADAPTER.on_turn_error = on_error
 
-# Create the Bot
-BOT = MyBot()
+# The bot module (LangChain and the tools) is imported in a worker thread once the server is
+# listening, so the port opens without waiting for it; messages that arrive before it is
+# loaded wait for it. The agent and the tools are then warmed up in the background.
+_bot_loading = None
+
+
+def load_bot():
+    # Create the Bot
+    from bot import MyBot
+    return MyBot()
+
+
+def bot_ready() -> bool:
+    return _bot_loading is not None and _bot_loading.done() and _bot_loading.exception() is None
+
+
+def get_bot() -> "asyncio.Future":
+    global _bot_loading
+    # Try again on the next message if loading failed
+    if _bot_loading is None or (_bot_loading.done() and _bot_loading.exception() is not None):
+        _bot_loading = asyncio.get_running_loop().run_in_executor(None, load_bot)
+    return _bot_loading
+
+
+async def warm_up_bot() -> None:
+    try:
+        bot = await get_bot()
+        await asyncio.get_running_loop().run_in_executor(None, bot.warm_up)
+    except Exception:
+        print("\n [warm_up] could not load the bot:", file=sys.stderr)
+        traceback.print_exc()
+
+
+async def warm_up(app: web.Application) -> None:
+    asyncio.ensure_future(warm_up_bot())
+
+
+STARTED_AT = time.time()
+HTTP_REQUESTS = Counter("http_requests_total", "Requests to /api/messages", ["status"])
 
 
 # Listen for incoming requests on /api/messages
@@ -67,19 +106,46 @@ async def messages(req: Request) -> Response:
     if "application/json" in req.headers["Content-Type"]:
         body = await req.json()
     else:
+        HTTP_REQUESTS.inc(status="415")
         return Response(status=415)
 
     activity = Activity().deserialize(body)
     auth_header = req.headers["Authorization"] if "Authorization" in req.headers else ""
 
-    response = await ADAPTER.process_activity(activity, auth_header, BOT.on_turn)
+    try:
+        bot = await get_bot()
+        response = await ADAPTER.process_activity(activity, auth_header, bot.on_turn)
+    except Exception:
+        HTTP_REQUESTS.inc(status="500")
+        raise
     if response:
+        HTTP_REQUESTS.inc(status=str(response.status))
         return json_response(data=response.body, status=response.status)
+    HTTP_REQUESTS.inc(status="201")
     return Response(status=201)
 
 
+# Prometheus scrape endpoint
+async def metrics(req: Request) -> Response:
+    return Response(text=render(), content_type="text/plain")
+
+
+# Liveness check; does not call any downstream service. "ready" is false while this worker's bot
+# is loading; "in_flight_turns" counts the messages being answered by all the workers.
+async def healthz(req: Request) -> Response:
+    in_flight = 0
+    if bot_ready():
+        from bot import BOT_IN_FLIGHT
+        in_flight = BOT_IN_FLIGHT.total()
+    return json_response({"status": "ok", "ready": bot_ready(), "uptime_seconds": round(time.time() - STARTED_AT, 1),
+                          "in_flight_turns": in_flight})
+
+
 APP = web.Application(middlewares=[aiohttp_error_middleware])
 APP.router.add_post("/api/messages", messages)
+APP.router.add_get("/metrics", metrics)
+APP.router.add_get("/healthz", healthz)
+APP.on_startup.append(warm_up)
 
 if __name__ == "__main__":
     try:
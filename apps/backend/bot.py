@@ -2,17 +2,24 @@
 # Licensed under the MIT License.
 import os
 import re
+import sys
+import time
+import threading
 import asyncio
+import contextvars
 from concurrent.futures import ThreadPoolExecutor
 from langchain.chat_models import AzureChatOpenAI
 from langchain.utilities import BingSearchAPIWrapper
-from langchain.memory import ConversationBufferWindowMemory
 from langchain.agents import ConversationalChatAgent, AgentExecutor, Tool
 
 #custom libraries that we will use later in the app
-from utils import DocSearchTool, CSVTabularTool, SQLDbTool, ChatGPTTool, BingSearchTool, run_agent
-from callbacks import MyCustomHandler
-from prompts import CUSTOM_CHATBOT_PREFIX, CUSTOM_CHATBOT_SUFFIX 
+from utils import DocSearchTool, CSVTabularTool, SQLDbTool, ChatGPTTool, BingSearchTool, run_agent, num_tokens_from_string, model_tokens_limit
+from callbacks import MyCustomHandler, TracingCallbackHandler, MetricsCallbackHandler
+from memory import TokenBudgetMemory
+from tracing import trace, span
+from metrics import Counter, Gauge, Histogram
+from prompts import CUSTOM_CHATBOT_SUFFIX
+from prompt_registry import PROMPTS
 
 from botbuilder.core import ActivityHandler, TurnContext
 from botbuilder.schema import ChannelAccount, Activity, ActivityTypes
@@ -24,13 +31,19 @@ os.environ["OPENAI_API_VERSION"] = os.environ.get("AZURE_OPENAI_API_VERSION")
 os.environ["OPENAI_API_TYPE"] = "azure"
 
 
-class MyBot(ActivityHandler):
-    # See https://aka.ms/about-bot-activity-message to learn more about the message and other activity types.
-    
-    # Set a Deployment model name
-    MODEL_DEPLOYMENT_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME")
-    
-    llm = AzureChatOpenAI(deployment_name=MODEL_DEPLOYMENT_NAME, temperature=0.5, max_tokens=500)
+# One pool for all the agent runs, so its queue shows how far behind the bot is
+AGENT_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("AGENT_MAX_WORKERS", 32)), thread_name_prefix="agent")
+
+BOT_TURNS = Counter("bot_turns_total", "Messages answered by the bot", ["status"])
+BOT_IN_FLIGHT = Gauge("bot_in_flight_turns", "Messages being answered")
+BOT_TURN_LATENCY = Histogram("bot_turn_duration_seconds", "Time to answer a message")
+AGENT_QUEUE_DEPTH = Gauge("agent_executor_queue_depth", "Agent runs waiting for a worker thread",
+                          function=lambda: AGENT_EXECUTOR._work_queue.qsize())
+
+
+def build_agent_chain(model_deployment_name: str) -> AgentExecutor:
+    """Builds the LLMs, the tools/experts, the main agent and its memory"""
+    llm = AzureChatOpenAI(deployment_name=model_deployment_name, temperature=0.5, max_tokens=500, callbacks=[TracingCallbackHandler(), MetricsCallbackHandler()])
     
     # Initialize our Tools/Experts
     indexes = ["cogsrch-index-files", "cogsrch-index-csv"]
@@ -66,11 +79,64 @@ class MyBot(ActivityHandler):
         ),
     ]
     
-    # Set main Agent
-    llm_a = AzureChatOpenAI(deployment_name=MODEL_DEPLOYMENT_NAME, temperature=0.5, max_tokens=500)
-    agent = ConversationalChatAgent.from_llm_and_tools(llm=llm_a, tools=tools, system_message=CUSTOM_CHATBOT_PREFIX, human_message=CUSTOM_CHATBOT_SUFFIX)
-    memory = ConversationBufferWindowMemory(memory_key="chat_history", return_messages=True, k=10)
-    agent_chain = AgentExecutor.from_agent_and_tools(agent=agent, tools=tools, memory=memory)
+    # Recent turns verbatim within MEMORY_TOKEN_LIMIT tokens, older ones summarized in the background
+    llm_summary = AzureChatOpenAI(deployment_name=model_deployment_name, temperature=0, max_tokens=300, callbacks=[TracingCallbackHandler(), MetricsCallbackHandler()])
+    memory = TokenBudgetMemory(llm=llm_summary, memory_key="chat_history", return_messages=True,
+                               max_token_limit=int(os.environ.get("MEMORY_TOKEN_LIMIT", 1000)))
+
+    # Set main Agent, with the richest system message that leaves room for the chat history and its summary
+    llm_a = AzureChatOpenAI(deployment_name=model_deployment_name, temperature=0.5, max_tokens=500, callbacks=[TracingCallbackHandler(), MetricsCallbackHandler()])
+    budget = model_tokens_limit(model_deployment_name) - memory.max_prompt_tokens
+    try:
+        budget -= num_tokens_from_string(CUSTOM_CHATBOT_SUFFIX + "".join(tool.description for tool in tools))
+        _, system_message = PROMPTS.select("chatbot_prefix", budget)
+    except Exception as e:
+        print("Could not load the tokenizer:", e, file=sys.stderr)
+        system_message = PROMPTS.get("chatbot_prefix", "full")
+    agent = ConversationalChatAgent.from_llm_and_tools(llm=llm_a, tools=tools, system_message=system_message.template, human_message=CUSTOM_CHATBOT_SUFFIX)
+    return AgentExecutor.from_agent_and_tools(agent=agent, tools=tools, memory=memory)
+
+
+def warm_up_tools(agent_chain: AgentExecutor) -> None:
+    """Does the one-off work of the tools ahead of the first message: loads the tokenizer, counts
+    the tokens of the prompts, builds the Bing and SQL agents (reflecting the database schema).
+    Failures are only logged, the tools retry on first use."""
+    try:
+        num_tokens_from_string("warm up")
+        PROMPTS.precompute()
+    except Exception as e:
+        print("Could not load the tokenizer:", e, file=sys.stderr)
+    for tool in agent_chain.tools:
+        tool_instance = getattr(tool.func, "__self__", None)
+        if hasattr(tool_instance, "get_agent_executor"):
+            try:
+                tool_instance.get_agent_executor()
+            except Exception as e:
+                print(f"Could not warm up {tool.name}:", e, file=sys.stderr)
+
+
+class MyBot(ActivityHandler):
+    # See https://aka.ms/about-bot-activity-message to learn more about the message and other activity types.
+    
+    # Set a Deployment model name
+    MODEL_DEPLOYMENT_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME")
+
+    def __init__(self):
+        super().__init__()
+        # The agent and its tools are built on first use, or ahead of it by warm_up()
+        self._agent_chain = None
+        self._agent_lock = threading.Lock()
+
+    @property
+    def agent_chain(self) -> AgentExecutor:
+        with self._agent_lock:
+            if self._agent_chain is None:
+                self._agent_chain = build_agent_chain(self.MODEL_DEPLOYMENT_NAME)
+            return self._agent_chain
+
+    def warm_up(self) -> None:
+        """Builds the agent and warms up its tools; blocking, run it in a worker thread"""
+        warm_up_tools(self.agent_chain)
     
     
     async def on_message_activity(self, turn_context: TurnContext):
@@ -80,7 +146,19 @@ class MyBot(ActivityHandler):
         # Please note below that running a non-async function like run_agent in a separate thread won't make it truly asynchronous. It allows the function to be called without blocking the event loop, but it may still have synchronous behavior internally.
         
         loop = asyncio.get_event_loop()
-        answer = await loop.run_in_executor(ThreadPoolExecutor(), run_agent, turn_context.activity.text, self.agent_chain)
+        BOT_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        status = "error"
+        try:
+            # Spans of the message are grouped by conversation id; the context is copied so the worker thread sees the trace
+            with trace(turn_context.activity.conversation.id), span("message", activity_id=turn_context.activity.id):
+                answer = await loop.run_in_executor(AGENT_EXECUTOR, contextvars.copy_context().run,
+                                                    lambda: run_agent(turn_context.activity.text, self.agent_chain))
+            status = "ok"
+        finally:
+            BOT_IN_FLIGHT.dec()
+            BOT_TURN_LATENCY.observe(time.perf_counter() - start)
+            BOT_TURNS.inc(status=status)
 
         await turn_context.send_activity(answer)
 
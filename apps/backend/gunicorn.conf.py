@@ -0,0 +1,35 @@
+# Gunicorn settings of the bot backend:
+#     gunicorn --config gunicorn.conf.py app:APP
+#
+# Gunicorn pre-forks WEB_CONCURRENCY aiohttp workers (default: 1) that share the listening
+# socket. `kill -HUP <master pid>` reloads them gracefully: new workers are started with the
+# new code and the old ones finish the messages they are answering (for up to graceful_timeout
+# seconds) before they exit.
+#
+# The conversation memory of the bot's agent lives in the worker that built it, and the
+# messages of a conversation can reach any worker, so with several workers each one only
+# remembers the turns it answered itself. Raise WEB_CONCURRENCY only if that is acceptable.
+import os
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+worker_class = "aiohttp.worker.GunicornWebWorker"
+timeout = 600
+graceful_timeout = 120
+
+# The workers share their caches (search results, query embeddings, Bing results and SQL
+# query results) through one SQLite file instead of each warming its own
+# and report their metrics through another, so /metrics and /healthz cover all the workers
+if workers > 1:
+    os.environ.setdefault("SHARED_CACHE_PATH", os.path.join(tempfile.gettempdir(), "bot-cache.sqlite3"))
+    os.environ.setdefault("SHARED_METRICS_PATH", os.path.join(tempfile.gettempdir(), "bot-metrics.sqlite3"))
+
+
+def on_starting(server):
+    """Counters start from zero with the master; they survive the reloads of the workers"""
+    path = os.environ.get("SHARED_METRICS_PATH")
+    if path:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
@@ -1,13 +1,15 @@
+from __future__ import annotations
+
 import streamlit as st
 import urllib
 import os
 import re
 import time
 import random
+import queue
 from collections import OrderedDict
-from openai.error import OpenAIError
-from langchain.docstore.document import Document
-from langchain.chat_models import AzureChatOpenAI
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Tuple
 
 from utils import (
     get_search_results,
@@ -17,7 +19,20 @@ from utils import (
     embed_docs,
     search_docs,
     get_answer,
+    get_extractive_answers,
+    extractive_answer_th_from_env,
+    extractive_reranker_th_from_env,
+    EXTRACTIVE_ANSWERS,
+    LANGUAGE_CODES,
 )
+from dedup import dedup_docs
+from compression import compress_docs, compression_tokens_from_env
+
+# LangChain and openai are imported when a question is answered, so the page opens without loading them
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+    from langchain.chat_models import AzureChatOpenAI
+
 st.set_page_config(page_title="GPT Smart Search", page_icon="📖", layout="wide")
 # Add custom CSS styles to adjust padding
 st.markdown("""
@@ -36,6 +51,119 @@ def clear_submit():
     st.session_state["submit"] = False
 
 
+@st.cache_resource
+def get_llm(model: str, streaming: bool = False) -> AzureChatOpenAI:
+    from langchain.chat_models import AzureChatOpenAI
+
+    # The openai settings are process-wide, so they are set once together with the client
+    os.environ["OPENAI_API_BASE"] = os.environ.get("AZURE_OPENAI_ENDPOINT")
+    os.environ["OPENAI_API_KEY"] = os.environ.get("AZURE_OPENAI_API_KEY")
+    os.environ["OPENAI_API_VERSION"] = os.environ["AZURE_OPENAI_API_VERSION"]
+    os.environ["OPENAI_API_TYPE"] = "azure"
+    return AzureChatOpenAI(deployment_name=model, temperature=0, max_tokens=500, streaming=streaming)
+
+
+@st.cache_resource
+def get_answer_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="answer")
+
+
+# Search results and answers are cached per query, so reruns of the page (e.g. changing the
+# answer language) only call Azure Search and OpenAI for what actually changed
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def search(query: str, indexes: Tuple[str, ...]) -> Tuple[OrderedDict, List[Document]]:
+    from langchain.docstore.document import Document
+
+    agg_search_results = get_search_results(query, list(indexes))
+    ordered_results = order_search_results(agg_search_results, reranker_threshold=1)
+
+    docs = []
+    for key,value in ordered_results.items():
+        for page in value["chunks"]:
+            docs.append(Document(page_content=page, metadata={"source": value["location"]}))
+
+    return ordered_results, dedup_docs(docs)
+
+
+# Extractive answers of Azure Search that score at least EXTRACTIVE_ANSWER_THRESHOLD (0-1) are shown
+# right away, while the generated answer is written; unset to turn them off
+EXTRACTIVE_ANSWER_THRESHOLD = extractive_answer_th_from_env()
+EXTRACTIVE_ANSWER_RERANKER_THRESHOLD = extractive_reranker_th_from_env()
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def quick_answers(query: str, language: str, indexes: Tuple[str, ...], min_score: float, min_reranker_score: float) -> List[dict]:
+    # The search results come from the cache of get_search_results. Only new searches (or a new
+    # answer language) run this function, so other reruns of the page are not counted. Answers
+    # are not translated, so only those from documents in the answer language are shown.
+    answers = get_extractive_answers(get_search_results(query, list(indexes)), min_score=min_score,
+                                     min_reranker_score=min_reranker_score, language=LANGUAGE_CODES[language])
+    EXTRACTIVE_ANSWERS.inc(source="search_page", outcome="hit" if answers else "miss")
+    return answers
+
+
+# With COMPRESSION_TOKENS_PER_DOC set, only the sentences of each chunk most relevant to the
+# question, within that many tokens, are given to the LLM
+COMPRESSION_TOKENS_PER_DOC = compression_tokens_from_env()
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def select_docs(query: str, indexes: Tuple[str, ...], model: str) -> Tuple[List[Document], str]:
+    """Picks the docs that fit the model and the chain type, independently of the answer language"""
+    _, docs = search(query, indexes)
+    if COMPRESSION_TOKENS_PER_DOC is not None:
+        docs = compress_docs(docs, query, max_tokens_per_doc=COMPRESSION_TOKENS_PER_DOC)
+
+    tokens_limit = model_tokens_limit(model)
+    num_tokens = num_tokens_from_docs(docs)
+
+    if num_tokens > tokens_limit:
+        index = embed_docs(docs)
+        top_docs = search_docs(index,query)
+        num_tokens = num_tokens_from_docs(top_docs)
+        chain_type = "map_reduce" if num_tokens > tokens_limit else "stuff"
+    else:
+        top_docs = docs
+        chain_type = "stuff"
+
+    return top_docs, chain_type
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def answer_question(query: str, language: str, indexes: Tuple[str, ...], model: str,
+                    _tokens: queue.Queue = None) -> dict:
+    """Answers the question; with a stuff chain the answer tokens are also put in `_tokens` as they come"""
+    top_docs, chain_type = select_docs(query, indexes, model)
+    if chain_type == "stuff" and _tokens is not None:
+        from callbacks import QueueCallbackHandler
+        answer = get_answer(llm=get_llm(model, streaming=True), docs=top_docs, query=query, language=language,
+                            chain_type=chain_type, callbacks=[QueueCallbackHandler(_tokens)])
+    else:
+        answer = get_answer(llm=get_llm(model), docs=top_docs, query=query, language=language, chain_type=chain_type)
+    return {"output_text": answer["output_text"]}
+
+
+split_regex = re.compile("Sources:?\\W*", re.IGNORECASE)
+
+
+def stream_answer(placeholder, query: str, language: str, indexes: Tuple[str, ...], model: str) -> dict:
+    """Generates the answer in a background thread and streams it into `placeholder`"""
+    tokens = queue.Queue()
+    future = get_answer_executor().submit(answer_question, query, language, indexes, model, tokens)
+    with placeholder.container():
+        with st.spinner("Reading the source documents to provide the best answer... ⏳"):
+            text_placeholder = st.empty()
+            text = ""
+            while not future.done() or not tokens.empty():
+                try:
+                    text += tokens.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                text_placeholder.markdown(split_regex.split(text)[0] + "▌")
+    return future.result()
+
+
 with st.sidebar:
     st.markdown("""# Instructions""")
     st.markdown("""
@@ -79,13 +207,7 @@ elif (not os.environ.get("DATASOURCE_SAS_TOKEN")) or (os.environ.get("DATASOURCE
     st.error("Please set your DATASOURCE_SAS_TOKEN on your Web App Settings")
 
 else: 
-    os.environ["OPENAI_API_BASE"] = os.environ.get("AZURE_OPENAI_ENDPOINT")
-    os.environ["OPENAI_API_KEY"] = os.environ.get("AZURE_OPENAI_API_KEY")
-    os.environ["OPENAI_API_VERSION"] = os.environ["AZURE_OPENAI_API_VERSION"]
-    os.environ["OPENAI_API_TYPE"] = "azure"
-    
     MODEL = os.environ.get("AZURE_OPENAI_MODEL_NAME")
-    llm = AzureChatOpenAI(deployment_name=MODEL, temperature=0, max_tokens=500)
                            
     if button or st.session_state.get("submit"):
         if not query:
@@ -96,80 +218,64 @@ else:
             try:
                 index1_name = "cogsrch-index-files"
                 index2_name = "cogsrch-index-csv"
-                indexes = [index1_name, index2_name]
+                indexes = (index1_name, index2_name)
                 
-                agg_search_results = get_search_results(query, indexes)
-                ordered_results = order_search_results(agg_search_results, reranker_threshold=1)
+                ordered_results, docs = search(query, indexes)
 
 
                 st.session_state["submit"] = True
-                # Output Columns
-                placeholder = st.empty()
 
             except Exception as e:
                 st.markdown("Not data returned from Azure Search, check connection..")
                 st.markdown(e)
             
             if "ordered_results" in locals():
-                try:
-                    docs = []
-                    for key,value in ordered_results.items():
-                        for page in value["chunks"]:
-                            docs.append(Document(page_content=page, metadata={"source": value["location"]}))
-                            add_text = "Reading the source documents to provide the best answer... ⏳"
-
-                    if "add_text" in locals():
-                        with st.spinner(add_text):
-                            if(len(docs)>0):
-                                
-                                tokens_limit = model_tokens_limit(MODEL)
-                                num_tokens = num_tokens_from_docs(docs)
-                                
-                                if num_tokens > tokens_limit:
-                                    index = embed_docs(docs)
-                                    top_docs = search_docs(index,query)
-                                    num_tokens = num_tokens_from_docs(top_docs)
-                                    chain_type = "map_reduce" if num_tokens > tokens_limit else "stuff"
-                                else:
-                                    top_docs = docs
-                                    chain_type = "stuff"
-                                
-                                answer = get_answer(llm=llm, docs=top_docs, query=query, language=language, chain_type=chain_type)
-                                
-                            else:
-                                answer = {"output_text":"No results found" }
-                    else:
-                        answer = {"output_text":"No results found" }
+                if EXTRACTIVE_ANSWER_THRESHOLD is not None:
+                    answers = quick_answers(query, language, indexes, EXTRACTIVE_ANSWER_THRESHOLD, EXTRACTIVE_ANSWER_RERANKER_THRESHOLD)
+                    if answers:
+                        st.markdown("#### Quick answer")
+                        for answer in answers:
+                            url = answer['location'] + os.environ.get("DATASOURCE_SAS_TOKEN")
+                            title = str(answer['title']) if (answer['title']) else answer['name']
+                            st.markdown(answer["text"] + "  [[" + title + "]](" + url + ")")
+                    hits = EXTRACTIVE_ANSWERS.value(source="search_page", outcome="hit")
+                    misses = EXTRACTIVE_ANSWERS.value(source="search_page", outcome="miss")
+                    st.caption(f"Quick answers found for {int(hits)} of {int(hits + misses)} searches")
 
+                # Output: the answer goes in the placeholders, the search results are shown right away below them
+                st.markdown("#### Answer")
+                answer_placeholder = st.empty()
+                sources_placeholder = st.empty()
+                st.markdown("---")
+                st.markdown("#### Search Results")
 
-                    with placeholder.container():
-
-                        st.markdown("#### Answer")
-                        split_word = "Source"
-                        split_regex = re.compile(f"{split_word}s:?\\W*", re.IGNORECASE)
-                        answer_text = split_regex.split(answer["output_text"])[0]
-                        st.markdown(answer_text)
-                        try:
-                            sources_list = split_regex.split(answer["output_text"])[1].replace(" ","").split(",")
-                            #sources_list = answer["output_text"].split("SOURCES:")[1].replace(" ","").split(",")
-                            sources_markdown = "Sources: "
-                            for index, value in enumerate(sources_list):
-                                sources_markdown += "[[" + str(index+1) + "]](" + value + os.environ.get("DATASOURCE_SAS_TOKEN") + ")"
-                            st.markdown(sources_markdown)
-                        except Exception as e:
-                            st.markdown("Sources: N/A")
-                            
+                if(len(docs)>0):
+                    for key, value in ordered_results.items():
+                        url = value['location'] + os.environ.get("DATASOURCE_SAS_TOKEN")
+                        title = str(value['title']) if (value['title']) else value['name']
+                        score = str(round(value['score']*100/4,2))
+                        st.markdown("[" + title +  "](" + url + ")" + "  (Score: " + score + "%)")
+                        st.markdown(value["caption"])
                         st.markdown("---")
-                        st.markdown("#### Search Results")
 
-                        if(len(docs)>0):
-                            for key, value in ordered_results.items():
-                                url = value['location'] + os.environ.get("DATASOURCE_SAS_TOKEN")
-                                title = str(value['title']) if (value['title']) else value['name']
-                                score = str(round(value['score']*100/4,2))
-                                st.markdown("[" + title +  "](" + url + ")" + "  (Score: " + score + "%)")
-                                st.markdown(value["caption"])
-                                st.markdown("---")
+                from openai.error import OpenAIError
+                try:
+                    if(len(docs)>0):
+                        answer = stream_answer(answer_placeholder, query, language, indexes, MODEL)
+                    else:
+                        answer = {"output_text":"No results found" }
+
+                    answer_text = split_regex.split(answer["output_text"])[0]
+                    answer_placeholder.markdown(answer_text)
+                    try:
+                        sources_list = split_regex.split(answer["output_text"])[1].replace(" ","").split(",")
+                        #sources_list = answer["output_text"].split("SOURCES:")[1].replace(" ","").split(",")
+                        sources_markdown = "Sources: "
+                        for index, value in enumerate(sources_list):
+                            sources_markdown += "[[" + str(index+1) + "]](" + value + os.environ.get("DATASOURCE_SAS_TOKEN") + ")"
+                        sources_placeholder.markdown(sources_markdown)
+                    except Exception as e:
+                        sources_placeholder.markdown("Sources: N/A")
 
                 except OpenAIError as e:
-                    st.error(e)
\ No newline at end of file
+                    answer_placeholder.error(e)
@@ -0,0 +1,129 @@
+"""Offline benchmark of the DocSearch answer pipeline against local stand-ins.
+
+Starts the stand-in server (see standins.py), points the environment at it and runs
+DocSearchTool on distinct questions for every combination of corpus size (pages returned per
+search result) and concurrency. Per-stage durations come from the tracing spans (tracing.py),
+so the stages reported are the ones instrumented in utils: get_search_results, search_index,
+order_search_results, num_tokens_from_docs, embed_docs, search_docs, get_answer and each
+llm call, plus the whole DocSearchTool run.
+
+    python benchmarks/bench.py --pages-per-doc 1 5 20 --concurrency 1 4 16 --requests 32
+
+Use --latency-scale 0 to measure only our own overhead, or --throttle-rate to see how
+429s from the services affect throughput and tail latency.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standins import StandInServer
+
+
+class SpanCollector:
+    """Span exporter that keeps the durations of the spans by name"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = dict()
+
+    def __call__(self, span: Dict[str, Any]) -> None:
+        with self._lock:
+            self.durations.setdefault(span["name"], []).append(span["durationMs"] / 1000)
+
+    def reset(self) -> Dict[str, List[float]]:
+        with self._lock:
+            durations, self.durations = self.durations, dict()
+        return durations
+
+
+def summarize(durations: List[float]) -> Dict[str, float]:
+    values = np.asarray(durations)
+    return {"count": len(values), "mean": round(float(values.mean()), 4),
+            "p50": round(float(np.percentile(values, 50)), 4),
+            "p95": round(float(np.percentile(values, 95)), 4),
+            "p99": round(float(np.percentile(values, 99)), 4)}
+
+
+def run_cell(tool, num_requests: int, concurrency: int, collector: SpanCollector, offset: int) -> Dict[str, Any]:
+    """Runs `num_requests` distinct questions through the tool with `concurrency` threads"""
+    collector.reset()
+    questions = [f"What do the papers say about question {offset + i}?" for i in range(num_requests)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        answers = list(executor.map(tool._run, questions))
+    seconds = time.perf_counter() - started
+    stages = {name: summarize(values) for name, values in sorted(collector.reset().items())}
+    return {"requests": num_requests, "errors": sum(answer is None for answer in answers),
+            "seconds": round(seconds, 3), "throughput": round(num_requests / seconds, 2), "stages": stages}
+
+
+def print_cell(result: Dict[str, Any]) -> None:
+    print(f"\npages/doc={result['pages_per_doc']} concurrency={result['concurrency']}: "
+          f"{result['requests']} requests, {result['errors']} errors, {result['seconds']}s, "
+          f"{result['throughput']} req/s")
+    print(f"  {'stage':<22}{'count':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, stats in result["stages"].items():
+        print(f"  {name:<22}{stats['count']:>7}{stats['mean']:>9.3f}{stats['p50']:>9.3f}"
+              f"{stats['p95']:>9.3f}{stats['p99']:>9.3f}")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the DocSearch pipeline against local stand-ins")
+    parser.add_argument("--pages-per-doc", type=int, nargs="+", default=[1, 5, 20],
+                        help="corpus sizes: pages returned for each search result")
+    parser.add_argument("--page-words", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="requests per corpus size and concurrency")
+    parser.add_argument("--k", type=int, default=10, help="search results per index")
+    parser.add_argument("--model", default="gpt-35-turbo", help="deployment name, which sets the token limit")
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    server = StandInServer(latency_scale=args.latency_scale, throttle_rate=args.throttle_rate,
+                           page_words=args.page_words).start()
+    os.environ.update(server.environment())
+
+    # Imported once the environment points at the stand-ins
+    import tracing
+    from utils import DocSearchTool
+    from langchain.chat_models import AzureChatOpenAI
+    from callbacks import TracingCallbackHandler
+
+    collector = SpanCollector()
+    tracing.add_span_exporter(collector)
+    llm = AzureChatOpenAI(deployment_name=args.model, temperature=0, max_tokens=500, callbacks=[TracingCallbackHandler()])
+    tool = DocSearchTool(llm=llm, indexes=["cogsrch-index-files", "cogsrch-index-csv"], k=args.k)
+
+    results = []
+    try:
+        for pages_per_doc in args.pages_per_doc:
+            server.pages_per_doc = pages_per_doc
+            for concurrency in args.concurrency:
+                result = run_cell(tool, args.requests, concurrency, collector, offset=len(results) * args.requests)
+                result.update(pages_per_doc=pages_per_doc, concurrency=concurrency)
+                print_cell(result)
+                results.append(result)
+    finally:
+        server.stop()
+
+    print("\nStand-in requests:", server.requests, "throttled:", server.throttled)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+"""Load test of the bot backend's /api/messages endpoint.
+
+Posts synthetic Bot Framework message activities to a running backend at a fixed (Poisson)
+arrival rate, spread over a number of conversations, and reports every --interval seconds
+the throughput, latency percentiles, error rate, in-flight requests and the CPU and memory
+of the backend processes.
+
+By default it starts everything locally: the service stand-ins (standins.py), a stand-in of
+the Bot Framework connector that receives the bot's replies, and apps/backend/app.py with
+auth disabled and its Azure OpenAI, Search and Bing calls pointed at the stand-ins.
+
+    python benchmarks/loadtest.py --rate 5 --duration 60 --conversations 50
+
+Add --workers N to run the backend under gunicorn (apps/backend/gunicorn.conf.py) instead.
+
+Pass --url to target a backend that is already running (it must accept unauthenticated
+requests, i.e. have no MicrosoftAppId). For CI, --max-p95 and --max-error-rate make the
+exit code non-zero when the run is too slow or fails too often.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from aiohttp import ClientSession, ClientTimeout, web
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standins import StandInServer
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# First message of the reply that app.on_error sends when a turn raises
+BOT_ERROR_REPLY = "The bot encountered an error or bug."
+
+DEFAULT_MESSAGES = [
+    "@docsearch What are markov chains?",
+    "@docsearch What are the main risk factors for Covid-19?",
+    "@chatgpt How does random forest work?",
+    "@bing What is the weather like in Seattle?",
+    "Hello, what can you do?",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ProcessStats:
+    """CPU and memory of a process and its children (e.g. gunicorn workers), from psutil when
+    installed or /proc on Linux"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self._last_time = None
+        self._last_cpu_seconds = dict()
+
+    def _read_psutil(self, psutil) -> Dict[int, Tuple[float, int]]:
+        process = psutil.Process(self.pid)
+        usage = dict()
+        for p in [process] + process.children(recursive=True):
+            try:
+                times = p.cpu_times()
+                usage[p.pid] = (times.user + times.system, p.memory_info().rss)
+            except psutil.Error:
+                pass
+        return usage
+
+    def _read_proc(self) -> Dict[int, Tuple[float, int]]:
+        stats = dict()
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        stats[int(entry)] = f.read().rsplit(")", 1)[1].split()
+                except OSError:
+                    pass
+        pids, found = {self.pid}, True
+        while found:
+            children = {pid for pid, fields in stats.items() if int(fields[1]) in pids} - pids
+            pids |= children
+            found = bool(children)
+        return {pid: ((int(stats[pid][11]) + int(stats[pid][12])) / os.sysconf("SC_CLK_TCK"),
+                      int(stats[pid][21]) * os.sysconf("SC_PAGE_SIZE")) for pid in pids if pid in stats}
+
+    def sample(self) -> Dict[str, Optional[float]]:
+        try:
+            try:
+                import psutil
+                usage = self._read_psutil(psutil)
+            except ImportError:
+                usage = self._read_proc()
+        except Exception:
+            return {"cpu_percent": None, "rss_mb": None, "processes": None}
+        now = time.monotonic()
+        cpu_percent = None
+        if self._last_time is not None:
+            # Processes started since the last sample count from zero
+            cpu_seconds = sum(cpu - self._last_cpu_seconds.get(pid, 0.0) for pid, (cpu, _) in usage.items())
+            cpu_percent = round(100 * cpu_seconds / (now - self._last_time), 1)
+        self._last_time = now
+        self._last_cpu_seconds = {pid: cpu for pid, (cpu, _) in usage.items()}
+        return {"cpu_percent": cpu_percent, "rss_mb": round(sum(rss for _, rss in usage.values()) / 2 ** 20, 1),
+                "processes": len(usage)}
+
+
+class Connector:
+    """Stand-in of the Bot Framework connector: receives the replies the bot sends to serviceUrl
+    and keeps the time and text of the first message replying to each activity"""
+
+    def __init__(self):
+        self.replies = dict()
+        self.app = web.Application()
+        self.app.router.add_post("/v3/conversations/{conversation_id}/activities/{activity_id}", self.reply)
+        self.app.router.add_post("/v3/conversations/{conversation_id}/activities", self.reply)
+        self.runner = None
+        self.url = None
+
+    async def reply(self, request: web.Request) -> web.Response:
+        activity = await request.json()
+        reply_to = activity.get("replyToId")
+        if activity.get("type") == "message" and reply_to and reply_to not in self.replies:
+            self.replies[reply_to] = (time.perf_counter(), activity.get("text") or "")
+        return web.json_response({"id": str(uuid.uuid4())})
+
+    async def start(self) -> str:
+        port = free_port()
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+
+def make_activity(text: str, conversation: int, service_url: str) -> Dict[str, Any]:
+    return {
+        "type": "message",
+        "id": str(uuid.uuid4()),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "serviceUrl": service_url,
+        "channelId": "loadtest",
+        "from": {"id": f"user-{conversation}", "name": f"User {conversation}"},
+        "conversation": {"id": f"conversation-{conversation}"},
+        "recipient": {"id": "bot", "name": "Bot"},
+        "text": text,
+        "locale": "en-US",
+    }
+
+
+class LoadTest:
+    def __init__(self, url: str, service_url: str, connector: Connector, rate: float, duration: float,
+                 conversations: int, messages: List[str], timeout: float, stats: Optional[ProcessStats] = None):
+        self.url = url.rstrip("/")
+        self.service_url = service_url
+        self.connector = connector
+        self.rate = rate
+        self.duration = duration
+        self.conversations = conversations
+        self.messages = messages
+        self.timeout = timeout
+        self.stats = stats
+        self.results = []
+        self.in_flight = 0
+        self.intervals = []
+
+    async def send(self, session: ClientSession, i: int) -> None:
+        activity = make_activity(random.choice(self.messages), i % self.conversations, self.service_url)
+        self.in_flight += 1
+        start = time.perf_counter()
+        status, error = None, None
+        try:
+            async with session.post(self.url + "/api/messages", json=activity) as response:
+                await response.read()
+                status = response.status
+                if status >= 400:
+                    error = f"HTTP {status}"
+        except asyncio.TimeoutError:
+            error = "timeout"
+        except Exception as e:
+            error = type(e).__name__
+        finally:
+            self.in_flight -= 1
+        end = time.perf_counter()
+        replied, text = self.connector.replies.pop(activity["id"], (None, None))
+        if error is None and text == BOT_ERROR_REPLY:
+            error = "bot error"
+        self.results.append({"start": start, "end": end, "latency": end - start, "status": status, "error": error,
+                             "reply_latency": replied - start if replied else None})
+
+    async def report(self, started: float, interval: float) -> None:
+        seen = 0
+        while True:
+            await asyncio.sleep(interval)
+            done = self.results[seen:]
+            seen += len(done)
+            latencies = [r["latency"] for r in done if r["error"] is None]
+            row = {"t": round(time.perf_counter() - started, 1), "completed": len(done),
+                   "throughput": round(len(done) / interval, 2), "errors": sum(r["error"] is not None for r in done),
+                   "in_flight": self.in_flight}
+            row.update(percentiles(latencies))
+            if self.stats:
+                row.update(self.stats.sample())
+            self.intervals.append(row)
+            print(" ".join(f"{key}={value}" for key, value in row.items()), file=sys.stderr)
+
+    async def run(self, interval: float = 5.0) -> Dict[str, Any]:
+        async with ClientSession(timeout=ClientTimeout(total=self.timeout)) as session:
+            started = time.perf_counter()
+            reporter = asyncio.ensure_future(self.report(started, interval))
+            tasks, i = [], 0
+            # Open-loop arrivals: messages are sent on schedule whether or not earlier ones finished
+            next_at = started
+            while next_at - started < self.duration:
+                await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+                tasks.append(asyncio.ensure_future(self.send(session, i)))
+                i += 1
+                next_at += random.expovariate(self.rate)
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+            reporter.cancel()
+        return self.summary(elapsed)
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        ok = [r for r in self.results if r["error"] is None]
+        errors = dict()
+        for r in self.results:
+            if r["error"] is not None:
+                errors[r["error"]] = errors.get(r["error"], 0) + 1
+        summary = {"sent": len(self.results), "succeeded": len(ok), "seconds": round(elapsed, 2),
+                   "offered_rate": self.rate, "throughput": round(len(ok) / elapsed, 2),
+                   "error_rate": round(1 - len(ok) / len(self.results), 4) if self.results else 0.0,
+                   "errors": errors, "latency": percentiles([r["latency"] for r in ok]),
+                   "reply_latency": percentiles([r["reply_latency"] for r in ok if r["reply_latency"] is not None])}
+        if self.intervals:
+            cpu = [row["cpu_percent"] for row in self.intervals if row.get("cpu_percent") is not None]
+            rss = [row["rss_mb"] for row in self.intervals if row.get("rss_mb") is not None]
+            summary["resources"] = {"max_cpu_percent": max(cpu) if cpu else None, "max_rss_mb": max(rss) if rss else None}
+        return summary
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    return {name: round(float(np.percentile(values, q)), 3) for name, q in (("p50", 50), ("p95", 95), ("p99", 99))}
+
+
+def start_backend(port: int, environment: Dict[str, str], model: str, workers: Optional[int] = None) -> subprocess.Popen:
+    """Starts app.py, or gunicorn with its config when `workers` is given"""
+    env = dict(os.environ, **environment, PORT=str(port), MicrosoftAppId="", MicrosoftAppPassword="",
+               AZURE_OPENAI_MODEL_NAME=model,
+               PYTHONPATH=os.pathsep.join([os.path.join(ROOT, "common"), os.environ.get("PYTHONPATH", "")]))
+    command = [sys.executable, "app.py"]
+    if workers:
+        env["WEB_CONCURRENCY"] = str(workers)
+        command = [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "--bind", f"localhost:{port}", "app:APP"]
+    return subprocess.Popen(command, cwd=os.path.join(ROOT, "apps", "backend"), env=env)
+
+
+async def wait_until_up(url: str, process: Optional[subprocess.Popen], timeout: float = 120) -> None:
+    deadline = time.monotonic() + timeout
+    async with ClientSession(timeout=ClientTimeout(total=2)) as session:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"The backend exited with code {process.returncode}")
+            try:
+                async with session.get(url + "/healthz") as response:
+                    # The app answers before the bot is loaded; wait for it to be ready
+                    if response.status == 200 and (await response.json()).get("ready", True):
+                        return
+            except Exception:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"The backend at {url} did not come up in {timeout}s")
+
+
+async def amain(args: argparse.Namespace) -> int:
+    standins, process, stats = None, None, None
+    connector = Connector()
+    service_url = await connector.start()
+    url = args.url
+    try:
+        if url is None:
+            standins = StandInServer(latency_scale=args.latency_scale, throttle_rate=args.throttle_rate).start()
+            port = free_port()
+            process = start_backend(port, standins.environment(), args.model, args.workers)
+            stats = ProcessStats(process.pid)
+            url = f"http://localhost:{port}"
+        await wait_until_up(url, process)
+
+        messages = DEFAULT_MESSAGES
+        if args.messages:
+            with open(args.messages, encoding="utf-8") as f:
+                messages = [line.strip() for line in f if line.strip()]
+
+        test = LoadTest(url, service_url, connector, args.rate, args.duration, args.conversations,
+                        messages, args.timeout, stats)
+        summary = await test.run(args.interval)
+    finally:
+        await connector.stop()
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+        if standins is not None:
+            standins.stop()
+
+    print(json.dumps(summary, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"settings": vars(args), "summary": summary, "intervals": test.intervals}, f, indent=2)
+
+    failed = []
+    if args.max_p95 is not None and (summary["latency"]["p95"] is None or summary["latency"]["p95"] > args.max_p95):
+        failed.append(f"p95 latency {summary['latency']['p95']}s > {args.max_p95}s")
+    if args.max_error_rate is not None and summary["error_rate"] > args.max_error_rate:
+        failed.append(f"error rate {summary['error_rate']} > {args.max_error_rate}")
+    for reason in failed:
+        print("FAILED:", reason, file=sys.stderr)
+    return 1 if failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Load test the bot backend's /api/messages endpoint")
+    parser.add_argument("--url", help="backend to test; by default one is started locally against stand-ins")
+    parser.add_argument("--rate", type=float, default=2.0, help="messages per second (Poisson arrivals)")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to send messages for")
+    parser.add_argument("--conversations", type=int, default=20)
+    parser.add_argument("--messages", help="file with one message text per line (default: a mix of tools)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds before a request counts as timed out")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between progress reports")
+    parser.add_argument("--model", default="gpt-35-turbo", help="deployment name used by the local backend")
+    parser.add_argument("--workers", type=int, help="run the local backend under gunicorn with this many workers")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="latency of the local stand-ins")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of stand-in requests answered with 429")
+    parser.add_argument("--max-p95", type=float, help="fail if the p95 latency in seconds is higher")
+    parser.add_argument("--max-error-rate", type=float, help="fail if the error rate (0-1) is higher")
+    parser.add_argument("--json", help="also write the summary and the per-interval rows to this JSON file")
+    args = parser.parse_args(argv)
+    return asyncio.run(amain(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
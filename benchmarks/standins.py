@@ -0,0 +1,341 @@
+"""Local stand-ins for the Azure services the apps call, for offline benchmarks.
+
+One HTTP server answers:
+- Azure Search:  GET  /indexes/<index>/docs           semantic results with @search.rerankerScore,
+                                                      @search.captions, @search.answers and pages
+                 POST /indexes/<index>/docs/index     index-documents (push ingestion)
+- Azure OpenAI:  POST /openai/deployments/<d>/chat/completions   (also streamed)
+                 POST /openai/deployments/<d>/embeddings
+- Bing:          GET  /v7.0/search
+
+Every response waits a configurable latency (with jitter), and a fraction of requests can be
+throttled with 429 responses. Content is synthetic but deterministic, so runs are comparable.
+
+    python standins.py --port 8765 --latency-scale 1.0 --throttle-rate 0.05
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+
+# Seconds each service takes to answer at latency scale 1.0; chat also pays per generated token
+DEFAULT_LATENCY = {"search": 0.15, "index": 0.1, "embeddings": 0.05, "chat": 0.4, "bing": 0.2}
+CHAT_SECONDS_PER_TOKEN = 0.02
+
+_WORDS = ("model data learning network training results method performance analysis system "
+          "algorithm features patients covid infection study clinical risk treatment approach "
+          "graph reinforcement policy markov chain boosting forest tree regression accuracy").split()
+_SOURCE_REGEX = re.compile(r"Source:\s*(\S+)")
+_TOOL_REGEX = re.compile(r"@(docsearch|bing|covidstats|chatgpt)\b")
+_REACT_TOOLS_REGEX = re.compile(r"should be one of \[([^\]]+)\]")
+
+
+def _seeded(*parts) -> random.Random:
+    return random.Random(hashlib.md5("|".join(map(str, parts)).encode("utf-8")).hexdigest())
+
+
+def synthetic_text(num_words: int, *seed) -> str:
+    rng = _seeded(*seed)
+    words = [rng.choice(_WORDS) for _ in range(num_words)]
+    # A sentence break every ~15 words and a paragraph break every ~120 so chunkers have something to cut on
+    return " ".join(word + (".\n\n" if i % 120 == 119 else "." if i % 15 == 14 else "")
+                    for i, word in enumerate(words))
+
+
+class StandInServer:
+    """Threaded HTTP server emulating Azure Search, Azure OpenAI and Bing.
+
+    The attributes can be changed between benchmark runs without restarting the server:
+    `corpus_docs` documents exist in every index, search returns up to `$top` of them with
+    `pages_per_doc` pages of `page_words` words each.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_scale: float = 1.0, jitter: float = 0.2,
+                 throttle_rate: float = 0.0, corpus_docs: int = 1000, pages_per_doc: int = 3, page_words: int = 300,
+                 embedding_dim: int = 1536, completion_tokens: int = 80,
+                 latency: Optional[Dict[str, float]] = None):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.latency_scale = latency_scale
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.corpus_docs = corpus_docs
+        self.pages_per_doc = pages_per_doc
+        self.page_words = page_words
+        self.embedding_dim = embedding_dim
+        self.completion_tokens = completion_tokens
+        self.requests = dict()
+        self.throttled = dict()
+        # Deterministic failures for tests: the next `throttle_next[service]` requests get a 429, and
+        # an index action whose key is in `index_failures` fails that many more times with a 503
+        self.throttle_next = dict()
+        self.index_failures = dict()
+        self.indexed_keys = []
+        self._lock = threading.Lock()
+        self._rng = random.Random(0)
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StandInServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def environment(self) -> Dict[str, str]:
+        """Environment variables that point the apps and utils at this server"""
+        return {
+            "AZURE_SEARCH_ENDPOINT": self.url,
+            "AZURE_SEARCH_KEY": "stand-in",
+            "AZURE_SEARCH_API_VERSION": "2021-04-30-Preview",
+            "AZURE_OPENAI_ENDPOINT": self.url,
+            "AZURE_OPENAI_API_KEY": "stand-in",
+            "AZURE_OPENAI_API_VERSION": "2023-05-15",
+            "OPENAI_API_BASE": self.url,
+            "OPENAI_API_KEY": "stand-in",
+            "OPENAI_API_VERSION": "2023-05-15",
+            "OPENAI_API_TYPE": "azure",
+            "BING_SEARCH_URL": self.url + "/v7.0/search",
+            "BING_SUBSCRIPTION_KEY": "stand-in",
+            "DATASOURCE_SAS_TOKEN": "?sas=stand-in",
+        }
+
+    # Behaviour shared by all endpoints
+
+    def _count(self, service: str, throttled: bool = False) -> None:
+        with self._lock:
+            self.requests[service] = self.requests.get(service, 0) + 1
+            if throttled:
+                self.throttled[service] = self.throttled.get(service, 0) + 1
+
+    def _should_throttle(self, service: str) -> bool:
+        with self._lock:
+            if self.throttle_next.get(service):
+                self.throttle_next[service] -= 1
+                return True
+            return bool(self.throttle_rate) and self._rng.random() < self.throttle_rate
+
+    def _wait(self, service: str, extra: float = 0.0) -> None:
+        seconds = (self.latency[service] + extra) * self.latency_scale
+        if seconds > 0:
+            with self._lock:
+                factor = 1 + self._rng.uniform(-self.jitter, self.jitter)
+            time.sleep(seconds * factor)
+
+    # Responses
+
+    def search_response(self, index: str, query: str, top: int) -> dict:
+        rng = _seeded(index, query)
+        ids = rng.sample(range(self.corpus_docs), min(top, self.corpus_docs))
+        scores = sorted((rng.uniform(0.5, 3.5) for _ in ids), reverse=True)
+        value = []
+        for doc_id, score in zip(ids, scores):
+            pages = [synthetic_text(self.page_words, index, doc_id, page) for page in range(self.pages_per_doc)]
+            value.append({
+                "@search.score": score * 3,
+                "@search.rerankerScore": score,
+                "@search.captions": [{"text": pages[0][:200], "highlights": ""}],
+                "id": f"{index}-{doc_id}",
+                "title": f"Document {doc_id}",
+                "content": " ".join(pages),
+                "pages": pages,
+                "language": "en",
+                "metadata_storage_name": f"doc{doc_id}.pdf",
+                "metadata_storage_path": f"{self.url}/{index}/doc{doc_id}.pdf",
+            })
+        answers = [{"key": value[0]["id"], "text": value[0]["pages"][0][:300], "highlights": None,
+                    "score": 0.9}] if value else []
+        return {"@odata.count": len(value), "@search.answers": answers, "value": value}
+
+    def index_result(self, key: str) -> dict:
+        with self._lock:
+            if self.index_failures.get(key):
+                self.index_failures[key] -= 1
+                return {"key": key, "status": False, "statusCode": 503, "errorMessage": "Service unavailable (stand-in)."}
+            self.indexed_keys.append(key)
+        return {"key": key, "status": True, "statusCode": 200}
+
+    def chat_text(self, messages: List[dict]) -> str:
+        prompt = messages[-1]["content"] if messages else ""
+        sources = _SOURCE_REGEX.findall(prompt.split("QUESTION:")[-1])
+        words = _seeded(prompt).sample(_WORDS * 8, k=min(self.completion_tokens, len(_WORDS) * 8))
+        answer = " ".join(words).capitalize() + "."
+        if any("action_input" in m.get("content", "") for m in messages):
+            # Conversational agent (the bot): call the tool named in the input, if any, else answer
+            user_input = prompt.split("NOTHING else):")[-1]
+            tool = _TOOL_REGEX.search(user_input) if "TOOL RESPONSE" not in prompt else None
+            action = {"action": tool.group(0), "action_input": user_input.strip()} if tool else \
+                {"action": "Final Answer", "action_input": answer}
+            return "```json\n" + json.dumps(action) + "\n```"
+        if "Final Answer:" in prompt:
+            # ReAct agents (e.g. the Bing tool): use the first tool once, then answer
+            tools = _REACT_TOOLS_REGEX.search(prompt)
+            if tools and "Observation:" not in prompt.split("Question:")[-1]:
+                question = prompt.split("Question:")[-1].split("\n")[0].strip()
+                return f"Thought: I should search\nAction: {tools.group(1).split(',')[0].strip()}\nAction Input: {question}"
+            return "Thought: I now know the final answer\nFinal Answer: " + answer
+        return answer + "\nSOURCES: " + (", ".join(sources[:2]) if sources else "N/A")
+
+    def embedding(self, item) -> List[float]:
+        rng = _seeded(json.dumps(item))
+        return [rng.uniform(-1, 1) for _ in range(self.embedding_dim)]
+
+    def bing_response(self, query: str, count: int) -> dict:
+        value = [{"name": f"Result {i} for {query}", "url": f"https://example.com/{i}",
+                  "snippet": synthetic_text(40, "bing", query, i)} for i in range(count)]
+        return {"webPages": {"value": value}}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status: int, body: dict, headers: Optional[Dict[str, str]] = None) -> None:
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _throttle(self, service: str) -> bool:
+                if server._should_throttle(service):
+                    server._count(service, throttled=True)
+                    self._send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded (stand-in)."}},
+                                    {"Retry-After": "1"})
+                    return True
+                server._count(service)
+                return False
+
+            def _body(self) -> dict:
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                match = re.match(r"^/indexes/([^/]+)/docs$", url.path)
+                if match:
+                    if self._throttle("search"):
+                        return
+                    server._wait("search")
+                    return self._send_json(200, server.search_response(match.group(1), params.get("search", ""),
+                                                                       int(params.get("$top", 5))))
+                if url.path == "/v7.0/search":
+                    if self._throttle("bing"):
+                        return
+                    server._wait("bing")
+                    return self._send_json(200, server.bing_response(params.get("q", ""), int(params.get("count", 5))))
+                self._send_json(404, {"error": {"message": "not found"}})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                body = self._body()
+                if re.match(r"^/indexes/[^/]+/docs/index$", url.path):
+                    if self._throttle("index"):
+                        return
+                    server._wait("index")
+                    results = [server.index_result(action.get("id")) for action in body.get("value", [])]
+                    status = 207 if any(not result["status"] for result in results) else 200
+                    return self._send_json(status, {"value": results})
+                if url.path.endswith("/embeddings"):
+                    if self._throttle("embeddings"):
+                        return
+                    server._wait("embeddings")
+                    inputs = body.get("input")
+                    # A single string, a single list of tokens, or a list of either
+                    if isinstance(inputs, str) or (isinstance(inputs, list) and inputs and isinstance(inputs[0], int)):
+                        inputs = [inputs]
+                    data = [{"object": "embedding", "index": i, "embedding": server.embedding(item)}
+                            for i, item in enumerate(inputs or [])]
+                    return self._send_json(200, {"object": "list", "data": data, "model": "text-embedding-ada-002",
+                                                 "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+                if url.path.endswith("/chat/completions"):
+                    if self._throttle("chat"):
+                        return
+                    text = server.chat_text(body.get("messages", []))
+                    prompt_tokens = sum(len(m.get("content", "").split()) for m in body.get("messages", []))
+                    completion_tokens = len(text.split())
+                    if body.get("stream"):
+                        return self._stream_chat(text)
+                    server._wait("chat", completion_tokens * CHAT_SECONDS_PER_TOKEN)
+                    return self._send_json(200, {
+                        "id": "chatcmpl-standin", "object": "chat.completion", "created": int(time.time()),
+                        "model": "gpt-35-turbo",
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": text}}],
+                        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                  "total_tokens": prompt_tokens + completion_tokens},
+                    })
+                self._send_json(404, {"error": {"message": "not found"}})
+
+            def _stream_chat(self, text: str) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                server._wait("chat")
+                for i, word in enumerate(text.split(" ")):
+                    chunk = {"id": "chatcmpl-standin", "object": "chat.completion.chunk", "created": int(time.time()),
+                             "model": "gpt-35-turbo",
+                             "choices": [{"index": 0, "finish_reason": None,
+                                          "delta": {"content": word if i == 0 else " " + word}}]}
+                    self.wfile.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+                    self.wfile.flush()
+                    time.sleep(CHAT_SECONDS_PER_TOKEN * server.latency_scale)
+                done = {"id": "chatcmpl-standin", "object": "chat.completion.chunk", "created": int(time.time()),
+                        "model": "gpt-35-turbo", "choices": [{"index": 0, "finish_reason": "stop", "delta": {}}]}
+                self.wfile.write(b"data: " + json.dumps(done).encode("utf-8") + b"\n\ndata: [DONE]\n\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve stand-ins for Azure Search, Azure OpenAI and Bing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplies every latency; 0 for none")
+    parser.add_argument("--jitter", type=float, default=0.2, help="relative +/- jitter of the latencies")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--corpus-docs", type=int, default=1000)
+    parser.add_argument("--pages-per-doc", type=int, default=3)
+    parser.add_argument("--page-words", type=int, default=300)
+    args = parser.parse_args()
+
+    server = StandInServer(args.host, args.port, latency_scale=args.latency_scale, jitter=args.jitter,
+                           throttle_rate=args.throttle_rate, corpus_docs=args.corpus_docs,
+                           pages_per_doc=args.pages_per_doc, page_words=args.page_words)
+    print("Serving stand-ins on", server.url)
+    for key, value in server.environment().items():
+        print(f"  {key}={value}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
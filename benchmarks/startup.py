@@ -0,0 +1,141 @@
+"""Import-time profile and cold start time of the bot backend and the shared utils.
+
+For each module, runs `python -X importtime -c "import <module>"` in a fresh interpreter (with
+common/ on the path, from apps/backend) and reports the wall time, the top-level packages that
+take the most time to import (summing their own import times) and the slowest direct imports
+of the module.
+
+The Azure settings point at the local stand-ins (see standins.py). With --app it also starts
+apps/backend/app.py and reports how long it takes until /healthz answers (the port is open)
+and until the bot is loaded ("ready": true).
+
+    python benchmarks/startup.py utils bot --top 15 --app
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from aiohttp import ClientSession, ClientTimeout
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadtest import ROOT, free_port, start_backend
+from standins import StandInServer
+
+
+def parse_importtime(stderr: str) -> List[Dict[str, Any]]:
+    """Parses the `-X importtime` lines into (module, depth, self_us, cumulative_us) records"""
+    records = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        records.append({"module": name.strip(), "depth": depth,
+                        "self_us": int(self_us), "cumulative_us": int(cumulative_us)})
+    return records
+
+
+def profile_import(module: str, top: int, environment: Dict[str, str]) -> Dict[str, Any]:
+    env = dict(os.environ, **environment, PYTHONPATH=os.pathsep.join([os.path.join(ROOT, "common"), os.environ.get("PYTHONPATH", "")]))
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=os.path.join(ROOT, "apps", "backend"),
+                               env=env, capture_output=True, text=True)
+    seconds = time.perf_counter() - started
+    if completed.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{completed.stderr[-2000:]}")
+    records = parse_importtime(completed.stderr)
+
+    packages = dict()
+    for record in records:
+        package = record["module"].split(".")[0]
+        packages[package] = packages.get(package, 0) + record["self_us"]
+    # The module is the last record at depth 0; its direct imports are the depth 1 records before it
+    target = max((i for i, r in enumerate(records) if r["module"] == module), default=len(records) - 1)
+    first = max((i for i, r in enumerate(records[:target]) if r["depth"] == 0), default=-1) + 1
+    direct = [r for r in records[first:target] if r["depth"] == 1]
+
+    return {"module": module, "wall_seconds": round(seconds, 3),
+            "import_seconds": round(records[target]["cumulative_us"] / 1e6, 3) if records else None,
+            "modules_imported": len(records),
+            "packages": [{"package": name, "seconds": round(us / 1e6, 3)}
+                         for name, us in sorted(packages.items(), key=lambda item: -item[1])[:top]],
+            "direct_imports": [{"module": r["module"], "seconds": round(r["cumulative_us"] / 1e6, 3)}
+                               for r in sorted(direct, key=lambda r: -r["cumulative_us"])[:top]]}
+
+
+def print_profile(profile: Dict[str, Any]) -> None:
+    print(f"\nimport {profile['module']}: {profile['import_seconds']}s importing {profile['modules_imported']} modules "
+          f"({profile['wall_seconds']}s with interpreter start up)")
+    print(f"  {'package (own import time)':<40}{'seconds':>9}")
+    for row in profile["packages"]:
+        print(f"  {row['package']:<40}{row['seconds']:>9.3f}")
+    print(f"  {'direct import (cumulative)':<40}{'seconds':>9}")
+    for row in profile["direct_imports"]:
+        print(f"  {row['module']:<40}{row['seconds']:>9.3f}")
+
+
+async def time_app_startup(environment: Dict[str, str], timeout: float = 120) -> Dict[str, Optional[float]]:
+    """Seconds from starting app.py until /healthz answers and until the bot is ready"""
+    port = free_port()
+    started = time.perf_counter()
+    process = start_backend(port, environment, "gpt-35-turbo")
+    result = {"listening_seconds": None, "ready_seconds": None}
+    try:
+        async with ClientSession(timeout=ClientTimeout(total=2)) as session:
+            while time.perf_counter() - started < timeout and process.poll() is None:
+                try:
+                    async with session.get(f"http://localhost:{port}/healthz") as response:
+                        body = await response.json()
+                    elapsed = round(time.perf_counter() - started, 3)
+                    if result["listening_seconds"] is None:
+                        result["listening_seconds"] = elapsed
+                    if body.get("ready", True):
+                        result["ready_seconds"] = elapsed
+                        break
+                except Exception:
+                    pass
+                await asyncio.sleep(0.05)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Import-time profile and cold start time of the bot backend")
+    parser.add_argument("modules", nargs="*", default=["utils", "bot"], help="modules to profile (from common/ or apps/backend/)")
+    parser.add_argument("--top", type=int, default=10, help="packages and imports to list per module")
+    parser.add_argument("--app", action="store_true", help="also time the start up of app.py against the stand-ins")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    # bot.py reads the Azure OpenAI settings at import time, so point them at the stand-ins
+    standins = StandInServer(latency_scale=0).start()
+    results = {"imports": []}
+    try:
+        for module in args.modules:
+            profile = profile_import(module, args.top, standins.environment())
+            print_profile(profile)
+            results["imports"].append(profile)
+
+        if args.app:
+            results["app"] = asyncio.run(time_app_startup(standins.environment()))
+            print(f"\napp.py: listening after {results['app']['listening_seconds']}s, "
+                  f"bot ready after {results['app']['ready_seconds']}s")
+    finally:
+        standins.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+"""Batch question answering over the Azure Search indexes.
+
+Answers a file of questions through the same path as DocSearchTool: get_search_results ->
+order_search_results -> optional compression to the relevant sentences -> token check (and vector
+search when the docs don't fit) -> get_answer. Questions are processed concurrently, with
+separate limits for the search and the answer stage, and each result is appended to a JSONL
+file as soon as it is ready:
+
+    python batch_qa.py questions.txt answers.jsonl --search-concurrency 8 --answer-concurrency 4
+
+The questions file has one question per line, or is a .jsonl file of {"id": ..., "question": ...}
+objects (the id defaults to a hash of the question). Re-running with the same output file
+resumes: questions that already have an answer are skipped, failed ones are retried.
+
+Azure Search and Azure OpenAI settings are read from the same environment variables as the apps.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+from langchain.chat_models import AzureChatOpenAI
+from langchain.docstore.document import Document
+
+try:
+    from .utils import (get_search_results, order_search_results, model_tokens_limit, num_tokens_from_docs,
+                        embed_docs, search_docs, get_answer)
+    from .dedup import dedup_docs
+    from .compression import compress_docs, compression_tokens_from_env
+except ImportError:
+    from utils import (get_search_results, order_search_results, model_tokens_limit, num_tokens_from_docs,
+                       embed_docs, search_docs, get_answer)
+    from dedup import dedup_docs
+    from compression import compress_docs, compression_tokens_from_env
+
+
+_SOURCES_REGEX = re.compile("sources?:?\\W*", re.IGNORECASE)
+
+
+def question_id(question: str) -> str:
+    return hashlib.sha1(question.strip().encode("utf-8")).hexdigest()[:16]
+
+
+def read_questions(path: str) -> Iterator[Dict[str, str]]:
+    """Yields {"id", "question"} items from a text file (one question per line) or a .jsonl file"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                item = json.loads(line)
+                yield {"id": str(item.get("id") or question_id(item["question"])), "question": item["question"]}
+            else:
+                yield {"id": question_id(line), "question": line}
+
+
+def answered_ids(path: str) -> Set[str]:
+    """Ids of the questions already answered without error in an output file"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by an interruption
+            if record.get("error") is None:
+                done.add(record["id"])
+    return done
+
+
+def _ends_with_partial_line(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        if not f.tell():
+            return False
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) != b"\n"
+
+
+class BatchAnswerer:
+    """Answers questions like DocSearchTool, timing each stage and bounding the
+    number of concurrent search and answer calls separately"""
+
+    def __init__(self, llm: AzureChatOpenAI, indexes: List[str], k: int = 10, reranker_threshold: int = 1,
+                 language: str = "English", chunks_limit: int = 100, similarity_k: int = 4,
+                 search_concurrency: int = 8, answer_concurrency: int = 4, compression_tokens: Optional[int] = None):
+        self.llm = llm
+        self.indexes = indexes
+        self.k = k
+        self.reranker_threshold = reranker_threshold
+        self.language = language
+        self.chunks_limit = chunks_limit
+        self.similarity_k = similarity_k
+        self.search_concurrency = search_concurrency
+        self.answer_concurrency = answer_concurrency
+        self.compression_tokens = compression_tokens or None
+        self._search_slots = threading.BoundedSemaphore(search_concurrency)
+        self._answer_slots = threading.BoundedSemaphore(answer_concurrency)
+
+    def answer(self, item: Dict[str, str]) -> Dict[str, Any]:
+        """Answers one question and returns its output record; errors are recorded, not raised"""
+        query = item["question"]
+        record = {"id": item["id"], "question": query, "answer": None, "sources": [], "chain_type": None,
+                  "num_tokens": None, "timings": {}, "error": None}
+        timings = record["timings"]
+        started = time.perf_counter()
+
+        def timed(stage, func, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings[stage] = round(time.perf_counter() - start, 3)
+
+        try:
+            with self._search_slots:
+                agg_search_results = timed("search", get_search_results, query, self.indexes, self.k)
+            ordered_results = timed("order", order_search_results, agg_search_results, reranker_threshold=self.reranker_threshold)
+
+            docs = []
+            for key, value in ordered_results.items():
+                for page in value["chunks"]:
+                    docs.append(Document(page_content=page, metadata={"source": value["location"]}))
+            docs = dedup_docs(docs)
+            if not docs:
+                record["answer"] = "No Results Found in my knowledge base"
+                return record
+            if self.compression_tokens is not None:
+                docs = timed("compress", compress_docs, docs, query, max_tokens_per_doc=self.compression_tokens)
+
+            tokens_limit = model_tokens_limit(self.llm.deployment_name)
+            num_tokens = timed("tokens", num_tokens_from_docs, docs)
+            if num_tokens > tokens_limit:
+                with self._search_slots:
+                    index = timed("embed", embed_docs, docs, chunks_limit=self.chunks_limit)
+                top_docs = timed("vector_search", search_docs, index, query, k=self.similarity_k)
+                num_tokens = num_tokens_from_docs(top_docs)
+                chain_type = "map_reduce" if num_tokens > tokens_limit else "stuff"
+            else:
+                top_docs = docs
+                chain_type = "stuff"
+            record["chain_type"], record["num_tokens"] = chain_type, num_tokens
+
+            with self._answer_slots:
+                response = timed("answer", get_answer, llm=self.llm, docs=top_docs, query=query,
+                                 language=self.language, chain_type=chain_type)
+            parts = _SOURCES_REGEX.split(response["output_text"])
+            record["answer"] = parts[0].strip()
+            if len(parts) > 1:
+                record["sources"] = [source for source in parts[1].replace(" ", "").split(",") if source]
+
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            # Wall-clock time, including the waits for a search or answer slot
+            timings["total"] = round(time.perf_counter() - started, 3)
+        return record
+
+    def run(self, items: Iterable[Dict[str, str]], output_path: str, verbose: bool = True) -> Dict[str, Any]:
+        """Answers the items not yet in `output_path` and appends their records to it"""
+        done = answered_ids(output_path)
+        todo = (item for item in items if item["id"] not in done)
+        # Enough threads to keep both stages busy; the semaphores bound each stage
+        workers = self.search_concurrency + self.answer_concurrency
+        stats = {"skipped": len(done), "answered": 0, "errors": 0}
+        started = time.perf_counter()
+
+        with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as executor:
+            if _ends_with_partial_line(output_path):
+                # End the line an interrupted run left, so the next record is not appended to it
+                out.write("\n")
+            def write(record):
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                stats["errors" if record["error"] else "answered"] += 1
+                if verbose:
+                    print(f"{stats['answered']} answered, {stats['errors']} errors, "
+                          f"{round(time.perf_counter() - started, 1)}s", file=sys.stderr)
+
+            pending = set()
+            for item in todo:
+                pending.add(executor.submit(self.answer, item))
+                # Keep a bounded number of questions in flight
+                if len(pending) >= workers * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        write(future.result())
+            for future in pending:
+                write(future.result())
+
+        stats["seconds"] = round(time.perf_counter() - started, 2)
+        return stats
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Answer a file of questions from the Azure Search indexes")
+    parser.add_argument("questions", help="text file with one question per line, or .jsonl with id and question")
+    parser.add_argument("output", help="JSONL file the answers are appended to; re-runs resume from it")
+    parser.add_argument("--indexes", nargs="+", default=["cogsrch-index-files", "cogsrch-index-csv"])
+    parser.add_argument("--model", default=os.environ.get("AZURE_OPENAI_MODEL_NAME"))
+    parser.add_argument("--language", default="English")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--reranker-threshold", type=int, default=1)
+    parser.add_argument("--chunks-limit", type=int, default=100)
+    parser.add_argument("--similarity-k", type=int, default=4)
+    parser.add_argument("--search-concurrency", type=int, default=8, help="concurrent Azure Search and embedding calls")
+    parser.add_argument("--answer-concurrency", type=int, default=4, help="concurrent answer generations")
+    parser.add_argument("--compression-tokens", type=int, default=compression_tokens_from_env(),
+                        help="tokens kept of each chunk (default: COMPRESSION_TOKENS_PER_DOC), 0 to keep whole chunks")
+    args = parser.parse_args(argv)
+
+    os.environ["OPENAI_API_BASE"] = os.environ.get("AZURE_OPENAI_ENDPOINT")
+    os.environ["OPENAI_API_KEY"] = os.environ.get("AZURE_OPENAI_API_KEY")
+    os.environ["OPENAI_API_VERSION"] = os.environ.get("AZURE_OPENAI_API_VERSION")
+    os.environ["OPENAI_API_TYPE"] = "azure"
+
+    llm = AzureChatOpenAI(deployment_name=args.model, temperature=0, max_tokens=500)
+    answerer = BatchAnswerer(llm, args.indexes, k=args.k, reranker_threshold=args.reranker_threshold,
+                             language=args.language, chunks_limit=args.chunks_limit, similarity_k=args.similarity_k,
+                             search_concurrency=args.search_concurrency, answer_concurrency=args.answer_concurrency,
+                             compression_tokens=args.compression_tokens)
+    stats = answerer.run(read_questions(args.questions), args.output)
+    print(json.dumps(stats))
+    return 1 if stats["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
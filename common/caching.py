@@ -0,0 +1,256 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Union
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    `maxsize` bounds the number of entries; the least recently used entry is
+    evicted first. A `ttl` of None keeps entries until they are evicted or
+    invalidated.
+    """
+
+    shared = False  # Each process has its own entries
+
+    def __init__(self, maxsize: int = 128, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, expires_at: Optional[float]) -> bool:
+        return expires_at is not None and time.monotonic() >= expires_at
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING or self._expired(item[1]):
+                if item is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """Returns the cached value for `key`, computing it with `func` on a miss."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+        return default if item is _MISSING else item[0]
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Removes every entry whose key matches `predicate`. Returns the number removed."""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def _stable_key(key: Hashable) -> str:
+    """Text of a key that is the same in every process (set order depends on the hash seed)"""
+    if isinstance(key, (set, frozenset)):
+        return "{" + ",".join(sorted(_stable_key(item) for item in key)) + "}"
+    if isinstance(key, tuple):
+        return "(" + ",".join(_stable_key(item) for item in key) + ")"
+    return repr(key)
+
+
+class SQLiteCache:
+    """Cache with the interface of TTLCache, stored in a SQLite file so that the processes on
+    a machine (e.g. the gunicorn workers of the bot) share its entries.
+
+    Several caches can live in the same file under different names. Keys must be made of
+    strings, numbers, tuples and sets; values are pickled. Expiry uses wall-clock time, and
+    eviction is approximately LRU: the last use of an entry is recorded at most once a
+    second. `hits` and `misses` count the lookups of this process only.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, name: str, maxsize: int = 128, ttl: Optional[float] = None):
+        self.path = path
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, opened again in forked processes
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS cache_entries (cache TEXT, key TEXT, key_data BLOB, "
+                               "value BLOB, expires_at REAL, used_at REAL, PRIMARY KEY (cache, key))")
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_entries_used_at ON cache_entries (cache, used_at)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def _key(key: Hashable) -> str:
+        return hashlib.sha1(_stable_key(key).encode("utf-8")).hexdigest()
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        connection = self._connection()
+        stored_key, now = self._key(key), time.time()
+        row = connection.execute("SELECT value, expires_at, used_at FROM cache_entries WHERE cache = ? AND key = ?",
+                                 (self.name, stored_key)).fetchone()
+        if row is None or (row[1] is not None and now >= row[1]):
+            if row is not None:
+                connection.execute("DELETE FROM cache_entries WHERE cache = ? AND key = ? AND expires_at <= ?",
+                                   (self.name, stored_key, now))
+            self._count(hit=False)
+            return default
+        if now - row[2] > 1:
+            connection.execute("UPDATE cache_entries SET used_at = ? WHERE cache = ? AND key = ?", (now, self.name, stored_key))
+        self._count(hit=True)
+        return pickle.loads(row[0])
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?, ?)",
+                           (self.name, self._key(key), pickle.dumps(key), pickle.dumps(value), expires_at, now))
+        connection.execute("DELETE FROM cache_entries WHERE cache = ? AND (expires_at <= ? OR key IN ("
+                           "SELECT key FROM cache_entries WHERE cache = ? ORDER BY used_at DESC LIMIT -1 OFFSET ?))",
+                           (self.name, now, self.name, self.maxsize))
+
+    def get_or_set(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """Returns the cached value for `key`, computing it with `func` on a miss."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        connection, stored_key = self._connection(), self._key(key)
+        row = connection.execute("SELECT value, expires_at FROM cache_entries WHERE cache = ? AND key = ?",
+                                 (self.name, stored_key)).fetchone()
+        connection.execute("DELETE FROM cache_entries WHERE cache = ? AND key = ?", (self.name, stored_key))
+        if row is None or (row[1] is not None and time.time() >= row[1]):
+            return default
+        return pickle.loads(row[0])
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Removes every entry whose key matches `predicate`. Returns the number removed."""
+        connection = self._connection()
+        rows = connection.execute("SELECT key, key_data FROM cache_entries WHERE cache = ?", (self.name,)).fetchall()
+        keys = [(self.name, stored_key) for stored_key, key_data in rows if predicate(pickle.loads(key_data))]
+        connection.executemany("DELETE FROM cache_entries WHERE cache = ? AND key = ?", keys)
+        return len(keys)
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM cache_entries WHERE cache = ?", (self.name,))
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM cache_entries WHERE cache = ? AND "
+                                          "(expires_at IS NULL OR expires_at > ?)", (self.name, time.time())).fetchone()[0]
+
+
+def make_cache(name: str, maxsize: int = 128, ttl: Optional[float] = None) -> Union[TTLCache, SQLiteCache]:
+    """Returns a TTLCache, or a SQLiteCache shared by the processes on this machine when the
+    SHARED_CACHE_PATH environment variable names its file"""
+    path = os.environ.get("SHARED_CACHE_PATH")
+    if path:
+        return SQLiteCache(path, name, maxsize=maxsize, ttl=ttl)
+    return TTLCache(maxsize=maxsize, ttl=ttl)
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into a single execution.
+
+    The first caller for a key runs `func`; callers arriving while it is in flight
+    wait for it and receive the same result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
@@ -1,8 +1,24 @@
 import sys
+import time
+import queue
 from typing import Any, Dict, List, Optional, Union
 from langchain.callbacks.base import BaseCallbackHandler
+from uuid import UUID
 from langchain.schema import AgentAction, AgentFinish, LLMResult
 
+try:
+    from .tracing import start_span
+    from .metrics import Counter, Histogram
+except ImportError:
+    from tracing import start_span
+    from metrics import Counter, Histogram
+
+
+LLM_REQUESTS = Counter("llm_requests_total", "LLM calls", ["model"])
+LLM_ERRORS = Counter("llm_errors_total", "LLM calls that failed after retries", ["model", "error"])
+LLM_LATENCY = Histogram("llm_duration_seconds", "Duration of LLM calls", ["model"])
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens used by LLM calls", ["model", "kind"])
+
 DEFAULT_ANSWER_PREFIX_TOKENS = ["Final", "Answer", ":"]
         
 class MyCustomHandler(BaseCallbackHandler):
@@ -28,5 +44,75 @@ class MyCustomHandler(BaseCallbackHandler):
 
     def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
         sys.stdout.write(f"{action.log}\n")
-        
-        
+
+
+class QueueCallbackHandler(BaseCallbackHandler):
+    """Callback handler that puts the streamed LLM tokens in a queue, so that
+    another thread (e.g. the Streamlit script) can render them as they arrive.
+    Only works with LLMs that have streaming enabled.
+    """
+
+    def __init__(self, tokens: queue.Queue):
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        """Run on new LLM token. Only available when streaming is enabled."""
+        self.tokens.put(token)
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Callback handler that records each LLM call as a span (see tracing.py), with its
+    latency and its prompt/completion token counts, under the span that made the call.
+    """
+
+    def __init__(self):
+        self._spans = dict()
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        span = start_span("llm", {"llm.model": (serialized.get("kwargs") or {}).get("deployment_name"),
+                                  "llm.prompts": len(prompts)})
+        if span is not None:
+            self._spans[run_id] = span
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        span = self._spans.pop(run_id, None)
+        if span is None:
+            return
+        # Streaming responses do not report token usage
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            if key in token_usage:
+                span.set_attribute("llm." + key, token_usage[key])
+        span.end()
+
+    def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], *, run_id: UUID, **kwargs: Any) -> None:
+        span = self._spans.pop(run_id, None)
+        if span is not None:
+            span.end(error)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Callback handler that counts LLM calls, errors and tokens and observes their latency
+    in the process metrics (see metrics.py).
+    """
+
+    def __init__(self):
+        self._starts = dict()
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        model = (serialized.get("kwargs") or {}).get("deployment_name") or ""
+        self._starts[run_id] = (model, time.perf_counter())
+        LLM_REQUESTS.inc(model=model)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        model, start = self._starts.pop(run_id, ("", None))
+        if start is not None:
+            LLM_LATENCY.observe(time.perf_counter() - start, model=model)
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        for kind in ("prompt", "completion"):
+            if kind + "_tokens" in token_usage:
+                LLM_TOKENS.inc(token_usage[kind + "_tokens"], model=model, kind=kind)
+
+    def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], *, run_id: UUID, **kwargs: Any) -> None:
+        model, start = self._starts.pop(run_id, ("", None))
+        LLM_ERRORS.inc(model=model, error=type(error).__name__)
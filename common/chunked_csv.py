@@ -0,0 +1,152 @@
+import operator
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+
+# Filters are a list of (column, op, value) tuples that must all hold, e.g.
+# [("state", "==", "TX"), ("date", ">=", "2020-07-01"), ("date", "<=", "2020-07-31")]
+Filter = Tuple[str, str, Any]
+
+_FILTER_OPS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda series, value: series.isin(value),
+    "not in": lambda series, value: ~series.isin(value),
+}
+
+# How the partial result of each aggregation is combined across chunks
+_PARTIAL_AGGS = {"sum": "sum", "count": "sum", "min": "min", "max": "max", "size": "sum"}
+
+
+class ChunkedCSVDataset:
+    """Lazily scanned view over a CSV file that never loads the whole file.
+
+    Every operation streams the file in chunks of `chunksize` rows. Only the columns
+    that are selected or filtered on are parsed, and filters are applied to each chunk
+    before anything is kept, so memory is bounded by the chunk size and the size of
+    the result rather than by the size of the file.
+    """
+
+    def __init__(self, path: str, chunksize: int = 100000, pandas_kwargs: Optional[dict] = None):
+        self.path = path
+        self.chunksize = chunksize
+        self.pandas_kwargs = pandas_kwargs or {}
+        self._columns = None
+
+    def __repr__(self) -> str:
+        return f"ChunkedCSVDataset(path={self.path!r}, columns={self.columns})"
+
+    @property
+    def columns(self) -> List[str]:
+        """Column names, read from the header only"""
+        if self._columns is None:
+            import pandas as pd
+            self._columns = list(pd.read_csv(self.path, nrows=0, **self.pandas_kwargs).columns)
+        return self._columns
+
+    def head(self, n: int = 5):
+        """First `n` rows as a DataFrame"""
+        import pandas as pd
+        return pd.read_csv(self.path, nrows=n, **self.pandas_kwargs)
+
+    def _usecols(self, columns: Optional[Sequence[str]], filters: Optional[List[Filter]]) -> Optional[List[str]]:
+        if columns is None:
+            return None
+        needed = list(columns) + [f[0] for f in filters or [] if f[0] not in columns]
+        missing = set(needed) - set(self.columns)
+        if missing:
+            raise KeyError(f"Columns not found in {self.path}: {sorted(missing)}")
+        return needed
+
+    def scan(self, columns: Optional[Sequence[str]] = None, filters: Optional[List[Filter]] = None) -> Iterator[Any]:
+        """Yields DataFrame chunks with only `columns` (all if None) and only the rows matching `filters`"""
+        import pandas as pd
+
+        usecols = self._usecols(columns, filters)
+        reader = pd.read_csv(self.path, usecols=usecols, chunksize=self.chunksize, **self.pandas_kwargs)
+        for chunk in reader:
+            if filters:
+                mask = pd.Series(True, index=chunk.index)
+                for column, op, value in filters:
+                    if op not in _FILTER_OPS:
+                        raise ValueError(f"Unsupported filter operator: {op}")
+                    mask &= _FILTER_OPS[op](chunk[column], value)
+                chunk = chunk[mask]
+            if columns is not None:
+                chunk = chunk[list(columns)]
+            if len(chunk):
+                yield chunk
+
+    def select(self, columns: Optional[Sequence[str]] = None, filters: Optional[List[Filter]] = None,
+               limit: Optional[int] = 1000):
+        """Collects the matching rows into one DataFrame, stopping after `limit` rows"""
+        import pandas as pd
+
+        parts, num_rows = [], 0
+        for chunk in self.scan(columns, filters):
+            parts.append(chunk)
+            num_rows += len(chunk)
+            if limit is not None and num_rows >= limit:
+                break
+        if not parts:
+            return pd.DataFrame(columns=list(columns) if columns is not None else self.columns)
+        df = pd.concat(parts, ignore_index=True)
+        return df.head(limit) if limit is not None else df
+
+    def aggregate(self, aggs: Dict[str, Union[str, List[str]]], filters: Optional[List[Filter]] = None,
+                  group_by: Optional[Union[str, List[str]]] = None):
+        """Computes aggregations in one streaming pass.
+
+        `aggs` maps a column to one or more of "sum", "count", "min", "max", "mean" and "size".
+        Without `group_by` a Series indexed by "column_agg" is returned, otherwise a DataFrame
+        indexed by the group keys with one "column_agg" column per aggregation.
+        """
+        import pandas as pd
+
+        group_by = [group_by] if isinstance(group_by, str) else list(group_by or [])
+        aggs = {column: [agg] if isinstance(agg, str) else list(agg) for column, agg in aggs.items()}
+
+        # mean is computed from the partial sums and counts
+        partial_aggs = {}
+        for column, names in aggs.items():
+            for name in names:
+                if name == "mean":
+                    partial_aggs.setdefault(column, set()).update(["sum", "count"])
+                elif name in _PARTIAL_AGGS:
+                    partial_aggs.setdefault(column, set()).add(name)
+                else:
+                    raise ValueError(f"Unsupported aggregation: {name}")
+        partial_aggs = {column: sorted(names) for column, names in partial_aggs.items()}
+
+        partials = []
+        for chunk in self.scan(group_by + [c for c in partial_aggs if c not in group_by], filters):
+            if group_by:
+                partial = chunk.groupby(group_by).agg(partial_aggs)
+            else:
+                partial = chunk.agg(partial_aggs).unstack().to_frame().T
+            partials.append(partial)
+
+        if partials:
+            combined = pd.concat(partials)
+            combine = {key: _PARTIAL_AGGS[key[1]] for key in combined.columns}
+            combined = combined.groupby(level=group_by).agg(combine) if group_by else combined.agg(combine).to_frame().T
+        else:
+            combined = None
+
+        result = {}
+        for column, names in aggs.items():
+            for name in names:
+                if combined is None:
+                    value = 0 if name in ("sum", "count", "size") else float("nan")
+                elif name == "mean":
+                    value = combined[(column, "sum")] / combined[(column, "count")]
+                else:
+                    value = combined[(column, name)]
+                result[f"{column}_{name}"] = value if group_by or combined is None else value.iloc[0]
+
+        if group_by:
+            return pd.DataFrame(result) if combined is not None else pd.DataFrame(columns=list(result))
+        return pd.Series(result)
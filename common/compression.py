@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import math
+import os
+import re
+from collections import Counter
+from typing import TYPE_CHECKING, Callable, List, Optional, Sequence
+
+import numpy as np
+import tiktoken
+
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+
+
+# Sentence ends (., ! or ? followed by space) and line breaks
+_SENTENCE_REGEX = re.compile(r"(?<=[.!?])\s+|\s*\n\s*")
+_WORD_REGEX = re.compile(r"\w+")
+# Joins spans that were not next to each other in the chunk
+SPAN_SEPARATOR = " ... "
+
+
+def compression_tokens_from_env() -> Optional[int]:
+    """Tokens kept of each chunk from COMPRESSION_TOKENS_PER_DOC; None (no compression) when it is
+    unset or 0. The apps and batch_qa all read the setting through this function."""
+    tokens = int(os.environ.get("COMPRESSION_TOKENS_PER_DOC") or 0)
+    return tokens if tokens > 0 else None
+
+
+def compression_embeddings_from_env() -> bool:
+    """True when COMPRESSION_EMBEDDINGS is set: sentences are scored by embedding similarity instead of BM25"""
+    return bool(os.environ.get("COMPRESSION_EMBEDDINGS"))
+
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence.strip() for sentence in _SENTENCE_REGEX.split(text) if sentence.strip()]
+
+
+def bm25_scores(query: str, sentences: Sequence[str], k1: float = 1.2, b: float = 0.75) -> List[float]:
+    """BM25 score of each sentence for the query, with the sentences themselves as the corpus,
+    so words that appear in most of the candidates (e.g. "the") weigh little"""
+    terms = set(_WORD_REGEX.findall(query.lower()))
+    tokenized = [_WORD_REGEX.findall(sentence.lower()) for sentence in sentences]
+    if not terms or not tokenized:
+        return [0.0] * len(sentences)
+    average_length = sum(len(words) for words in tokenized) / len(tokenized) or 1
+    document_frequency = Counter(word for words in tokenized for word in set(words) if word in terms)
+    idf = {term: math.log(1 + (len(tokenized) - count + 0.5) / (count + 0.5)) for term, count in document_frequency.items()}
+
+    scores = []
+    for words in tokenized:
+        frequencies = Counter(word for word in words if word in idf)
+        norm = k1 * (1 - b + b * len(words) / average_length)
+        scores.append(sum(idf[word] * count * (k1 + 1) / (count + norm) for word, count in frequencies.items()))
+    return scores
+
+
+def cosine_scores(query_vector: Sequence[float], sentence_vectors: Sequence[Sequence[float]]) -> List[float]:
+    vectors = np.asarray(sentence_vectors, dtype=np.float32)
+    query = np.asarray(query_vector, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+    return (vectors @ query / np.where(norms == 0, 1, norms)).tolist()
+
+
+def compress_docs(docs: List[Document], query: str, max_tokens_per_doc: int = 300,
+                  embed_query: Optional[Callable[[str], List[float]]] = None,
+                  embed_texts: Optional[Callable[[List[str]], List[List[float]]]] = None,
+                  encoding_name: str = "cl100k_base", verbose: bool = False) -> List[Document]:
+    """Keeps, in each Document, only the sentences most relevant to the query that fit in
+    `max_tokens_per_doc` tokens, in their original order and with the same metadata.
+
+    Sentences are scored with BM25 over all the candidate sentences, or by cosine similarity
+    when `embed_query` and `embed_texts` are given (they get every sentence of every Document,
+    so they should be cached). A Document with no sentence matching the query (e.g. in another
+    language than the query) keeps its first sentences, since the search ranked it relevant anyway.
+    """
+    from langchain.docstore.document import Document
+
+    encoding = tiktoken.get_encoding(encoding_name)
+    doc_sentences = [split_sentences(doc.page_content) for doc in docs]
+    sentences = [sentence for doc in doc_sentences for sentence in doc]
+    if not sentences:
+        return docs
+    if embed_query is not None and embed_texts is not None:
+        scores = cosine_scores(embed_query(query), embed_texts(sentences))
+    else:
+        scores = bm25_scores(query, sentences)
+
+    compressed_docs = []
+    original_tokens = compressed_tokens = 0
+    start = 0
+    for doc, doc_sentence_list in zip(docs, doc_sentences):
+        doc_scores = scores[start:start + len(doc_sentence_list)]
+        start += len(doc_sentence_list)
+        tokens = [len(encoding.encode(sentence)) for sentence in doc_sentence_list]
+        original_tokens += sum(tokens)
+        if sum(tokens) <= max_tokens_per_doc:
+            compressed_docs.append(doc)
+            compressed_tokens += sum(tokens)
+            continue
+
+        if any(score > 0 for score in doc_scores):
+            order = sorted(range(len(doc_sentence_list)), key=lambda i: doc_scores[i], reverse=True)
+        else:
+            order = range(len(doc_sentence_list))
+        kept, budget = [], max_tokens_per_doc
+        for i in order:
+            if tokens[i] <= budget:
+                kept.append(i)
+                budget -= tokens[i]
+        if not kept:
+            # A single sentence longer than the budget: keep its beginning
+            best = order[0]
+            kept_text = encoding.decode(encoding.encode(doc_sentence_list[best])[:max_tokens_per_doc])
+            compressed_tokens += max_tokens_per_doc
+        else:
+            kept.sort()
+            kept_text = doc_sentence_list[kept[0]]
+            for previous, i in zip(kept, kept[1:]):
+                kept_text += (" " if i == previous + 1 else SPAN_SEPARATOR) + doc_sentence_list[i]
+            compressed_tokens += max_tokens_per_doc - budget
+        compressed_docs.append(Document(page_content=kept_text, metadata=dict(doc.metadata)))
+
+    if verbose:
+        print("Compressed docs from", original_tokens, "to", compressed_tokens, "tokens")
+    return compressed_docs
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import hashlib
+import re
+from typing import TYPE_CHECKING, Hashable, List, Optional
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+
+
+_WORD_REGEX = re.compile(r"\w+")
+
+
+def simhash(text: str, ngram: int = 3) -> int:
+    """64-bit SimHash of the word n-grams of a text. Near-identical texts get fingerprints
+    that differ in only a few bits."""
+    words = _WORD_REGEX.findall(text.lower())
+    if not words:
+        return 0
+    if len(words) <= ngram:
+        shingles = [" ".join(words)]
+    else:
+        shingles = [" ".join(words[i:i + ngram]) for i in range(len(words) - ngram + 1)]
+
+    hashes = np.fromiter((int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+                          for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    # One row of 64 bits per shingle; a fingerprint bit is set when most shingles have it set
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    majority = bits.sum(axis=0) * 2 > len(shingles)
+    return int.from_bytes(np.packbits(majority, bitorder="little").tobytes(), "little")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class SimHashIndex:
+    """Finds fingerprints within `max_distance` bits of each other without comparing all pairs.
+
+    The 64 bits are split into max_distance + 1 bands; two fingerprints that differ in at
+    most max_distance bits must agree on at least one band, so only fingerprints sharing
+    a band are compared.
+    """
+
+    def __init__(self, max_distance: int = 3):
+        self.max_distance = max_distance
+        self.num_bands = max_distance + 1
+        self.band_bits = 64 // self.num_bands
+        self._bands = [dict() for _ in range(self.num_bands)]
+
+    def _band_values(self, fingerprint: int) -> List[int]:
+        mask = (1 << self.band_bits) - 1
+        return [(fingerprint >> (i * self.band_bits)) & mask for i in range(self.num_bands)]
+
+    def find(self, fingerprint: int) -> Optional[Hashable]:
+        """Returns the key of a stored near-duplicate of `fingerprint`, if any"""
+        for band, value in zip(self._bands, self._band_values(fingerprint)):
+            for other, key in band.get(value, ()):
+                if hamming_distance(fingerprint, other) <= self.max_distance:
+                    return key
+        return None
+
+    def add(self, fingerprint: int, key: Hashable) -> None:
+        for band, value in zip(self._bands, self._band_values(fingerprint)):
+            band.setdefault(value, []).append((fingerprint, key))
+
+    def add_if_new(self, fingerprint: int, key: Hashable) -> Optional[Hashable]:
+        """Adds the fingerprint unless it has a near-duplicate, whose key is returned instead"""
+        duplicate = self.find(fingerprint)
+        if duplicate is None:
+            self.add(fingerprint, key)
+        return duplicate
+
+
+def dedup_docs(docs: List[Document], max_distance: int = 8, verbose: bool = False) -> List[Document]:
+    """Drops Documents whose content is a near-duplicate of an earlier one, keeping the order.
+
+    Docs are expected best-first (as built from order_search_results), so the
+    highest-ranked copy is the one kept. For chunks of a few hundred words a couple of
+    edited words move the fingerprint by about 2-9 bits, while unrelated chunks are
+    20+ bits apart.
+    """
+    index = SimHashIndex(max_distance)
+    unique_docs = []
+    for i, doc in enumerate(docs):
+        if index.add_if_new(simhash(doc.page_content), i) is None:
+            unique_docs.append(doc)
+    if verbose and len(unique_docs) < len(docs):
+        print("Near-duplicate chunks removed:", len(docs) - len(unique_docs))
+    return unique_docs
@@ -0,0 +1,483 @@
+"""Push-mode ingestion into an Azure Search index.
+
+Walks a directory, parses .pdf/.docx/.txt files in a process pool and uploads one
+document per chunk, following the cogsrch-index-files schema, through the
+index-documents API in batched mergeOrUpload actions.
+
+    python ingest.py ./data/arxivcs --index cogsrch-index-files --base-url https://<account>.blob.core.windows.net/arxivcs
+
+The endpoint, key and API version default to AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_KEY
+and AZURE_SEARCH_API_VERSION; --endpoint can point at a local stand-in for testing.
+
+With --dedup-max-distance chunks that are near-duplicates (by SimHash) of a chunk
+already indexed in the run are not uploaded.
+
+With --manifest the run is incremental: unchanged files are skipped, only new or changed
+chunks are uploaded, and the chunks of changed or removed files that no longer exist
+are deleted from the index.
+
+With --vector-index the uploaded chunks are also embedded into a local, memory-mapped
+FAISS index (see vector_index.py) that DocSearchTool can fuse with the search results.
+Chunks already in the vector index are not embedded again; with --manifest the chunks of
+unchanged files are carried over, and unchanged files missing from it are parsed again.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import requests
+
+try:
+    from .utils import iter_file_docs
+    from .dedup import SimHashIndex, simhash
+    from .vector_index import LocalVectorIndexBuilder
+except ImportError:
+    from utils import iter_file_docs
+    from dedup import SimHashIndex, simhash
+    from vector_index import LocalVectorIndexBuilder
+
+
+SUPPORTED_EXTENSIONS = (".pdf", ".docx", ".txt")
+
+# Azure Search accepts at most 1000 actions and 16 MB per index request
+MAX_BATCH_ACTIONS = 1000
+MAX_BATCH_BYTES = 15 * 1024 * 1024
+
+# Per-document status codes worth retrying in a 207 response
+RETRIABLE_STATUS_CODES = {409, 422, 429, 500, 503}
+
+
+def walk_files(root: str, extensions: Tuple[str, ...] = SUPPORTED_EXTENSIONS) -> Iterator[str]:
+    """Yields the supported files under `root`, in a stable order"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(extensions):
+                yield os.path.join(dirpath, filename)
+
+
+def document_key(location: str, source: str) -> str:
+    """Index key of a chunk: URL-safe base64 of its location and page-chunk source"""
+    return base64.urlsafe_b64encode(f"{location}#{source}".encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def file_location(path: str, root: str, base_url: Optional[str] = None) -> str:
+    """metadata_storage_path of a file: `base_url` joined with its path relative to `root`"""
+    relative_path = os.path.relpath(path, root).replace(os.sep, "/")
+    if base_url:
+        return base_url.rstrip("/") + "/" + relative_path
+    return relative_path
+
+
+def parse_file_to_documents(path: str, root: str, base_url: Optional[str] = None, language: str = "en",
+                            chunk_size: int = 800, encoding_name: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Parses a file and returns its chunks as cogsrch-index-files documents"""
+    name = os.path.basename(path)
+    location = file_location(path, root, base_url)
+    documents = []
+    for doc in iter_file_docs(path, name, chunk_size=chunk_size, encoding_name=encoding_name):
+        documents.append({
+            "id": document_key(location, doc.metadata["source"]),
+            "title": os.path.splitext(name)[0],
+            "content": doc.page_content,
+            "pages": [doc.page_content],
+            "language": language,
+            "metadata_storage_name": name,
+            "metadata_storage_path": location,
+        })
+    return documents
+
+
+def _parse_task(args: tuple) -> Tuple[str, List[Dict[str, Any]], Optional[str]]:
+    path = args[0]
+    try:
+        return path, parse_file_to_documents(*args), None
+    except Exception as e:
+        return path, [], f"{type(e).__name__}: {e}"
+
+
+def drop_near_duplicates(documents: List[Dict[str, Any]], dedup: Optional[SimHashIndex]) -> List[Dict[str, Any]]:
+    """Removes the documents whose content is a near-duplicate of one already in `dedup`"""
+    if dedup is None:
+        return documents
+    return [document for document in documents
+            if dedup.add_if_new(simhash(document["content"]), document["id"]) is None]
+
+
+def iter_parsed_files(paths: Iterable[str], root: str, base_url: Optional[str] = None, language: str = "en",
+                      chunk_size: int = 800, encoding_name: Optional[str] = None,
+                      workers: Optional[int] = None) -> Iterator[Tuple[str, List[Dict[str, Any]], Optional[str]]]:
+    """Parses files in a process pool and yields (path, documents, error) as each file finishes"""
+    tasks = ((path, root, base_url, language, chunk_size, encoding_name) for path in paths)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from map(_parse_task, tasks)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for task in tasks:
+            pending.add(executor.submit(_parse_task, task))
+            # Keep a bounded number of files in flight so parsed documents don't pile up
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in pending:
+            yield future.result()
+
+
+class PushIndexer:
+    """Uploads index actions in batches, with concurrent in-flight batches and retries"""
+
+    def __init__(self, endpoint: str, index: str, api_key: str, api_version: str,
+                 batch_size: int = 500, concurrency: int = 4, max_retries: int = 5, backoff: float = 0.5,
+                 report_every: float = 5.0, verbose: bool = True):
+        self.url = f"{endpoint.rstrip('/')}/indexes/{index}/docs/index"
+        self.headers = {'Content-Type': 'application/json', 'api-key': api_key}
+        self.params = {'api-version': api_version}
+        self.batch_size = min(batch_size, MAX_BATCH_ACTIONS)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.report_every = report_every
+        self.verbose = verbose
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.stats = {"files": 0, "file_errors": 0, "succeeded": 0, "failed": 0, "retries": 0, "batches": 0, "bytes": 0}
+        self.failed_keys = []
+        self._started = None
+        self._last_report = 0.0
+
+    def _session(self) -> requests.Session:
+        # One connection pool per upload thread
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def count(self, **increments: int) -> None:
+        with self._lock:
+            for name, value in increments.items():
+                self.stats[name] += value
+
+    def upload_batch(self, actions: List[Dict[str, Any]]) -> List[str]:
+        """Sends one batch, retrying failed actions with backoff. Returns the keys that still failed."""
+        pending = actions
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.count(retries=len(pending))
+                time.sleep(min(2 ** attempt * self.backoff, 30))
+
+            body = json.dumps({"value": pending})
+            try:
+                resp = self._session().post(self.url, data=body, headers=self.headers, params=self.params, timeout=120)
+            except requests.RequestException as e:
+                if self.verbose:
+                    print("Upload error:", e, file=sys.stderr)
+                continue
+            self.count(bytes=len(body))
+
+            if resp.status_code in (429, 503) or resp.status_code >= 500:
+                continue
+            if resp.status_code not in (200, 207):
+                if self.verbose:
+                    print("Upload failed:", resp.status_code, resp.text[:500], file=sys.stderr)
+                break
+
+            by_key = {action["id"]: action for action in pending}
+            retry = []
+            for result in resp.json().get("value", []):
+                if result.get("status"):
+                    self.count(succeeded=1)
+                elif result.get("statusCode") in RETRIABLE_STATUS_CODES and result.get("key") in by_key:
+                    retry.append(by_key[result["key"]])
+                else:
+                    self.count(failed=1)
+                    with self._lock:
+                        self.failed_keys.append(result.get("key"))
+            pending = retry
+            if not pending:
+                return []
+
+        self.count(failed=len(pending))
+        failed = [action["id"] for action in pending]
+        with self._lock:
+            self.failed_keys.extend(failed)
+        return failed
+
+    def iter_batches(self, actions: Iterable[Dict[str, Any]]) -> Iterator[List[Dict[str, Any]]]:
+        """Groups actions into batches that fit the action count and request size limits"""
+        batch, batch_bytes = [], 0
+        for action in actions:
+            size = len(json.dumps(action))
+            if batch and (len(batch) >= self.batch_size or batch_bytes + size > MAX_BATCH_BYTES):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(action)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def run(self, actions: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+        """Uploads all actions with up to `concurrency` batches in flight and returns the stats"""
+        self._started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            in_flight = deque()
+            for batch in self.iter_batches(actions):
+                if len(in_flight) >= self.concurrency:
+                    in_flight.popleft().result()
+                in_flight.append(executor.submit(self.upload_batch, batch))
+                self.count(batches=1)
+                self.report()
+            for future in in_flight:
+                future.result()
+        self.report(final=True)
+        return self.summary()
+
+    def actions_from_files(self, parsed_files: Iterable[Tuple[str, List[Dict[str, Any]], Optional[str]]],
+                           action: str = "mergeOrUpload", dedup: Optional[SimHashIndex] = None) -> Iterator[Dict[str, Any]]:
+        """Turns parsed files into index actions, counting files and parse errors on the way"""
+        for path, documents, error in parsed_files:
+            self.count(files=1)
+            if error:
+                self.count(file_errors=1)
+                print("Could not parse", path, ":", error, file=sys.stderr)
+                continue
+            for document in drop_near_duplicates(documents, dedup):
+                yield {"@search.action": action, **document}
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self._started if self._started else 0.0
+        with self._lock:
+            summary = dict(self.stats)
+        summary["seconds"] = round(elapsed, 2)
+        summary["docs_per_second"] = round(summary["succeeded"] / elapsed, 1) if elapsed else 0.0
+        summary["mb_per_second"] = round(summary["bytes"] / elapsed / 1e6, 2) if elapsed else 0.0
+        return summary
+
+    def report(self, final: bool = False) -> None:
+        if not self.verbose:
+            return
+        now = time.perf_counter()
+        if not final and now - self._last_report < self.report_every:
+            return
+        self._last_report = now
+        s = self.summary()
+        print(("Done: " if final else "") +
+              f"{s['files']} files ({s['file_errors']} errors), {s['succeeded']} docs uploaded, "
+              f"{s['failed']} failed, {s['retries']} retried, {s['docs_per_second']} docs/s, "
+              f"{s['mb_per_second']} MB/s, {s['seconds']}s", file=sys.stderr)
+
+
+def file_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def document_hash(document: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(document, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class IngestManifest:
+    """Local record of what has been uploaded, used to make re-ingestion incremental.
+
+    For each file (keyed by its metadata_storage_path) it stores the size, mtime and
+    content hash of the file and the content hash of every uploaded chunk document by
+    document ID. `settings` fingerprints the parsing options; when they change every
+    file is treated as changed.
+    """
+
+    def __init__(self, path: str, settings: Optional[Dict[str, Any]] = None):
+        self.path = path
+        self.settings = settings or {}
+        self.files = dict()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("settings") == self.settings:
+                self.files = data.get("files", {})
+            else:
+                # Different chunking options: keep the uploaded IDs so they can be deleted,
+                # but force every file to be parsed again
+                self.files = {location: {"chunks": entry.get("chunks", {})} for location, entry in data.get("files", {}).items()}
+        self._pending = dict()
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "settings": self.settings, "files": self.files}, f)
+        os.replace(tmp_path, self.path)
+
+    def is_unchanged(self, path: str, location: str) -> bool:
+        """Checks size and mtime first and only hashes the file when they differ"""
+        entry = self.files.get(location)
+        if not entry or "hash" not in entry:
+            return False
+        stat = os.stat(path)
+        if entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+            return True
+        if entry.get("size") == stat.st_size and entry["hash"] == file_hash(path):
+            entry["mtime_ns"] = stat.st_mtime_ns
+            return True
+        return False
+
+    def plan(self, paths: Iterable[str], root: str, base_url: Optional[str] = None) -> Tuple[List[str], List[str]]:
+        """Returns the paths that need parsing and the locations of files that were removed"""
+        changed, seen = [], set()
+        for path in paths:
+            location = file_location(path, root, base_url)
+            seen.add(location)
+            if not self.is_unchanged(path, location):
+                changed.append(path)
+        removed = [location for location in self.files if location not in seen]
+        return changed, removed
+
+    def actions_for_file(self, path: str, location: str, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """mergeOrUpload actions for new or changed chunks and delete actions for chunks that are gone"""
+        old_chunks = self.files.get(location, {}).get("chunks", {})
+        new_chunks = {document["id"]: document_hash(document) for document in documents}
+        actions = [{"@search.action": "mergeOrUpload", **document} for document in documents
+                   if old_chunks.get(document["id"]) != new_chunks[document["id"]]]
+        actions += [{"@search.action": "delete", "id": key} for key in old_chunks if key not in new_chunks]
+
+        stat = os.stat(path)
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": file_hash(path), "chunks": new_chunks,
+                 "fingerprints": {document["id"]: simhash(document["content"]) for document in documents}}
+        self._pending[location] = (entry, [action["id"] for action in actions])
+        return actions
+
+    def actions_for_removed(self, location: str) -> List[Dict[str, Any]]:
+        actions = [{"@search.action": "delete", "id": key} for key in self.files.get(location, {}).get("chunks", {})]
+        self._pending[location] = (None, [action["id"] for action in actions])
+        return actions
+
+    def seed(self, dedup: SimHashIndex, skip_locations: Iterable[str] = ()) -> None:
+        """Adds the fingerprints of the recorded chunks (except those of `skip_locations`) to `dedup`"""
+        skip_locations = set(skip_locations)
+        for location, entry in self.files.items():
+            if location not in skip_locations:
+                for key, fingerprint in entry.get("fingerprints", {}).items():
+                    dedup.add(fingerprint, key)
+
+    def commit(self, failed_keys: Iterable[str]) -> None:
+        """Records the uploaded state of every file whose actions all succeeded"""
+        failed_keys = set(failed_keys)
+        for location, (entry, keys) in self._pending.items():
+            if failed_keys.intersection(keys):
+                continue
+            if entry is None:
+                self.files.pop(location, None)
+            else:
+                self.files[location] = entry
+        self._pending.clear()
+
+
+def incremental_actions(indexer: "PushIndexer", manifest: IngestManifest, removed: List[str],
+                        parsed_files: Iterable[Tuple[str, List[Dict[str, Any]], Optional[str]]],
+                        root: str, base_url: Optional[str] = None, dedup: Optional[SimHashIndex] = None,
+                        vector_index: Optional[LocalVectorIndexBuilder] = None) -> Iterator[Dict[str, Any]]:
+    """Index actions for an incremental run: deletes for removed files, then the diff of each changed file.
+    With `vector_index` every chunk of the parsed files is added to it, not only the uploaded ones."""
+    for location in removed:
+        yield from manifest.actions_for_removed(location)
+    for path, documents, error in parsed_files:
+        indexer.count(files=1)
+        if error:
+            indexer.count(file_errors=1)
+            print("Could not parse", path, ":", error, file=sys.stderr)
+            continue
+        documents = drop_near_duplicates(documents, dedup)
+        location = file_location(path, root, base_url)
+        if vector_index is not None:
+            vector_index.add_file(location, documents)
+        yield from manifest.actions_for_file(path, location, documents)
+
+
+def tee_to_vector_index(actions: Iterable[Dict[str, Any]], builder: LocalVectorIndexBuilder) -> Iterator[Dict[str, Any]]:
+    """Passes the actions through, adding the uploaded documents to the vector index builder"""
+    for action in actions:
+        if action["@search.action"] != "delete":
+            builder.add(action)
+        yield action
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Parse a directory of documents and push them to an Azure Search index")
+    parser.add_argument("directory", help="directory with .pdf, .docx and .txt files")
+    parser.add_argument("--index", default="cogsrch-index-files")
+    parser.add_argument("--endpoint", default=os.environ.get("AZURE_SEARCH_ENDPOINT"))
+    parser.add_argument("--api-key", default=os.environ.get("AZURE_SEARCH_KEY"))
+    parser.add_argument("--api-version", default=os.environ.get("AZURE_SEARCH_API_VERSION"))
+    parser.add_argument("--base-url", help="URL the files are served from (e.g. the blob container), used as metadata_storage_path")
+    parser.add_argument("--language", default="en")
+    parser.add_argument("--chunk-size", type=int, default=800)
+    parser.add_argument("--encoding-name", help="size chunks in tokens of this tiktoken encoding, e.g. cl100k_base")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=4, help="upload batches in flight")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--manifest", help="manifest file that makes re-runs incremental (created if missing)")
+    parser.add_argument("--dedup-max-distance", type=int, default=None,
+                        help="skip chunks whose SimHash differs in at most this many bits from an indexed chunk "
+                             "(3 for exact boilerplate, up to 8 for lightly edited copies; higher values index slower)")
+    parser.add_argument("--vector-index", help="directory to build a local vector index of the uploaded chunks in")
+    args = parser.parse_args(argv)
+
+    if not (args.endpoint and args.api_key and args.api_version):
+        parser.error("Set AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_KEY and AZURE_SEARCH_API_VERSION or pass --endpoint, --api-key and --api-version")
+    indexer = PushIndexer(args.endpoint, args.index, args.api_key, args.api_version,
+                          batch_size=args.batch_size, concurrency=args.concurrency, max_retries=args.max_retries)
+    paths, removed = list(walk_files(args.directory)), []
+    dedup = SimHashIndex(args.dedup_max_distance) if args.dedup_max_distance is not None else None
+    builder = LocalVectorIndexBuilder(args.vector_index) if args.vector_index else None
+    if args.manifest:
+        settings = {"index": args.index, "base_url": args.base_url, "language": args.language,
+                    "chunk_size": args.chunk_size, "encoding_name": args.encoding_name}
+        manifest = IngestManifest(args.manifest, settings)
+        all_paths = paths
+        paths, removed = manifest.plan(all_paths, args.directory, args.base_url)
+        if builder is not None:
+            # Unchanged files whose chunks are not in the vector index (e.g. it is new) are parsed
+            # again; their chunks are unchanged, so nothing is uploaded for them
+            indexed, changed = builder.previous.locations(), set(paths)
+            paths += [path for path in all_paths if path not in changed
+                      and file_location(path, args.directory, args.base_url) not in indexed]
+        if dedup is not None:
+            # Chunks of unchanged files are still in the index and count as already seen
+            manifest.seed(dedup, skip_locations=removed + [file_location(path, args.directory, args.base_url) for path in paths])
+        print(f"{len(paths)} new or changed files, {len(removed)} removed files", file=sys.stderr)
+
+    parsed_files = iter_parsed_files(paths, args.directory, base_url=args.base_url,
+                                     language=args.language, chunk_size=args.chunk_size,
+                                     encoding_name=args.encoding_name, workers=args.workers)
+    if args.manifest:
+        summary = indexer.run(incremental_actions(indexer, manifest, removed, parsed_files, args.directory, args.base_url,
+                                                  dedup, vector_index=builder))
+        manifest.commit(indexer.failed_keys)
+        manifest.save()
+        if builder is not None:
+            builder.keep_previous(skip_locations=removed)
+            builder.finalize()
+    elif builder is not None:
+        summary = indexer.run(tee_to_vector_index(indexer.actions_from_files(parsed_files, dedup=dedup), builder))
+        builder.finalize()
+    else:
+        summary = indexer.run(indexer.actions_from_files(parsed_files, dedup=dedup))
+    print(json.dumps(summary))
+    return 1 if summary["failed"] or summary["file_errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""Conversation memory whose prompt size does not grow with the length of the conversation.
+
+TokenBudgetMemory keeps the most recent messages verbatim as long as they fit in
+`max_token_limit` tokens and folds the older ones into a running summary. The token count of
+each message is computed once, when it is added, and the summary is written by the LLM in a
+background thread, so neither is on the critical path of a turn. Until the summary has caught
+up, the newest of the messages waiting to be folded into it are still returned verbatim, within
+another `max_token_limit` tokens. If the summary keeps failing, the oldest waiting messages are
+dropped beyond `max_pending_token_limit` tokens, so the memory does not grow without bound.
+"""
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional
+
+import tiktoken
+from pydantic import PrivateAttr
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.memory.summary import SummarizerMixin
+from langchain.schema import BaseMessage, get_buffer_string
+
+
+# Tokens that the chat format adds around the content of each message (role and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# The summaries of all the conversations are written in this pool
+_summary_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="memory-summary")
+
+
+def num_tokens_from_message(message: BaseMessage, encoding_name: str = "cl100k_base") -> int:
+    """Returns the number of prompt tokens a chat message takes"""
+    encoding = tiktoken.get_encoding(encoding_name)
+    return len(encoding.encode(message.content)) + MESSAGE_OVERHEAD_TOKENS
+
+
+class TokenBudgetMemory(BaseChatMemory, SummarizerMixin):
+    """Recent messages verbatim within a token budget, plus a summary of the older ones.
+
+    Works like ConversationBufferMemory (set return_messages=True for chat agents); `llm`
+    writes the summary, which is returned first as a `summary_message_cls` message.
+    """
+
+    memory_key: str = "history"
+    max_token_limit: int = 1000  # Tokens of the messages kept verbatim
+    max_pending_token_limit: Optional[int] = None  # Tokens waiting for the summary; 4 * max_token_limit if None
+
+    _token_counts: List[int] = PrivateAttr(default_factory=list)
+    _buffer_tokens: int = PrivateAttr(default=0)
+    _pending: List[BaseMessage] = PrivateAttr(default_factory=list)
+    _pending_counts: List[int] = PrivateAttr(default_factory=list)
+    _pending_tokens: int = PrivateAttr(default=0)
+    _dropped: int = PrivateAttr(default=0)  # Pending messages dropped so far, unsummarized
+    _summary: str = PrivateAttr(default="")
+    _summarizing: Optional[Future] = PrivateAttr(default=None)  # Set while a summary is being written
+    _generation: int = PrivateAttr(default=0)
+    _lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    @property
+    def summary(self) -> str:
+        return self._summary
+
+    @property
+    def buffer(self) -> Any:
+        return self.load_memory_variables({})[self.memory_key]
+
+    @property
+    def max_prompt_tokens(self) -> int:
+        """Most tokens load_memory_variables can return: the buffer and the pending messages
+        (max_token_limit each) plus the summary, as long as the summarizer's max_tokens (or
+        max_token_limit if it has none)"""
+        summary_tokens = getattr(self.llm, "max_tokens", None) or self.max_token_limit
+        return 2 * self.max_token_limit + summary_tokens + MESSAGE_OVERHEAD_TOKENS
+
+    @property
+    def buffer_tokens(self) -> int:
+        """Tokens of the messages kept verbatim, not counting the summary and pending messages"""
+        return self._buffer_tokens
+
+    def _count_new_messages(self) -> None:
+        messages = self.chat_memory.messages
+        # The history was cleared or replaced outside of this memory
+        if len(self._token_counts) > len(messages):
+            self._token_counts, self._buffer_tokens = [], 0
+        for message in messages[len(self._token_counts):]:
+            tokens = num_tokens_from_message(message)
+            self._token_counts.append(tokens)
+            self._buffer_tokens += tokens
+
+    def _prune(self) -> bool:
+        """Moves the oldest messages out of the buffer until it fits in the budget"""
+        self._count_new_messages()
+        messages = self.chat_memory.messages
+        pruned = False
+        while messages and self._buffer_tokens > self.max_token_limit:
+            tokens = self._token_counts.pop(0)
+            self._pending.append(messages.pop(0))
+            self._pending_counts.append(tokens)
+            self._pending_tokens += tokens
+            self._buffer_tokens -= tokens
+            pruned = True
+        self._cap_pending()
+        return pruned
+
+    def _cap_pending(self) -> None:
+        """Drops the oldest pending messages beyond max_pending_token_limit tokens"""
+        limit = self.max_pending_token_limit if self.max_pending_token_limit is not None else 4 * self.max_token_limit
+        dropped = 0
+        while len(self._pending) > 1 and self._pending_tokens > limit:
+            self._pending.pop(0)
+            self._pending_tokens -= self._pending_counts.pop(0)
+            dropped += 1
+        if dropped:
+            self._dropped += dropped
+            print(f"Dropped {dropped} messages that could not be summarized yet", file=sys.stderr)
+
+    def _summarize(self, generation: int) -> None:
+        # Loops until the messages pruned while the LLM was writing are folded in too
+        while True:
+            with self._lock:
+                if generation != self._generation:
+                    return
+                if not self._pending:
+                    self._summarizing = None
+                    return
+                messages, summary, dropped = list(self._pending), self._summary, self._dropped
+            try:
+                new_summary = self.predict_new_summary(messages, summary).strip()
+            except Exception as e:
+                # The messages stay verbatim and are summarized after the next turn
+                print("Could not summarize the conversation:", e, file=sys.stderr)
+                with self._lock:
+                    if generation == self._generation:
+                        self._summarizing = None
+                return
+            with self._lock:
+                if generation != self._generation:
+                    return
+                self._summary = new_summary
+                # Messages dropped meanwhile were the oldest, i.e. the first of `messages`
+                summarized = max(0, len(messages) - (self._dropped - dropped))
+                self._pending_tokens -= sum(self._pending_counts[:summarized])
+                del self._pending[:summarized]
+                del self._pending_counts[:summarized]
+
+    def _schedule_summary(self) -> None:
+        with self._lock:
+            if self._pending and self._summarizing is None:
+                self._summarizing = _summary_executor.submit(self._summarize, self._generation)
+
+    def wait_for_summary(self, timeout: Optional[float] = None) -> bool:
+        """Waits for the summary to catch up; returns False on timeout"""
+        future = self._summarizing
+        return future is None or bool(wait([future], timeout=timeout).done)
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            # The history may have been loaded from a store (e.g. CosmosDB) longer than the budget
+            if self._prune():
+                self._schedule_summary()
+            # If the summary falls behind, the oldest pending messages are left out of the prompt
+            pending, tokens = [], 0
+            for message, count in zip(reversed(self._pending), reversed(self._pending_counts)):
+                tokens += count
+                if tokens > self.max_token_limit:
+                    break
+                pending.insert(0, message)
+            buffer = pending + list(self.chat_memory.messages)
+            if self._summary:
+                buffer = [self.summary_message_cls(content=self._summary)] + buffer
+        if self.return_messages:
+            return {self.memory_key: buffer}
+        return {self.memory_key: get_buffer_string(buffer, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        with self._lock:
+            super().save_context(inputs, outputs)
+            if self._prune():
+                self._schedule_summary()
+
+    def clear(self) -> None:
+        with self._lock:
+            super().clear()
+            self._generation += 1
+            self._token_counts, self._buffer_tokens = [], 0
+            self._pending, self._pending_counts, self._summary = [], [], ""
+            self._pending_tokens = self._dropped = 0
+            self._summarizing = None
@@ -0,0 +1,418 @@
+"""In-process metrics exposed in the Prometheus text format.
+
+Counters, gauges and histograms are module-level objects updated with a lock held for a
+few dict operations; `render()` formats all of them (plus the hit/miss counts of the
+registered caches) for a /metrics endpoint.
+
+When the SHARED_METRICS_PATH environment variable names a SQLite file (gunicorn.conf.py sets
+it when the bot runs several workers), every process writes its samples there every
+FLUSH_INTERVAL seconds, when it renders and at exit, and `render()` and `total()` report the
+sum over the processes. Counters and histograms of processes that exited are kept; gauges
+only count the processes still running.
+"""
+import atexit
+import bisect
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+FLUSH_INTERVAL = 5.0
+
+_metrics = []
+_caches = dict()
+_registry_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def _escape_label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type_name = ""
+    live_only = False  # Only the processes still running count (gauges)
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _metrics.append(self)
+        _shared_samples()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _snapshot(self) -> Dict[Tuple[str, ...], Any]:
+        """Values of this process by label values"""
+        with self._lock:
+            return dict(self._values)
+
+    def _add(self, total: Any, value: Any) -> Any:
+        return value if total is None else total + value
+
+    def _merge(self, values_by_pid: Dict[int, Dict[Tuple[str, ...], Any]], live_pids: Set[int]) -> Dict[Tuple[str, ...], Any]:
+        merged = dict()
+        for pid, values in values_by_pid.items():
+            if self.live_only and pid not in live_pids:
+                continue
+            for key, value in values.items():
+                merged[key] = self._add(merged.get(key), value)
+        return merged
+
+    def _merged_values(self) -> Dict[Tuple[str, ...], Any]:
+        shared = _shared_samples()
+        if shared is None:
+            return self._snapshot()
+        flush()
+        values_by_pid = shared.read().get(self.name, {})
+        return self._merge(values_by_pid, _live_pids(values_by_pid))
+
+    def _samples(self, values: Dict[Tuple[str, ...], Any]) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in values.items()]
+
+    def render(self, values: Optional[Dict[Tuple[str, ...], Any]] = None) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        return "\n".join(lines + self._samples(self._snapshot() if values is None else values))
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def total(self, **labels: str) -> float:
+        """Value summed over the processes sharing SHARED_METRICS_PATH (this process only when it is unset)"""
+        return self._merged_values().get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Gauge set explicitly, or read from `function` at scrape time when one is given"""
+    type_name = "gauge"
+    live_only = True
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        if self.function is not None:
+            return self.function()
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def total(self, **labels: str) -> float:
+        """Value summed over the running processes sharing SHARED_METRICS_PATH (this process only when it is unset)"""
+        return self._merged_values().get(self._key(labels), 0)
+
+    def _snapshot(self) -> Dict[Tuple[str, ...], Any]:
+        if self.function is not None:
+            try:
+                return {(): self.function()}
+            except Exception:
+                return {}
+        return super()._snapshot()
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket (not cumulative), then +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def time(self, **labels: str) -> Callable:
+        """Decorator that observes the duration of every call"""
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def _snapshot(self) -> Dict[Tuple[str, ...], Any]:
+        with self._lock:
+            return {key: list(counts) for key, counts in self._values.items()}
+
+    def _add(self, total: Any, value: Any) -> Any:
+        return list(value) if total is None else [a + b for a, b in zip(total, value)]
+
+    def _samples(self, values: Dict[Tuple[str, ...], Any]) -> List[str]:
+        lines = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                le_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le_label)} {cumulative}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+
+def register_cache(name: str, cache) -> None:
+    """Exports the hits and misses of a cache with `hits`/`misses` attributes (e.g. TTLCache)"""
+    with _registry_lock:
+        _caches[name] = cache
+
+
+# Hits and misses of the caches when this process was forked, which its parent reports
+_cache_baselines = dict()
+
+
+def _cache_samples() -> Dict[str, Dict[Tuple[str, ...], Any]]:
+    """Hits, misses and entries of the registered caches in this process"""
+    with _registry_lock:
+        caches = list(_caches.items())
+    samples = {"cache_hits_total": {}, "cache_misses_total": {}, "cache_entries": {}}
+    for name, cache in caches:
+        hits, misses = _cache_baselines.get(name, (0, 0))
+        samples["cache_hits_total"][(name,)] = cache.hits - hits
+        samples["cache_misses_total"][(name,)] = cache.misses - misses
+        samples["cache_entries"][(name,)] = len(cache)
+    return samples
+
+
+def _render_caches(samples: Dict[str, Dict[Tuple[str, ...], Any]]) -> str:
+    lines = ["# HELP cache_hits_total Cache lookups that found an entry", "# TYPE cache_hits_total counter"]
+    lines += [f'cache_hits_total{_format_labels(["cache"], key)} {value}' for key, value in samples["cache_hits_total"].items()]
+    lines += ["# HELP cache_misses_total Cache lookups that found no entry", "# TYPE cache_misses_total counter"]
+    lines += [f'cache_misses_total{_format_labels(["cache"], key)} {value}' for key, value in samples["cache_misses_total"].items()]
+    lines += ["# HELP cache_entries Entries currently in the cache", "# TYPE cache_entries gauge"]
+    lines += [f'cache_entries{_format_labels(["cache"], key)} {value}' for key, value in samples["cache_entries"].items()]
+    return "\n".join(lines)
+
+
+def _merge_cache_samples(samples: Dict[str, Dict[int, Dict[Tuple[str, ...], Any]]]) -> Dict[str, Dict[Tuple[str, ...], Any]]:
+    """Sums the hits and misses of all the processes and the entries of the running ones. The
+    entries of a cache shared by the processes (SQLiteCache) are counted once."""
+    with _registry_lock:
+        shared_caches = {name for name, cache in _caches.items() if getattr(cache, "shared", False)}
+    merged = {"cache_hits_total": {}, "cache_misses_total": {}, "cache_entries": {}}
+    for metric in merged:
+        values_by_pid = samples.get(metric, {})
+        live_pids = _live_pids(values_by_pid)
+        for pid, values in values_by_pid.items():
+            for key, value in values.items():
+                if metric == "cache_entries":
+                    if pid not in live_pids:
+                        continue
+                    if key[0] in shared_caches:
+                        merged[metric][key] = max(merged[metric].get(key, 0), value)
+                        continue
+                merged[metric][key] = merged[metric].get(key, 0) + value
+    return merged
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format, summed over the processes
+    sharing SHARED_METRICS_PATH when it is set"""
+    with _registry_lock:
+        metrics = list(_metrics)
+    shared = _shared_samples()
+    if shared is None:
+        return "\n".join([metric.render() for metric in metrics] + [_render_caches(_cache_samples())]) + "\n"
+
+    flush()
+    samples = shared.read()
+    rendered = []
+    for metric in metrics:
+        values_by_pid = samples.get(metric.name, {})
+        rendered.append(metric.render(metric._merge(values_by_pid, _live_pids(values_by_pid))))
+    rendered.append(_render_caches(_merge_cache_samples(samples)))
+    return "\n".join(rendered) + "\n"
+
+
+class _SharedSamples:
+    """Latest samples of each process, in a SQLite file shared by the processes on a machine.
+    A flush replaces all the rows of the process in one transaction."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, opened again in forked processes
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS metric_samples (pid INTEGER, metric TEXT, labels TEXT, "
+                               "value TEXT, PRIMARY KEY (pid, metric, labels))")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def write(self, pid: int, samples: Dict[str, Dict[Tuple[str, ...], Any]]) -> None:
+        rows = [(pid, metric, json.dumps(key), json.dumps(value))
+                for metric, values in samples.items() for key, value in values.items()]
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM metric_samples WHERE pid = ?", (pid,))
+            connection.executemany("INSERT INTO metric_samples VALUES (?, ?, ?, ?)", rows)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def read(self) -> Dict[str, Dict[int, Dict[Tuple[str, ...], Any]]]:
+        """Values by metric name, process id and label values"""
+        samples = dict()
+        for pid, metric, labels, value in self._connection().execute("SELECT pid, metric, labels, value FROM metric_samples"):
+            samples.setdefault(metric, {}).setdefault(pid, {})[tuple(json.loads(labels))] = json.loads(value)
+        return samples
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def _shared_samples() -> Optional[_SharedSamples]:
+    """The store of SHARED_METRICS_PATH, None when it is unset. Starts the flusher of this process."""
+    global _shared
+    path = os.environ.get("SHARED_METRICS_PATH")
+    if not path:
+        return None
+    with _shared_lock:
+        if _shared is None or _shared.path != path:
+            _shared = _SharedSamples(path)
+            threading.Thread(target=_flush_periodically, args=(_shared,), name="metrics-flush", daemon=True).start()
+        return _shared
+
+
+def _flush_periodically(shared: _SharedSamples) -> None:
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        if _shared is not shared:
+            return
+        try:
+            flush()
+        except Exception:
+            logger.warning("Could not write the metrics to %s", shared.path, exc_info=True)
+
+
+def flush() -> None:
+    """Writes the samples of this process to SHARED_METRICS_PATH; does nothing when it is unset"""
+    shared = _shared_samples()
+    if shared is None:
+        return
+    with _registry_lock:
+        metrics = list(_metrics)
+    samples = _cache_samples()
+    for metric in metrics:
+        samples[metric.name] = metric._snapshot()
+    shared.write(os.getpid(), samples)
+
+
+def _live_pids(values_by_pid: Dict[int, Any]) -> Set[int]:
+    live = set()
+    for pid in values_by_pid:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            continue
+        except PermissionError:
+            pass
+        live.add(pid)
+    return live
+
+
+def _flush_at_exit() -> None:
+    if _shared is not None:
+        try:
+            flush()
+        except Exception:
+            logger.warning("Could not write the metrics to %s", _shared.path, exc_info=True)
+
+
+def _after_fork_in_child() -> None:
+    """A forked process (e.g. a worker of a process pool) starts from zero: its parent reports
+    the values it inherited. Its flusher thread did not survive the fork and is started again."""
+    global _shared, _shared_lock, _registry_lock
+    if _shared is None:
+        return
+    _shared, _shared_lock, _registry_lock = None, threading.Lock(), threading.Lock()
+    for metric in _metrics:
+        metric._lock = threading.Lock()
+        metric._values.clear()
+    for name, cache in _caches.items():
+        _cache_baselines[name] = (cache.hits, cache.misses)
+    _shared_samples()
+
+
+atexit.register(_flush_at_exit)
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class RetryLogCounter(logging.Handler):
+    """Counts the retry warnings that LangChain logs when an OpenAI call is throttled or fails
+    (its retry decorator logs "Retrying ..." before each sleep)"""
+
+    def __init__(self, counter: Counter):
+        super().__init__(level=logging.WARNING)
+        self.counter = counter
+
+    def emit(self, record: logging.LogRecord) -> None:
+        message = record.getMessage()
+        if message.startswith("Retrying"):
+            reason = "throttled" if "RateLimitError" in message else "error"
+            self.counter.inc(reason=reason)
+        # Attaching this handler stops Python from printing the warnings of the logger
+        # when logging is not configured, so keep them on stderr in that case
+        if not logging.getLogger().handlers and logging.lastResort is not None:
+            logging.lastResort.handle(record)
@@ -0,0 +1,97 @@
+"""Token cost of the prompt templates and selection of the variant that fits the budget.
+
+Every prompt family (e.g. "combine", the prompt that answers from the fetched documents) is
+registered as a list of variants, from the richest (long few-shot examples) to the most
+compact. The cost of a variant is the tokens of its template with the input variables left
+empty, computed once on first use. `select` returns the richest variant that still leaves room
+for the variable part of the prompt (documents, question, chat history).
+
+    python prompt_registry.py   # prints the token cost of every variant
+"""
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import tiktoken
+from langchain.prompts.base import BasePromptTemplate
+from langchain.prompts import PromptTemplate
+
+try:
+    from .prompts import (COMBINE_PROMPT, COMBINE_PROMPT_COMPACT, COMBINE_PROMPT_MINIMAL,
+                          COMBINE_CHAT_PROMPT, COMBINE_CHAT_PROMPT_COMPACT, COMBINE_CHAT_PROMPT_MINIMAL,
+                          CUSTOM_CHATBOT_PREFIX, CUSTOM_CHATBOT_PREFIX_COMPACT)
+except Exception as e:
+    print(e)
+    from prompts import (COMBINE_PROMPT, COMBINE_PROMPT_COMPACT, COMBINE_PROMPT_MINIMAL,
+                          COMBINE_CHAT_PROMPT, COMBINE_CHAT_PROMPT_COMPACT, COMBINE_CHAT_PROMPT_MINIMAL,
+                          CUSTOM_CHATBOT_PREFIX, CUSTOM_CHATBOT_PREFIX_COMPACT)
+
+
+class PromptRegistry:
+    """Named prompt families, each with variants ordered from the richest to the most compact"""
+
+    def __init__(self, encoding_name: str = "cl100k_base"):
+        self.encoding_name = encoding_name
+        self._families: Dict[str, "OrderedDict[str, BasePromptTemplate]"] = dict()
+        self._tokens: Dict[Tuple[str, str], int] = dict()
+        self._lock = threading.Lock()
+
+    def register(self, name: str, variants: List[Tuple[str, BasePromptTemplate]]) -> None:
+        """Registers (variant name, prompt) pairs, from the richest to the most compact"""
+        if not variants:
+            raise ValueError(f"Prompt {name} needs at least one variant")
+        with self._lock:
+            self._families[name] = OrderedDict(variants)
+            for key in [key for key in self._tokens if key[0] == name]:
+                del self._tokens[key]
+
+    def variants(self, name: str) -> List[str]:
+        return list(self._families[name])
+
+    def get(self, name: str, variant: str) -> BasePromptTemplate:
+        return self._families[name][variant]
+
+    def tokens(self, name: str, variant: str) -> int:
+        """Tokens of the variant with its input variables empty"""
+        key = (name, variant)
+        if key not in self._tokens:
+            prompt = self._families[name][variant]
+            text = prompt.format(**{variable: "" for variable in prompt.input_variables})
+            encoding = tiktoken.get_encoding(self.encoding_name)
+            with self._lock:
+                self._tokens[key] = len(encoding.encode(text))
+        return self._tokens[key]
+
+    def precompute(self) -> Dict[str, Dict[str, int]]:
+        """Computes the cost of every variant, e.g. at start up, and returns them by family"""
+        return {name: {variant: self.tokens(name, variant) for variant in variants}
+                for name, variants in list(self._families.items())}
+
+    def select(self, name: str, budget: int) -> Tuple[str, BasePromptTemplate]:
+        """Returns the richest variant costing at most `budget` tokens, or the most compact one
+        if none does"""
+        variants = self._families[name]
+        for variant, prompt in variants.items():
+            if self.tokens(name, variant) <= budget:
+                return variant, prompt
+        return next(reversed(variants.items()))
+
+
+PROMPTS = PromptRegistry()
+
+# Prompt that answers from the fetched documents (stuff chain, or reduce step of map_reduce)
+PROMPTS.register("combine", [("full", COMBINE_PROMPT),
+                             ("compact", COMBINE_PROMPT_COMPACT),
+                             ("minimal", COMBINE_PROMPT_MINIMAL)])
+PROMPTS.register("combine_chat", [("full", COMBINE_CHAT_PROMPT),
+                                  ("compact", COMBINE_CHAT_PROMPT_COMPACT),
+                                  ("minimal", COMBINE_CHAT_PROMPT_MINIMAL)])
+# System message of the bot's main agent
+PROMPTS.register("chatbot_prefix", [("full", PromptTemplate(template=CUSTOM_CHATBOT_PREFIX, input_variables=[])),
+                                    ("compact", PromptTemplate(template=CUSTOM_CHATBOT_PREFIX_COMPACT, input_variables=[]))])
+
+
+if __name__ == "__main__":
+    for name, costs in PROMPTS.precompute().items():
+        for variant, tokens in costs.items():
+            print(f"{name:<16}{variant:<10}{tokens:>6} tokens")
@@ -0,0 +1,595 @@
+"""LangChain tools of the bot and the Smart Agent notebook, and the LangChain-based helpers they use.
+
+utils re-exports everything here on first access (e.g. `from utils import DocSearchTool`), so
+importing utils alone does not load LangChain.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from langchain.docstore.document import Document
+from langchain.chat_models import AzureChatOpenAI
+from langchain.chains import LLMChain
+from langchain.agents import create_pandas_dataframe_agent
+from langchain.tools import BaseTool
+from pydantic import Field, PrivateAttr
+from sqlalchemy import MetaData
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import URL
+from langchain.sql_database import SQLDatabase
+from langchain.agents import AgentExecutor, initialize_agent, AgentType, ZeroShotAgent
+from langchain.tools.python.tool import PythonAstREPLTool
+from langchain.utilities import BingSearchAPIWrapper
+from langchain.agents import create_sql_agent
+from langchain.agents.agent_toolkits import SQLDatabaseToolkit
+from langchain.callbacks.base import BaseCallbackManager
+
+try:
+    from .prompts import (CSV_PROMPT_PREFIX, CSV_PROMPT_SUFFIX, MSSQL_AGENT_PREFIX, MSSQL_AGENT_FORMAT_INSTRUCTIONS,
+                          CHATGPT_PROMPT, BING_PROMPT_PREFIX, CSV_CHUNKED_AGENT_PREFIX, CSV_CHUNKED_AGENT_SUFFIX)
+    from .caching import SingleFlight, make_cache
+    from .chunked_csv import ChunkedCSVDataset
+    from .dedup import dedup_docs
+    from .compression import compress_docs, compression_tokens_from_env, compression_embeddings_from_env
+    from .vector_index import get_local_vector_index
+    from .tracing import traced
+    from .metrics import register_cache
+    from .utils import (get_search_results, order_search_results, get_extractive_answers, hybrid_search_results,
+                        search_docs_by_vector, embed_docs, search_docs, embed_query, embed_texts, get_answer,
+                        extractive_answer_th_from_env, extractive_reranker_th_from_env,
+                        model_tokens_limit, num_tokens_from_docs, load_csv_dataframe, get_sql_engine,
+                        get_sql_db_url, normalize_sql, is_read_only_sql, sql_identifiers, _csv_cache_key,
+                        LANGUAGE_CODES, TOOL_LATENCY, TOOL_ERRORS, EXTRACTIVE_ANSWERS)
+except ImportError:
+    from prompts import (CSV_PROMPT_PREFIX, CSV_PROMPT_SUFFIX, MSSQL_AGENT_PREFIX, MSSQL_AGENT_FORMAT_INSTRUCTIONS,
+                         CHATGPT_PROMPT, BING_PROMPT_PREFIX, CSV_CHUNKED_AGENT_PREFIX, CSV_CHUNKED_AGENT_SUFFIX)
+    from caching import SingleFlight, make_cache
+    from chunked_csv import ChunkedCSVDataset
+    from dedup import dedup_docs
+    from compression import compress_docs, compression_tokens_from_env, compression_embeddings_from_env
+    from vector_index import get_local_vector_index
+    from tracing import traced
+    from metrics import register_cache
+    from utils import (get_search_results, order_search_results, get_extractive_answers, hybrid_search_results,
+                       search_docs_by_vector, embed_docs, search_docs, embed_query, embed_texts, get_answer,
+                       extractive_answer_th_from_env, extractive_reranker_th_from_env,
+                       model_tokens_limit, num_tokens_from_docs, load_csv_dataframe, get_sql_engine,
+                       get_sql_db_url, normalize_sql, is_read_only_sql, sql_identifiers, _csv_cache_key,
+                       LANGUAGE_CODES, TOOL_LATENCY, TOOL_ERRORS, EXTRACTIVE_ANSWERS)
+
+
+def create_chunked_csv_agent(llm: AzureChatOpenAI, dataset: ChunkedCSVDataset,
+                             callback_manager: BaseCallbackManager = None, verbose: bool = False) -> AgentExecutor:
+    """Creates an agent that answers questions over a CSV file through streaming ChunkedCSVDataset passes"""
+    import pandas as pd
+
+    tools = [PythonAstREPLTool(locals={"ds": dataset, "pd": pd})]
+    prompt = ZeroShotAgent.create_prompt(tools, prefix=CSV_CHUNKED_AGENT_PREFIX, suffix=CSV_CHUNKED_AGENT_SUFFIX,
+                                         input_variables=["input", "agent_scratchpad", "ds_head"])
+    prompt = prompt.partial(ds_head=str(dataset.head().to_markdown()))
+    llm_chain = LLMChain(llm=llm, prompt=prompt, callback_manager=callback_manager)
+    agent = ZeroShotAgent(llm_chain=llm_chain, allowed_tools=[tool.name for tool in tools], callback_manager=callback_manager)
+    return AgentExecutor.from_agent_and_tools(agent=agent, tools=tools, callback_manager=callback_manager, verbose=verbose)
+
+
+# Reflected databases are process-wide, one per database URL
+_sql_databases = dict()
+_sql_databases_lock = threading.Lock()
+
+
+class CachedSQLDatabase(SQLDatabase):
+    """SQLDatabase that keeps its reflected schema and table info for `schema_ttl` seconds.
+
+    The base class reflects the whole schema on construction and runs the sample-row
+    queries on every `get_table_info` call. Here both are reused until the TTL expires
+    or `invalidate_schema()` is called, after which the schema is reflected again in place.
+
+    Results of read-only queries are kept in an LRU cache keyed by the normalized SQL text
+    (see `normalize_sql`). Results longer than `max_cached_result_chars` are not cached, and
+    `invalidate_tables()` drops every cached result that reads from the given tables.
+    Write statements run through `run` invalidate the tables they touch.
+    """
+
+    def __init__(self, engine: Engine, schema_ttl: int = 3600, query_cache_size: int = 256,
+                 max_cached_result_chars: int = 20000, **kwargs: Any):
+        kwargs.pop("metadata", None)
+        self._schema_ttl = schema_ttl
+        self._init_kwargs = kwargs
+        # Shared by the workers when SHARED_CACHE_PATH is set, so they are named after the database
+        url_hash = hashlib.sha1(str(engine.url).encode("utf-8")).hexdigest()[:12]
+        self._table_info_cache = make_cache(f"sql_table_info:{url_hash}", maxsize=128, ttl=schema_ttl)
+        self._query_cache = make_cache(f"sql_queries:{url_hash}", maxsize=query_cache_size)
+        self._max_cached_result_chars = max_cached_result_chars
+        self._schema_lock = threading.RLock()
+        self._reflected_at = None
+        self._stale = False
+        super().__init__(engine, **kwargs)
+        self._reflected_at = time.monotonic()
+
+    def refresh_schema(self) -> None:
+        """Reflects the database schema again and drops the cached table info"""
+        with self._schema_lock:
+            self._reflected_at = None
+            self._table_info_cache.clear()
+            SQLDatabase.__init__(self, self._engine, metadata=MetaData(), **self._init_kwargs)
+            self._reflected_at = time.monotonic()
+            self._stale = False
+
+    def invalidate_schema(self) -> None:
+        """Marks the cached schema as stale; it is reflected again on next use"""
+        with self._schema_lock:
+            self._stale = True
+            self._table_info_cache.clear()
+
+    def _ensure_fresh(self) -> None:
+        # _reflected_at is None while the base class constructor is running
+        if self._reflected_at is None:
+            return
+        if self._stale or time.monotonic() - self._reflected_at > self._schema_ttl:
+            self.refresh_schema()
+
+    def get_usable_table_names(self) -> Iterable[str]:
+        self._ensure_fresh()
+        return super().get_usable_table_names()
+
+    def get_table_info(self, table_names: Optional[List[str]] = None) -> str:
+        self._ensure_fresh()
+        key = tuple(sorted(table_names)) if table_names is not None else None
+        return self._table_info_cache.get_or_set(key, lambda: super(CachedSQLDatabase, self).get_table_info(table_names))
+
+    def _tables_in(self, normalized_command: str) -> frozenset:
+        tables = {table.lower() for table in self._all_tables}
+        return frozenset(sql_identifiers(normalized_command) & tables)
+
+    def run(self, command: str, fetch: str = "all") -> str:
+        normalized_command = normalize_sql(command)
+        tables = self._tables_in(normalized_command)
+
+        if not is_read_only_sql(normalized_command):
+            result = super().run(command, fetch)
+            self.invalidate_tables(tables)
+            return result
+
+        key = (normalized_command, fetch, tables)
+        result = self._query_cache.get(key)
+        if result is None:
+            result = super().run(command, fetch)
+            if len(result) <= self._max_cached_result_chars:
+                self._query_cache.set(key, result)
+        return result
+
+    def invalidate_tables(self, tables: Iterable[str]) -> int:
+        """Drops the cached query results that read from any of `tables`"""
+        tables = {table.lower() for table in tables}
+        return self._query_cache.invalidate(lambda key: not tables.isdisjoint(key[2]))
+
+    def clear_query_cache(self) -> None:
+        self._query_cache.clear()
+
+
+def get_sql_database(db_url: Union[str, URL], schema_ttl: int = 3600, query_cache_size: int = 256,
+                     **engine_kwargs: Any) -> CachedSQLDatabase:
+    """Returns the process-wide CachedSQLDatabase for the given URL, reflecting it on first use"""
+    engine = get_sql_engine(db_url, **engine_kwargs)
+    key = str(engine.url)
+    with _sql_databases_lock:
+        if key not in _sql_databases:
+            _sql_databases[key] = CachedSQLDatabase(engine, schema_ttl=schema_ttl, query_cache_size=query_cache_size)
+            register_cache("sql_queries", _sql_databases[key]._query_cache)
+            register_cache("sql_table_info", _sql_databases[key]._table_info_cache)
+        return _sql_databases[key]
+
+
+######## TOOL CLASSES #####################################
+###########################################################
+    
+class DocSearchTool(BaseTool):
+    """Tool for Azure GPT Smart Search Engine"""
+    
+    name = "@docsearch"
+    description = "useful when the questions includes the term: @docsearch.\n"
+
+    llm: AzureChatOpenAI
+    indexes: List[str]
+    k: int = 10
+    response_language: str = "English"
+    reranker_th: int = 1
+    chunks_limit:int = 100
+    similarity_k: int = 4
+    dedup_max_distance: Optional[int] = 8  # SimHash bits two chunks may differ in to count as duplicates, None to keep all
+    # Built by ingest.py --vector-index
+    vector_index_path: Optional[str] = Field(default_factory=lambda: os.environ.get("LOCAL_VECTOR_INDEX_PATH"))
+    vector_k: int = 10
+    # Answer with the extractive answer of Azure Search, without calling the LLM, when it scores at
+    # least this much (0-1), its document at least extractive_reranker_th (0-4) and the document is
+    # in response_language (answers are not translated). None to always use the LLM
+    extractive_answer_th: Optional[float] = Field(default_factory=extractive_answer_th_from_env)
+    extractive_reranker_th: float = Field(default_factory=extractive_reranker_th_from_env)
+    # Tokens kept of each chunk: its sentences most relevant to the question (see compression.py). None to keep whole chunks
+    compression_tokens: Optional[int] = Field(default_factory=compression_tokens_from_env)
+    compression_embeddings: bool = Field(default_factory=compression_embeddings_from_env)  # score sentences by embeddings instead of BM25
+
+    
+    @traced("DocSearchTool")
+    @TOOL_LATENCY.time(tool="DocSearchTool")
+    def _run(self, query: str) -> str:
+
+        try:
+            agg_search_results = get_search_results(query, self.indexes, self.k)
+
+            language = LANGUAGE_CODES.get(self.response_language)
+            if self.extractive_answer_th is not None and language is not None:
+                answers = get_extractive_answers(agg_search_results, min_score=self.extractive_answer_th,
+                                                 min_reranker_score=self.extractive_reranker_th, language=language)
+                EXTRACTIVE_ANSWERS.inc(source="DocSearchTool", outcome="hit" if answers else "miss")
+                if answers:
+                    if self.verbose:
+                        print("Extractive answer with score", answers[0]["score"])
+                    url = answers[0]["location"] + os.environ["DATASOURCE_SAS_TOKEN"]
+                    return answers[0]["text"] + '<br><u>Sources</u>: <sup><a href="' + url + '">[1]</a></sup>'
+
+            vector_index = get_local_vector_index(self.vector_index_path) if self.vector_index_path else None
+            if vector_index is not None:
+                ordered_results = hybrid_search_results(query, self.indexes, self.k, self.reranker_th,
+                                                        vector_index, vector_k=self.vector_k,
+                                                        agg_search_results=agg_search_results)
+            else:
+                ordered_results = order_search_results(agg_search_results, reranker_threshold=self.reranker_th)
+            docs = []
+            for key,value in ordered_results.items():
+                for page in value["chunks"]:
+                    docs.append(Document(page_content=page, metadata={"source": value["location"]}))
+
+            if self.dedup_max_distance is not None:
+                docs = dedup_docs(docs, max_distance=self.dedup_max_distance, verbose=self.verbose)
+
+            if self.compression_tokens is not None:
+                docs = compress_docs(docs, query, max_tokens_per_doc=self.compression_tokens,
+                                     embed_query=embed_query if self.compression_embeddings else None,
+                                     embed_texts=embed_texts if self.compression_embeddings else None,
+                                     verbose=self.verbose)
+
+            # Calculate number of tokens of our docs
+            tokens_limit = model_tokens_limit(self.llm.deployment_name)
+
+            if(len(docs)>0):
+                num_tokens = num_tokens_from_docs(docs)
+                if self.verbose:
+                    print("Custom token limit for", self.llm.deployment_name, ":", tokens_limit)
+                    print("Combined docs tokens count:",num_tokens)
+
+            else:
+                return "No Results Found in my knowledge base"
+
+            if num_tokens > tokens_limit:
+                # Chunks in the local vector index are already embedded; only embed them here if some are not
+                top_docs = search_docs_by_vector(vector_index, query, docs, k=self.similarity_k) if vector_index is not None else None
+                if top_docs is None:
+                    index = embed_docs(docs, chunks_limit = self.chunks_limit, verbose=self.verbose)
+                    top_docs = search_docs(index, query, k = self.similarity_k)
+
+                # Now we need to recalculate the tokens count of the top results from similarity vector search
+                # in order to select the chain type: stuff or map_reduce
+
+                num_tokens = num_tokens_from_docs(top_docs)
+                if self.verbose:
+                    print("Token count after similarity search:", num_tokens)
+                chain_type = "map_reduce" if num_tokens > tokens_limit else "stuff"
+
+            else:
+                # if total tokens is less than our limit, we don't need to vectorize and do similarity search
+                top_docs = docs
+                chain_type = "stuff"
+
+            if self.verbose:
+                print("Chain Type selected:", chain_type)
+
+            response = get_answer(llm=self.llm, query=query, docs=top_docs, chain_type=chain_type, language=self.response_language)
+            
+            answer = response['output_text']
+            
+            try:
+                split_regex = re.compile(f"sources?:?\\W*", re.IGNORECASE)
+                answer_text = split_regex.split(answer)[0]
+                sources_list = split_regex.split(answer)[1].replace(" ","").split(",")
+
+                sources_html = '<br><u>Sources</u>: '
+                for index, value in enumerate(sources_list):
+                    url = value + os.environ["DATASOURCE_SAS_TOKEN"]
+                    sources_html +='<sup><a href="'+ url + '">[' + str(index+1) + ']</a></sup>'
+                    
+                answer = answer_text + sources_html
+
+            except Exception as e:
+                print(e)
+                
+            return answer
+
+        
+        except Exception as e:
+            TOOL_ERRORS.inc(tool="DocSearchTool")
+            print(e)
+    
+    async def _arun(self, query: str) -> str:
+        """Use the tool asynchronously."""
+        raise NotImplementedError("DocSearchTool does not support async")
+    
+
+class CSVTabularTool(BaseTool):
+    """Tool CSV agent"""
+    
+    name = "@csvfile"
+    description = "useful when the questions includes the term: @csvfile.\n"
+
+    path: str
+    llm: AzureChatOpenAI
+    columnar_format: Optional[str] = None  # "parquet" or "feather" to keep a memory-mapped copy next to the CSV
+    pandas_kwargs: Optional[dict] = None
+    chunked: bool = False  # Stream the file in chunks instead of loading it, for CSVs larger than memory
+    chunksize: int = 100000
+
+    _dataset: Optional[ChunkedCSVDataset] = PrivateAttr(default=None)
+    _dataset_key: Optional[tuple] = PrivateAttr(default=None)
+    _dataset_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def get_dataset(self) -> ChunkedCSVDataset:
+        """Opens the chunked dataset once per version of the CSV file"""
+        key = _csv_cache_key(self.path, None, self.pandas_kwargs)
+        with self._dataset_lock:
+            if self._dataset is None or self._dataset_key != key:
+                self._dataset = ChunkedCSVDataset(self.path, chunksize=self.chunksize, pandas_kwargs=self.pandas_kwargs)
+                self._dataset_key = key
+            return self._dataset
+
+    def get_agent_executor(self) -> AgentExecutor:
+        """Builds the agent of one run. Only the parsed DataFrame (or the chunked dataset) is
+        cached: the agent's Python REPL keeps the variables a run defines, so every run gets
+        fresh locals and its own copy of the DataFrame, which it may modify"""
+        if self.chunked:
+            return create_chunked_csv_agent(self.llm, self.get_dataset(), verbose=self.verbose, callback_manager=self.callbacks,)
+        df = load_csv_dataframe(self.path, columnar_format=self.columnar_format, pandas_kwargs=self.pandas_kwargs)
+        return create_pandas_dataframe_agent(self.llm, df.copy(), verbose=self.verbose, callback_manager=self.callbacks,)
+    
+    @traced("CSVTabularTool")
+    @TOOL_LATENCY.time(tool="CSVTabularTool")
+    def _run(self, query: str) -> str:
+        
+        try:
+            agent = self.get_agent_executor()
+            for i in range(5):
+                try:
+                    response = agent.run(CSV_PROMPT_PREFIX + query + CSV_PROMPT_SUFFIX) 
+                    break
+                except:
+                    TOOL_ERRORS.inc(tool="CSVTabularTool")
+                    response = "Error too many failed retries"
+                    continue
+
+            return response
+        except Exception as e:
+            TOOL_ERRORS.inc(tool="CSVTabularTool")
+            print(e)
+            response = e
+            return response
+    
+    async def _arun(self, query: str) -> str:
+        """Use the tool asynchronously."""
+        raise NotImplementedError("CSVTabularTool does not support async")
+        
+        
+class SQLDbTool(BaseTool):
+    """Tool SQLDB Agent"""
+    
+    name = "@covidstats"
+    description = "useful when the questions includes the term: @covidstats.\n"
+
+    llm: AzureChatOpenAI
+    db_url: Optional[str] = None  # Defaults to the Azure SQL database in the environment, e.g. "sqlite:///covid.db" for local runs
+    pool_size: int = 5
+    max_overflow: int = 10
+    schema_ttl: int = 3600
+    query_cache_size: int = 256
+
+    _agent_executor: Optional[AgentExecutor] = PrivateAttr(default=None)
+    _agent_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def db(self) -> CachedSQLDatabase:
+        return get_sql_database(self.db_url or get_sql_db_url(), schema_ttl=self.schema_ttl,
+                                query_cache_size=self.query_cache_size, pool_size=self.pool_size, max_overflow=self.max_overflow)
+
+    def get_agent_executor(self) -> AgentExecutor:
+        """Builds the SQL agent on first use and reuses it afterwards"""
+        with self._agent_lock:
+            if self._agent_executor is None:
+                toolkit = SQLDatabaseToolkit(db=self.db, llm=self.llm)
+                self._agent_executor = create_sql_agent(
+                    prefix=MSSQL_AGENT_PREFIX,
+                    format_instructions = MSSQL_AGENT_FORMAT_INSTRUCTIONS,
+                    llm=self.llm,
+                    toolkit=toolkit,
+                    callback_manager=self.callbacks,
+                    verbose=self.verbose
+                )
+            return self._agent_executor
+    
+    @traced("SQLDbTool")
+    @TOOL_LATENCY.time(tool="SQLDbTool")
+    def _run(self, query: str) -> str:
+        agent_executor = self.get_agent_executor()
+
+        for i in range(2):
+            try:
+                response = agent_executor.run(query) 
+                break
+            except Exception as e:
+                TOOL_ERRORS.inc(tool="SQLDbTool")
+                response = str(e)
+                continue
+
+        return response
+        
+    
+    async def _arun(self, query: str) -> str:
+        """Use the tool asynchronously."""
+        raise NotImplementedError("SQLDbTool does not support async")
+        
+        
+        
+class ChatGPTTool(BaseTool):
+    """Tool for a ChatGPT clone"""
+    
+    name = "@chatgpt"
+    description = "useful when the questions includes the term: @chatgpt.\n"
+
+    llm: AzureChatOpenAI
+    
+    @traced("ChatGPTTool")
+    @TOOL_LATENCY.time(tool="ChatGPTTool")
+    def _run(self, query: str) -> str:
+        try:
+            chatgpt_chain = LLMChain(
+                llm=self.llm, 
+                prompt=CHATGPT_PROMPT,
+                callback_manager=self.callbacks,
+                verbose=self.verbose
+            )
+
+            response = chatgpt_chain.run(query)
+
+            return response
+        except Exception as e:
+            TOOL_ERRORS.inc(tool="ChatGPTTool")
+            print(e)
+            
+    async def _arun(self, query: str) -> str:
+        """Use the tool asynchronously."""
+        raise NotImplementedError("ChatGPTTool does not support async")
+        
+
+# class BingSearchTool(BaseTool):
+#     """Tool for a Bing Search Wrapper"""
+    
+#     name = "@bing"
+#     description = "useful when the questions includes the term: @bing.\n"
+
+#     llm: AzureChatOpenAI
+#     k: int = 5
+    
+#     def _run(self, query: str) -> str:
+#         try:
+#             bing = BingSearchAPIWrapper(k=self.k)
+#             context = str(bing.results(query,num_results=self.k))
+#             chatgpt_chain = LLMChain(
+#                 llm=self.llm, 
+#                 prompt=PromptTemplate(input_variables=["context","question"],template='Only using the following pieces of texts with its corresponding titles and links: \n "{context}".\n Answer this question: {question}.\n\n If the answer to the question is not in the above pieces of texts, say "The answer is not in the context provided". Do not make up an answer. If you can provide the answer based on the pieces of texts, please also provide the link along with the answer. Nothing else.'),
+#                 callback_manager=self.callbacks,
+#                 verbose=self.verbose
+#             )
+
+#             response = chatgpt_chain({"question": query, "context": context})['text']
+
+#             return response
+        
+#         except Exception as e:
+#             print(e)
+            
+#     async def _arun(self, query: str) -> str:
+#         """Use the tool asynchronously."""
+#         raise NotImplementedError("ChatGPTTool does not support async")
+    
+    
+# Bing results are shared by all tool instances in the process (and by the workers, see make_cache)
+_bing_cache = make_cache("bing", maxsize=512, ttl=300)
+_bing_flight = SingleFlight()
+register_cache("bing", _bing_cache)
+
+
+class BingSearchResults(BaseTool):
+    """Tool for a Bing Search Wrapper"""
+
+    name = "@bing"
+    description = "useful when the questions includes the term: @bing.\n"
+
+    k: int = 5
+    cache_ttl: int = 300  # Seconds a result is reused for; news results go stale quickly
+
+    _bing: Optional[BingSearchAPIWrapper] = PrivateAttr(default=None)
+
+    def _search(self, query: str) -> List[dict]:
+        if self._bing is None:
+            self._bing = BingSearchAPIWrapper(k=self.k)
+        return self._bing.results(query,num_results=self.k)
+
+    def _run(self, query: str) -> str:
+        key = (" ".join(query.lower().split()), self.k)
+        results = _bing_cache.get(key)
+        if results is None:
+            # Concurrent identical queries share one in-flight Bing call
+            def search():
+                cached = _bing_cache.get(key)
+                if cached is None:
+                    cached = self._search(query)
+                    _bing_cache.set(key, cached, ttl=self.cache_ttl)
+                return cached
+            results = _bing_flight.do(key, search)
+        return results
+    
+    async def _arun(self, query: str) -> str:
+        """Use the tool asynchronously."""
+        raise NotImplementedError("BingSearchResults does not support async")
+            
+
+class BingSearchTool(BaseTool):
+    """Tool for a Bing Search Wrapper"""
+    
+    name = "@bing"
+    description = "useful when the questions includes the term: @bing.\n"
+    
+    llm: AzureChatOpenAI
+    k: int = 5
+
+    _agent_executor: Optional[AgentExecutor] = PrivateAttr(default=None)
+    _agent_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def get_agent_executor(self) -> AgentExecutor:
+        """Builds the ReAct agent on first use and reuses it afterwards"""
+        with self._agent_lock:
+            if self._agent_executor is None:
+                tools = [BingSearchResults(k=self.k)]
+                self._agent_executor = initialize_agent(tools=tools, 
+                                                        llm=self.llm, 
+                                                        agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, 
+                                                        agent_kwargs={'prefix':BING_PROMPT_PREFIX},
+                                                        callback_manager=self.callbacks,
+                                                        verbose=self.verbose)
+            return self._agent_executor
+    
+    @traced("BingSearchTool")
+    @TOOL_LATENCY.time(tool="BingSearchTool")
+    def _run(self, tool_input: Union[str, Dict],) -> str:
+        try:
+            parsed_input = self._parse_input(tool_input)
+            agent_executor = self.get_agent_executor()
+            
+            for i in range(3):
+                try:
+                    response = agent_executor.run(parsed_input) 
+                    break
+                except Exception as e:
+                    TOOL_ERRORS.inc(tool="BingSearchTool")
+                    response = str(e)
+                    continue
+
+            return response
+        
+        except Exception as e:
+            TOOL_ERRORS.inc(tool="BingSearchTool")
+            print(e)
+    
+    async def _arun(self, query: str) -> str:
+        """Use the tool asynchronously."""
+        raise NotImplementedError("BingSearchTool does not support async")
\ No newline at end of file
@@ -0,0 +1,173 @@
+"""Lightweight request tracing.
+
+A trace groups the spans of one request (e.g. one bot message, keyed by its conversation id).
+Spans nest through context variables, so the functions of the answer pipeline only need to be
+wrapped with `span()` or `@traced`, and LLM calls are recorded by TracingCallbackHandler.
+
+Finished spans are passed to the exporters as dicts that follow the OpenTelemetry span
+fields (traceId, spanId, parentSpanId, name, startTimeUnixNano, endTimeUnixNano, attributes,
+status). Set TRACING_EXPORT=stderr or TRACING_EXPORT=<file path> to write them as JSON lines,
+or register an exporter with `add_span_exporter`. Without exporters spans are not recorded.
+"""
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+
+_current_trace_id = contextvars.ContextVar("trace_id", default=None)
+_current_span = contextvars.ContextVar("span", default=None)
+
+_exporters: List[Callable[[Dict[str, Any]], None]] = []
+
+
+def _new_id(num_bytes: int) -> str:
+    return uuid.uuid4().hex[:num_bytes * 2]
+
+
+class Span:
+    """A timed operation within a trace"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None,
+                 attributes: Optional[Dict[str, Any]] = None, start_time_ns: Optional[int] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_time_ns = start_time_ns or time.time_ns()
+        self.end_time_ns = None
+        self.error = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def end(self, error: Optional[BaseException] = None, end_time_ns: Optional[int] = None) -> None:
+        self.end_time_ns = end_time_ns or time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        export_span(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start_time_ns,
+            "endTimeUnixNano": self.end_time_ns,
+            "durationMs": round((self.end_time_ns - self.start_time_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "status": {"code": "ERROR", "message": self.error} if self.error else {"code": "OK"},
+        }
+
+
+class _NoopSpan:
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class JsonLinesExporter:
+    """Writes each finished span as one JSON line to a stream or file"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def __call__(self, span: Dict[str, Any]) -> None:
+        line = json.dumps(span, default=str) + "\n"
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+def add_span_exporter(exporter: Callable[[Dict[str, Any]], None]) -> None:
+    _exporters.append(exporter)
+
+
+def tracing_enabled() -> bool:
+    return bool(_exporters)
+
+
+def export_span(span: Span) -> None:
+    record = span.to_dict()
+    for exporter in _exporters:
+        try:
+            exporter(record)
+        except Exception as e:
+            print("Could not export span:", e, file=sys.stderr)
+
+
+def current_trace_id() -> Optional[str]:
+    return _current_trace_id.get()
+
+
+@contextmanager
+def trace(trace_id: Optional[str] = None) -> Iterator[str]:
+    """Makes the spans started inside the block part of the trace `trace_id` (a new id if None)"""
+    trace_id = trace_id or _new_id(16)
+    trace_token = _current_trace_id.set(trace_id)
+    span_token = _current_span.set(None)
+    try:
+        yield trace_id
+    finally:
+        _current_span.reset(span_token)
+        _current_trace_id.reset(trace_token)
+
+
+def start_span(name: str, attributes: Optional[Dict[str, Any]] = None,
+               start_time_ns: Optional[int] = None) -> Optional[Span]:
+    """Starts a span under the current one without making it current; the caller must end() it.
+    Returns None when tracing is disabled."""
+    if not _exporters:
+        return None
+    parent = _current_span.get()
+    trace_id = _current_trace_id.get() or (parent.trace_id if parent else _new_id(16))
+    return Span(name, trace_id, parent.span_id if parent else None, attributes, start_time_ns)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Any]:
+    """Records the block as a span, nested under the current span"""
+    current = start_span(name, attributes)
+    if current is None:
+        yield _NOOP_SPAN
+        return
+    token = _current_span.set(current)
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end(error)
+
+
+def traced(name: str) -> Callable:
+    """Decorator that records every call of the function as a span called `name`"""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _exporters:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if os.environ.get("TRACING_EXPORT") == "stderr":
+    add_span_exporter(JsonLinesExporter(sys.stderr))
+elif os.environ.get("TRACING_EXPORT"):
+    add_span_exporter(JsonLinesExporter(open(os.environ["TRACING_EXPORT"], "a", encoding="utf-8")))
@@ -1,79 +1,149 @@
+from __future__ import annotations
+
 import re
 from io import BytesIO
-from typing import Any, Dict, List, Optional, Awaitable, Callable, Tuple, Type, Union
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional, Awaitable, Callable, Tuple, Type, Union
 import requests
 import os
-from collections import OrderedDict
+import logging
+import time
+import threading
+import itertools
+import bisect
+import codecs
+import hashlib
+import json
+import queue
+import zipfile
+from xml.etree import ElementTree
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-import docx2txt
 import tiktoken
 
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.docstore.document import Document
-from langchain.llms import AzureOpenAI
-from langchain.chat_models import AzureChatOpenAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.schema import BaseOutputParser, OutputParserException
-from langchain.vectorstores import VectorStore
-from langchain.vectorstores.faiss import FAISS
-from langchain.chains import LLMChain
-from langchain.memory import ConversationBufferMemory
-from langchain.agents import create_csv_agent
-from langchain.chains.question_answering import load_qa_chain
-from langchain.chains.qa_with_sources import load_qa_with_sources_chain
-from langchain.chains import ConversationalRetrievalChain
-from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
-from langchain.tools import BaseTool
-from langchain.prompts import PromptTemplate
-from openai.error import AuthenticationError
-from langchain.docstore.document import Document
-from pypdf import PdfReader
-from sqlalchemy.engine.url import URL
-from langchain.sql_database import SQLDatabase
-from langchain import SQLDatabaseChain
-from langchain.agents import AgentExecutor, initialize_agent, AgentType
-from langchain.tools import BaseTool
-from langchain.utilities import BingSearchAPIWrapper
-from langchain.agents import create_sql_agent
-from langchain.agents.agent_toolkits import SQLDatabaseToolkit
-from langchain.callbacks.base import BaseCallbackManager
-
 try:
-    from .prompts import (COMBINE_QUESTION_PROMPT, COMBINE_PROMPT, COMBINE_CHAT_PROMPT,
-                          CSV_PROMPT_PREFIX, CSV_PROMPT_SUFFIX, MSSQL_PROMPT, MSSQL_AGENT_PREFIX, 
-                          MSSQL_AGENT_FORMAT_INSTRUCTIONS, CHATGPT_PROMPT, BING_PROMPT_PREFIX)
+    from .caching import TTLCache, make_cache
+    from .vector_index import LocalVectorIndex
+    from .tracing import span, traced
+    from .metrics import Counter, Histogram, RetryLogCounter, register_cache
 except Exception as e:
     print(e)
-    from prompts import (COMBINE_QUESTION_PROMPT, COMBINE_PROMPT, COMBINE_CHAT_PROMPT,
-                          CSV_PROMPT_PREFIX, CSV_PROMPT_SUFFIX, MSSQL_PROMPT, MSSQL_AGENT_PREFIX, 
-                          MSSQL_AGENT_FORMAT_INSTRUCTIONS, CHATGPT_PROMPT, BING_PROMPT_PREFIX)
-
+    from caching import TTLCache, make_cache
+    from vector_index import LocalVectorIndex
+    from tracing import span, traced
+    from metrics import Counter, Histogram, RetryLogCounter, register_cache
+
+# LangChain (and SQLAlchemy, which it imports) takes over a second to import, so it is imported in the
+# functions that use it, and the tools and the other classes built on it live in tools.py, re-exported
+# below on first access. The Streamlit pages and the notebooks only pay for what they use.
+if TYPE_CHECKING:
+    from langchain.docstore.document import Document
+    from langchain.chat_models import AzureChatOpenAI
+    from langchain.vectorstores import VectorStore
+    from langchain.memory import ConversationBufferMemory
+    from langchain.agents import AgentExecutor
+    from langchain.callbacks.base import BaseCallbackManager, BaseCallbackHandler
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.engine.url import URL
+
+_TOOLS_EXPORTS = {"DocSearchTool", "CSVTabularTool", "SQLDbTool", "ChatGPTTool", "BingSearchResults", "BingSearchTool",
+                  "CachedSQLDatabase", "get_sql_database", "create_chunked_csv_agent"}
+
+
+def __getattr__(name: str) -> Any:
+    if name in _TOOLS_EXPORTS:
+        try:
+            from . import tools
+        except ImportError:
+            import tools
+        return getattr(tools, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
+# docx2txt and pypdf (which pulls in Pillow and cryptography) are imported on first use, so
+# the bot and the search page do not pay for them at start up
 # @st.cache_data
 def parse_docx(file: BytesIO) -> str:
+    import docx2txt
     text = docx2txt.process(file)
     # Remove multiple newlines
     text = re.sub(r"\n\s*\n", "\n\n", text)
     return text
 
 
-# @st.cache_data
-def parse_pdf(file: BytesIO) -> List[str]:
-    pdf = PdfReader(file)
-    output = []
-    for page in pdf.pages:
-        text = page.extract_text()
-        # Merge hyphenated words
-        text = re.sub(r"(\w+)-\n(\w+)", r"\1\2", text)
-        # Fix newlines in the middle of sentences
-        text = re.sub(r"(?<!\n\s)\n(?!\s\n)", " ", text.strip())
-        # Remove multiple newlines
-        text = re.sub(r"\n\s*\n", "\n\n", text)
+_HYPHENATED_WORDS_REGEX = re.compile(r"(\w+)-\n(\w+)")
+_MIDSENTENCE_NEWLINE_REGEX = re.compile(r"(?<!\n\s)\n(?!\s\n)")
+_MULTIPLE_NEWLINES_REGEX = re.compile(r"\n\s*\n")
+
+
+def normalize_pdf_text(text: str) -> str:
+    """Cleans up the text extracted from a PDF page"""
+    # Merge hyphenated words
+    text = _HYPHENATED_WORDS_REGEX.sub(r"\1\2", text)
+    # Fix newlines in the middle of sentences
+    text = _MIDSENTENCE_NEWLINE_REGEX.sub(" ", text.strip())
+    # Remove multiple newlines
+    text = _MULTIPLE_NEWLINES_REGEX.sub("\n\n", text)
+    return text
 
-        output.append(text)
 
-    return output
+# PDF opened once in each worker process of iter_pdf_pages
+_worker_pdf = None
+
+
+def _init_pdf_worker(source: Union[str, bytes]) -> None:
+    global _worker_pdf
+    from pypdf import PdfReader
+    _worker_pdf = PdfReader(source if isinstance(source, str) else BytesIO(source))
+
+
+def _parse_pdf_page_range(page_range: Tuple[int, int]) -> List[Tuple[int, str]]:
+    start, end = page_range
+    return [(i + 1, normalize_pdf_text(_worker_pdf.pages[i].extract_text())) for i in range(start, end)]
+
+
+def iter_pdf_pages(file: Union[BytesIO, bytes, str], workers: Optional[int] = None, ordered: bool = True,
+                   pages_per_task: int = 8) -> Iterator[Tuple[int, str]]:
+    """Yields (page_number, text) for each page of a PDF as soon as it is parsed.
+
+    With workers > 1 the page ranges are parsed in a process pool. At most two ranges per
+    worker are in flight at a time, so memory stays flat for long PDFs. With ordered=False
+    pages are yielded in the order they finish instead of in page order.
+    """
+    from pypdf import PdfReader
+
+    if not workers or workers <= 1:
+        for i, page in enumerate(PdfReader(file).pages):
+            yield i + 1, normalize_pdf_text(page.extract_text())
+        return
+
+    # Workers get a path or the raw bytes once, at start up, instead of with every task
+    source = file if isinstance(file, (str, bytes)) else file.read()
+    num_pages = len(PdfReader(source if isinstance(source, str) else BytesIO(source)).pages)
+    page_ranges = iter([(start, min(start + pages_per_task, num_pages)) for start in range(0, num_pages, pages_per_task)])
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_pdf_worker, initargs=(source,))
+    try:
+        pending = deque()
+        for page_range in itertools.islice(page_ranges, workers * 2):
+            pending.append(executor.submit(_parse_pdf_page_range, page_range))
+
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = wait(pending, return_when=FIRST_COMPLETED).done.pop()
+                pending.remove(future)
+            for page_range in itertools.islice(page_ranges, 1):
+                pending.append(executor.submit(_parse_pdf_page_range, page_range))
+            yield from future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+# @st.cache_data
+def parse_pdf(file: BytesIO, workers: Optional[int] = None) -> List[str]:
+    return [text for _, text in iter_pdf_pages(file, workers=workers)]
 
 
 # @st.cache_data
@@ -84,42 +154,304 @@ def parse_txt(file: BytesIO) -> str:
     return text
 
 
+def _normalize_blocks(pieces: Iterable[str], block_size: int = 65536, strip: bool = False) -> Iterator[str]:
+    """Collapses multiple newlines in a stream of text pieces, yielding blocks of about `block_size` chars.
+
+    Blocks are cut at the start of a paragraph break, so collapsing each block on its
+    own gives the same text as collapsing the whole stream at once.
+    """
+    buffer = ""
+    first = True
+    for piece in pieces:
+        buffer += piece
+        if len(buffer) < block_size:
+            continue
+        cut = None
+        for match in _MULTIPLE_NEWLINES_REGEX.finditer(buffer):
+            if match.end() < len(buffer) and not buffer[match.end()].isspace():
+                cut = match.start()
+        if not cut and len(buffer) >= 4 * block_size:
+            # No paragraph break past the start: cut before the trailing whitespace instead
+            cut = len(buffer.rstrip())
+        if not cut:
+            continue
+        block, buffer = _MULTIPLE_NEWLINES_REGEX.sub("\n\n", buffer[:cut]), buffer[cut:]
+        if strip and first:
+            block = block.lstrip()
+        first = False
+        if block:
+            yield block
+
+    block = _MULTIPLE_NEWLINES_REGEX.sub("\n\n", buffer)
+    if strip:
+        block = block.lstrip() if first else block
+        block = block.rstrip()
+    if block:
+        yield block
+
+
+def iter_txt_blocks(file: BytesIO, block_size: int = 65536) -> Iterator[str]:
+    """Streaming parse_txt: decodes the file incrementally and yields normalized blocks of text"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def pieces():
+        while True:
+            data = file.read(block_size)
+            if not data:
+                break
+            yield decoder.decode(data)
+        yield decoder.decode(b"", final=True)
+
+    return _normalize_blocks(pieces(), block_size)
+
+
+_DOCX_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_DOCX_TEXT_TAGS = {_DOCX_NAMESPACE + "tab": "\t", _DOCX_NAMESPACE + "br": "\n",
+                   _DOCX_NAMESPACE + "cr": "\n", _DOCX_NAMESPACE + "p": "\n\n"}
+
+
+def _iter_docx_xml_text(xml_file) -> Iterator[str]:
+    # Same text as docx2txt.xml2text, without building the whole element tree
+    for event, element in ElementTree.iterparse(xml_file, events=("start", "end")):
+        if event == "start":
+            if element.tag in _DOCX_TEXT_TAGS:
+                yield _DOCX_TEXT_TAGS[element.tag]
+        elif element.tag == _DOCX_NAMESPACE + "t":
+            yield element.text or ""
+        elif element.tag == _DOCX_NAMESPACE + "p":
+            element.clear()
+
+
+def iter_docx_blocks(file: BytesIO, block_size: int = 65536) -> Iterator[str]:
+    """Streaming parse_docx: yields normalized blocks of text while parsing the document XML"""
+
+    def pieces():
+        with zipfile.ZipFile(file) as zipf:
+            names = zipf.namelist()
+            # Headers, main document and footers, in the same order as docx2txt
+            parts = ([name for name in names if re.match(r"word/header[0-9]*.xml", name)] + ["word/document.xml"]
+                     + [name for name in names if re.match(r"word/footer[0-9]*.xml", name)])
+            for name in parts:
+                with zipf.open(name) as xml_file:
+                    yield from _iter_docx_xml_text(xml_file)
+
+    return _normalize_blocks(pieces(), block_size, strip=True)
+
+
+_CHUNK_SEPARATORS = ["\n\n", "\n", ".", "!", "?", ",", " ", ""]
+
+
+def chunk_offsets(text: str, chunk_size: int = 800, separators: List[str] = _CHUNK_SEPARATORS,
+                  encoding_name: Optional[str] = None) -> List[Tuple[int, int]]:
+    """Computes the (start, end) offsets of the chunks of `text` in a single pass.
+
+    Each chunk is the longest piece that fits in `chunk_size` and ends at the highest
+    priority separator found in it, like RecursiveCharacterTextSplitter with no overlap.
+    Whitespace around chunks is left out. With `encoding_name` (e.g. "cl100k_base")
+    `chunk_size` counts tiktoken tokens instead of characters.
+    """
+    return _chunk_offsets(text, chunk_size, separators, encoding_name)[0]
+
+
+def _last_token_boundary(text: str, end: int) -> int:
+    """Position of the last single space between two non-space characters before `end`, or -1.
+
+    Tokenizers always start a token at such a space, so the tokens after it do not depend
+    on the text before it, and the tokens before it do not change when text is appended.
+    """
+    position = text.rfind(" ", 0, end)
+    while position > 0:
+        if not text[position - 1].isspace() and position + 1 < len(text) and not text[position + 1].isspace():
+            return position
+        position = text.rfind(" ", 0, position)
+    return -1
+
+
+def _chunk_offsets(text: str, chunk_size: int = 800, separators: List[str] = _CHUNK_SEPARATORS,
+                   encoding_name: Optional[str] = None, start: int = 0,
+                   final: bool = True) -> Tuple[List[Tuple[int, int]], int]:
+    """chunk_offsets from `start`, also returning where the next chunk starts.
+
+    With final=False more text follows `text`: the chunks that could still change once it
+    is appended are left out, and chunking resumes at the returned offset.
+    """
+    if encoding_name:
+        encoding = tiktoken.get_encoding(encoding_name)
+        _, token_starts = encoding.decode_with_offsets(encoding.encode(text))
+
+    offsets = []
+    length = len(text)
+    # A chunk is complete once its limit is followed by text that appending cannot change
+    stable = length - 1 if final or not encoding_name else _last_token_boundary(text, length)
+    while start < length:
+        # Skip the whitespace between chunks
+        while start < length and text[start].isspace():
+            start += 1
+        if start == length:
+            break
+
+        if encoding_name:
+            i = bisect.bisect_right(token_starts, start) - 1
+            limit = token_starts[i + chunk_size] if i + chunk_size < len(token_starts) else length
+            limit = max(limit, start + 1)
+        else:
+            limit = start + chunk_size
+
+        if not final and limit > stable:
+            break
+        if limit >= length:
+            end = length
+        else:
+            end = limit
+            for separator in separators:
+                if not separator:
+                    break
+                position = text.rfind(separator, start, limit)
+                if position > start:
+                    # Whitespace separators are dropped, punctuation stays with its chunk
+                    end = position if separator.isspace() else position + len(separator)
+                    break
+
+        chunk_end = end
+        while chunk_end > start and text[chunk_end - 1].isspace():
+            chunk_end -= 1
+        if chunk_end > start:
+            offsets.append((start, chunk_end))
+        start = end
+    return offsets, start
+
+
+def iter_text_to_docs(pages: Iterable[Union[str, Tuple[int, str]]], chunk_size: int = 800,
+                      encoding_name: Optional[str] = None) -> Iterator[Document]:
+    """Streaming text_to_docs: yields the chunk Documents of each page as soon as it arrives.
+
+    `pages` holds either page texts, numbered in order, or (page_number, text) pairs.
+    Consecutive pairs with the same page number are blocks of one page (as produced by
+    iter_txt_blocks), and are chunked as if the page had come in one piece: the
+    unfinished tail of a block is carried into the next one. See chunk_offsets for
+    `chunk_size` and `encoding_name`.
+    """
+    from langchain.docstore.document import Document
+
+    chunk_counts = dict()
+    numbered = (page if isinstance(page, tuple) else (i + 1, page) for i, page in enumerate(pages))
+    carry, carry_start = "", 0
+
+    page_number, page_text = next(numbered, (None, None))
+    while page_number is not None:
+        next_number, next_text = next(numbered, (None, None))
+        final = next_number != page_number
+        text = carry + page_text
+        offsets, next_start = _chunk_offsets(text, chunk_size, encoding_name=encoding_name, start=carry_start,
+                                             final=final)
+        first_chunk = chunk_counts.get(page_number, 0)
+        for chunk_number, (start, end) in enumerate(offsets, start=first_chunk):
+            doc = Document(
+                page_content=text[start:end], metadata={"page": page_number, "chunk": chunk_number}
+            )
+            # Add sources a metadata
+            doc.metadata["source"] = f"{doc.metadata['page']}-{doc.metadata['chunk']}"
+            yield doc
+        chunk_counts[page_number] = first_chunk + len(offsets)
+
+        if final:
+            carry, carry_start = "", 0
+        else:
+            # Tokens are counted from a token boundary so the tail is tokenized as in the whole page
+            context = _last_token_boundary(text, next_start + 1) if encoding_name else -1
+            context = next_start if context < 0 else context
+            carry, carry_start = text[context:], next_start - context
+        page_number, page_text = next_number, next_text
+
+
+def iter_file_docs(file: Union[BytesIO, str], file_name: str, workers: Optional[int] = None,
+                   block_size: int = 65536, chunk_size: int = 800, encoding_name: Optional[str] = None) -> Iterator[Document]:
+    """Parses a .pdf, .docx or .txt file and yields its chunk Documents lazily"""
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == ".pdf":
+        pages = iter_pdf_pages(file, workers=workers)
+    elif extension == ".docx":
+        pages = ((1, block) for block in iter_docx_blocks(file, block_size))
+    elif extension == ".txt":
+        if isinstance(file, str):
+            with open(file, "rb") as f:
+                yield from iter_file_docs(f, file_name, workers, block_size, chunk_size, encoding_name)
+            return
+        pages = ((1, block) for block in iter_txt_blocks(file, block_size))
+    else:
+        raise ValueError(f"Unsupported file type: {file_name}")
+    yield from iter_text_to_docs(pages, chunk_size=chunk_size, encoding_name=encoding_name)
+
+
+def prefetch(iterable: Iterable, maxsize: int = 64) -> Iterator:
+    """Runs `iterable` in a background thread, at most `maxsize` items ahead of the consumer.
+
+    Lets a slow consumer (an uploader or embedder) work while parsing continues, while the
+    bounded queue blocks the producer whenever the consumer falls behind.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    done = object()
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((done, e))
+            return
+        put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    """Groups an iterable into lists of at most `size` items"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
 # @st.cache_data
-def text_to_docs(text: List[str]) -> List[Document]:
+def text_to_docs(text: List[str], chunk_size: int = 800, encoding_name: Optional[str] = None) -> List[Document]:
     """Converts a string or list of strings to a list of Documents
     with metadata."""
     if isinstance(text, str):
         # Take a single string as one page
         text = [text]
-    page_docs = [Document(page_content=page) for page in text]
-
-    # Add page numbers as metadata
-    for i, doc in enumerate(page_docs):
-        doc.metadata["page"] = i + 1
-
-    # Split pages into chunks
-    doc_chunks = []
-
-    for doc in page_docs:
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=800,
-            separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""],
-            chunk_overlap=0,
-        )
-        chunks = text_splitter.split_text(doc.page_content)
-        for i, chunk in enumerate(chunks):
-            doc = Document(
-                page_content=chunk, metadata={"page": doc.metadata["page"], "chunk": i}
-            )
-            # Add sources a metadata
-            doc.metadata["source"] = f"{doc.metadata['page']}-{doc.metadata['chunk']}"
-            doc_chunks.append(doc)
-    return doc_chunks
+    return list(iter_text_to_docs(text, chunk_size=chunk_size, encoding_name=encoding_name))
 
 
 # @st.cache_data(show_spinner=False)
+@traced("embed_docs")
 def embed_docs(docs: List[Document], chunks_limit: int=100, verbose: bool = False) -> VectorStore:
     """Embeds a list of Documents and returns a FAISS index"""
+    from langchain.embeddings import OpenAIEmbeddings
+    from langchain.vectorstores.faiss import FAISS
  
     # Select the Embedder model'
     if verbose: print("Number of chunks:",len(docs))
@@ -134,6 +466,7 @@ def embed_docs(docs: List[Document], chunks_limit: int=100, verbose: bool = Fals
     return index
 
 
+@traced("search_docs")
 def search_docs(index: VectorStore, query: str, k: int=4) -> List[Document]:
     """Searches a FAISS index for similar chunks to the query
     and returns a list of Documents."""
@@ -188,6 +521,7 @@ def model_tokens_limit(model: str) -> int:
     return token_limit
 
 # Returns num of toknes used on a list of Documents objects
+@traced("num_tokens_from_docs")
 def num_tokens_from_docs(docs: List[Document]) -> int:
     num_tokens = 0
     for i in range(len(docs)):
@@ -195,6 +529,11 @@ def num_tokens_from_docs(docs: List[Document]) -> int:
     return num_tokens
 
 
+# Azure Search responses by (index, query, k), kept for a few minutes so newly indexed documents show up
+_search_results_cache = make_cache("search_results", maxsize=1024, ttl=300)
+
+
+@traced("get_search_results")
 def get_search_results(query: str, indexes: list, k: int = 5) -> List[dict]:
     
     headers = {'Content-Type': 'application/json','api-key': os.environ["AZURE_SEARCH_KEY"]}
@@ -202,6 +541,11 @@ def get_search_results(query: str, indexes: list, k: int = 5) -> List[dict]:
     agg_search_results = []
     
     for index in indexes:
+        search_results = _search_results_cache.get((index, query, k))
+        if search_results is not None:
+            agg_search_results.append(search_results)
+            continue
+
         url = os.environ["AZURE_SEARCH_ENDPOINT"] + '/indexes/'+ index + '/docs'
         url += '?api-version={}'.format(os.environ["AZURE_SEARCH_API_VERSION"])
         url += '&search={}'.format(query)
@@ -215,14 +559,18 @@ def get_search_results(query: str, indexes: list, k: int = 5) -> List[dict]:
         url += '&answers=extractive|count-3'
         url += '&captions=extractive|highlight-false'
 
-        resp = requests.get(url, headers=headers)
+        with span("search_index", index=index):
+            resp = requests.get(url, headers=headers)
 
-        search_results = resp.json()
+            search_results = resp.json()
+        if resp.ok:
+            _search_results_cache.set((index, query, k), search_results)
         agg_search_results.append(search_results)
 
     return agg_search_results
     
 
+@traced("order_search_results")
 def order_search_results( agg_search_results: List[dict], reranker_threshold: int) -> OrderedDict:
     
     """Orders based on score the results from get_search_results function"""
@@ -249,27 +597,185 @@ def order_search_results( agg_search_results: List[dict], reranker_threshold: in
     return ordered_content
 
 
+# ISO 639-1 codes (the `language` field of the indexes) of the answer languages offered by the apps
+LANGUAGE_CODES = {"English": "en", "Spanish": "es", "French": "fr", "German": "de", "Portuguese": "pt", "Italian": "it"}
+
+
+def extractive_answer_th_from_env() -> Optional[float]:
+    """Minimum score (0-1) of an extractive answer from EXTRACTIVE_ANSWER_THRESHOLD; None (no
+    extractive answers) when it is unset. The apps read the setting through this function."""
+    threshold = os.environ.get("EXTRACTIVE_ANSWER_THRESHOLD")
+    return float(threshold) if threshold else None
+
+
+def extractive_reranker_th_from_env() -> float:
+    """Minimum reranker score (0-4) of the document of an extractive answer, from
+    EXTRACTIVE_ANSWER_RERANKER_THRESHOLD (default 2)"""
+    return float(os.environ.get("EXTRACTIVE_ANSWER_RERANKER_THRESHOLD") or 2)
+
+
+@traced("get_extractive_answers")
+def get_extractive_answers(agg_search_results: List[dict], min_score: float = 0.9,
+                           min_reranker_score: float = 2, language: Optional[str] = None) -> List[dict]:
+    """Returns the extractive answers (@search.answers) of the get_search_results function that
+    score at least `min_score` (0-1) and come from a document with a reranker score of at least
+    `min_reranker_score` (0-4), best first, with the title, location and language of their document.
+    With `language` (ISO 639-1 code) only answers from documents in that language are returned."""
+
+    answers = []
+    for search_results in agg_search_results:
+        results = {result['id']: result for result in search_results.get('value', [])}
+        for answer in search_results.get('@search.answers') or []:
+            result = results.get(answer['key'])
+            if result is None or answer['score'] < min_score or result['@search.rerankerScore'] < min_reranker_score:
+                continue
+            if language is not None and (result.get('language') or "").lower()[:2] != language:
+                continue
+            answers.append({
+                            "text": answer['text'],
+                            "score": answer['score'],
+                            "title": result['title'],
+                            "name": result['metadata_storage_name'],
+                            "location": result['metadata_storage_path'],
+                            "language": result.get('language')
+                        })
+    return sorted(answers, key=lambda x: x["score"], reverse=True)
+
+
+_query_embedding_cache = make_cache("query_embeddings", maxsize=1024)
+
+
+def embed_query(query: str) -> List[float]:
+    """Embeds a query, reusing the embedding of a query seen before"""
+    def embed():
+        from langchain.embeddings import OpenAIEmbeddings
+        embedder = OpenAIEmbeddings(deployment="text-embedding-ada-002", chunk_size=1)
+        return embedder.embed_query(query)
+
+    return _query_embedding_cache.get_or_set(query, embed)
+
+
+_sentence_embedding_cache = make_cache("sentence_embeddings", maxsize=20000)
+
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    """Embeds texts (e.g. the sentences of the search results), reusing the embeddings of the
+    texts seen before and embedding the others in one call"""
+    embeddings = [_sentence_embedding_cache.get(text) for text in texts]
+    missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+    if missing:
+        from langchain.embeddings import OpenAIEmbeddings
+        embedder = OpenAIEmbeddings(deployment="text-embedding-ada-002", chunk_size=16)
+        new_embeddings = dict(zip(missing, embedder.embed_documents(missing)))
+        for text, embedding in new_embeddings.items():
+            _sentence_embedding_cache.set(text, embedding)
+        embeddings = [new_embeddings[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
+    return embeddings
+
+
+def hybrid_search_results(query: str, indexes: list, k: int, reranker_threshold: int,
+                          vector_index: LocalVectorIndex, vector_k: int = 10, rrf_k: int = 60,
+                          agg_search_results: Optional[List[dict]] = None) -> OrderedDict:
+    """Fuses the ordered Azure Search results with the nearest chunks of the local vector index
+    using Reciprocal Rank Fusion, and returns them in the same format as order_search_results.
+    Pass `agg_search_results` if get_search_results was already called for the query."""
+
+    if agg_search_results is None:
+        agg_search_results = get_search_results(query, indexes, k)
+    ordered_results = order_search_results(agg_search_results, reranker_threshold)
+    vector_results = vector_index.search(embed_query(query), k=vector_k)
+
+    content = dict(ordered_results)
+    fused_scores = {id: 1 / (rrf_k + rank + 1) for rank, id in enumerate(content)}
+
+    # Results indexed other than by ingest.py (e.g. by the notebooks, one document per file with all
+    # its pages) never share its chunk ids: match them by chunk text, or by file when the whole file
+    # is a single result, so that the same content is not added twice
+    indexed_ids = vector_index.contains_ids(list(content))
+    ids_by_chunk = {chunk: id for id, value in content.items() for chunk in value["chunks"]}
+    whole_files = {value["location"]: id for id, value in content.items() if id not in indexed_ids}
+
+    vector_ranked = set()
+    for rank, result in enumerate(vector_results):
+        id = result["id"]
+        if id not in content:
+            id = ids_by_chunk.get(result["content"]) or whole_files.get(result["metadata_storage_path"], id)
+        if id not in content:
+            content[id] = {
+                            "title": result["title"],
+                            "chunks": [result["content"]],
+                            "language": result["language"],
+                            "caption": result["content"][:200],
+                            "score": result["similarity"] * 4, # Same 0-4 scale as the reranker score
+                            "name": result["metadata_storage_name"],
+                            "location": result["metadata_storage_path"]
+                        }
+        if id not in vector_ranked:
+            vector_ranked.add(id)
+            fused_scores[id] = fused_scores.get(id, 0) + 1 / (rrf_k + rank + 1)
+
+    ordered_content = OrderedDict()
+    for id in sorted(fused_scores, key=lambda x: fused_scores[x], reverse=True):
+        ordered_content[id] = content[id]
+
+    return ordered_content
+
+
+def search_docs_by_vector(vector_index: LocalVectorIndex, query: str, docs: List[Document], k: int = 4) -> Optional[List[Document]]:
+    """Ranks Documents by the similarity of their stored vectors to the query, so only the query
+    is embedded. Returns None when some Document is not in the vector index."""
+    similarities = vector_index.similarities(embed_query(query), [doc.page_content for doc in docs])
+    if any(similarity is None for similarity in similarities):
+        return None
+    ranked = sorted(zip(similarities, range(len(docs))), reverse=True)
+    return [docs[i] for _, i in ranked[:k]]
+
+
+@traced("get_answer")
 def get_answer(llm: AzureChatOpenAI,
                docs: List[Document], 
                query: str, 
                language: str, 
                chain_type: str,
                memory: ConversationBufferMemory = None,
-               callback_manager: BaseCallbackManager = None
+               callback_manager: BaseCallbackManager = None,
+               callbacks: Optional[List[BaseCallbackHandler]] = None,
+               tokens_limit: Optional[int] = None
               ) -> Dict[str, Any]:
     
-    """Gets an answer to a question from a list of Documents."""
+    """Gets an answer to a question from a list of Documents.
+    Unlike callback_manager, `callbacks` also reach the LLM (e.g. to stream its tokens).
+    The prompt is the richest variant that fits in `tokens_limit` (by default
+    model_tokens_limit of the llm) with the documents, the question and the chat history."""
+    from langchain.chains.qa_with_sources import load_qa_with_sources_chain
+    from langchain.schema import get_buffer_string
+    try:
+        from .prompts import COMBINE_QUESTION_PROMPT
+        from .prompt_registry import PROMPTS
+    except ImportError:
+        from prompts import COMBINE_QUESTION_PROMPT
+        from prompt_registry import PROMPTS
+
+    # Pick the prompt variant. With map_reduce the extracts of the map step are not known yet;
+    # they are at most as long as the documents they come from.
+    if tokens_limit is None:
+        tokens_limit = model_tokens_limit(getattr(llm, "deployment_name", None))
+    history = memory.buffer if memory is not None else ""
+    if not isinstance(history, str):
+        history = get_buffer_string(history)
+    budget = tokens_limit - num_tokens_from_docs(docs) - num_tokens_from_string(query + history)
+    _, combine_prompt = PROMPTS.select("combine" if memory is None else "combine_chat", budget)
 
     # Get the answer
         
     if chain_type == "stuff":
         if memory == None:
             chain = load_qa_with_sources_chain(llm, chain_type=chain_type,
-                                               prompt=COMBINE_PROMPT,
+                                               prompt=combine_prompt,
                                                callback_manager=callback_manager)
         else:
             chain = load_qa_with_sources_chain(llm, chain_type=chain_type, 
-                                               prompt=COMBINE_CHAT_PROMPT,
+                                               prompt=combine_prompt,
                                                memory=memory,
                                                callback_manager=callback_manager)
 
@@ -277,24 +783,27 @@ def get_answer(llm: AzureChatOpenAI,
         if memory == None:
             chain = load_qa_with_sources_chain(llm, chain_type=chain_type, 
                                                question_prompt=COMBINE_QUESTION_PROMPT,
-                                               combine_prompt=COMBINE_PROMPT,
+                                               combine_prompt=combine_prompt,
                                                callback_manager=callback_manager)
         else:
             chain = load_qa_with_sources_chain(llm, chain_type=chain_type, 
                                                question_prompt=COMBINE_QUESTION_PROMPT,
-                                               combine_prompt=COMBINE_CHAT_PROMPT,
+                                               combine_prompt=combine_prompt,
                                                memory=memory,
                                                callback_manager=callback_manager)
     else:
         print("Error: chain_type", chain_type, "not supported")
     
-    answer = chain( {"input_documents": docs, "question": query, "language": language}, return_only_outputs=True)
+    answer = chain( {"input_documents": docs, "question": query, "language": language}, return_only_outputs=True, callbacks=callbacks)
 
     return answer
 
 
 def run_agent(question:str, agent_chain: AgentExecutor) -> str:
     """Function to run the brain agent and deal with potential parsing errors"""
+    from langchain.chains import LLMChain
+    from langchain.prompts import PromptTemplate
+    from langchain.schema import OutputParserException
     
     try:
         return agent_chain.run(input=question)
@@ -311,287 +820,159 @@ def run_agent(question:str, agent_chain: AgentExecutor) -> str:
         return response
     
 
-######## TOOL CLASSES #####################################
-###########################################################
-    
-class DocSearchTool(BaseTool):
-    """Tool for Azure GPT Smart Search Engine"""
-    
-    name = "@docsearch"
-    description = "useful when the questions includes the term: @docsearch.\n"
+# Parsed DataFrames keyed by (path, mtime, size, columnar format, hash of the pandas kwargs)
+_dataframe_cache = TTLCache(maxsize=8)
 
-    llm: AzureChatOpenAI
-    indexes: List[str]
-    k: int = 10
-    response_language: str = "English"
-    reranker_th: int = 1
-    chunks_limit:int = 100
-    similarity_k: int = 4
+logger = logging.getLogger(__name__)
 
-    
-    def _run(self, query: str) -> str:
 
-        try:
-            agg_search_results = get_search_results(query, self.indexes, self.k)
-            ordered_results = order_search_results(agg_search_results, reranker_threshold=self.reranker_th)
-            docs = []
-            for key,value in ordered_results.items():
-                for page in value["chunks"]:
-                    docs.append(Document(page_content=page, metadata={"source": value["location"]}))
-
-            # Calculate number of tokens of our docs
-            tokens_limit = model_tokens_limit(self.llm.deployment_name)
-
-            if(len(docs)>0):
-                num_tokens = num_tokens_from_docs(docs)
-                if self.verbose:
-                    print("Custom token limit for", self.llm.deployment_name, ":", tokens_limit)
-                    print("Combined docs tokens count:",num_tokens)
+def _pandas_kwargs_hash(pandas_kwargs: Optional[dict] = None) -> str:
+    """Stable hash of the read_csv arguments, empty when there are none"""
+    if not pandas_kwargs:
+        return ""
+    return hashlib.sha1(json.dumps(pandas_kwargs, sort_keys=True, default=repr).encode("utf-8")).hexdigest()[:16]
 
-            else:
-                return "No Results Found in my knowledge base"
 
-            if num_tokens > tokens_limit:
-                index = embed_docs(docs, chunks_limit = self.chunks_limit, verbose=self.verbose)
-                top_docs = search_docs(index, query, k = self.similarity_k)
+def _csv_cache_key(path: str, columnar_format: Optional[str] = None, pandas_kwargs: Optional[dict] = None) -> tuple:
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, columnar_format, _pandas_kwargs_hash(pandas_kwargs))
 
-                # Now we need to recalculate the tokens count of the top results from similarity vector search
-                # in order to select the chain type: stuff or map_reduce
 
-                num_tokens = num_tokens_from_docs(top_docs)
-                if self.verbose:
-                    print("Token count after similarity search:", num_tokens)
-                chain_type = "map_reduce" if num_tokens > tokens_limit else "stuff"
+def _columnar_path(path: str, columnar_format: str, pandas_kwargs: Optional[dict] = None) -> str:
+    kwargs_hash = _pandas_kwargs_hash(pandas_kwargs)
+    return path + ("." + kwargs_hash if kwargs_hash else "") + "." + columnar_format
 
-            else:
-                # if total tokens is less than our limit, we don't need to vectorize and do similarity search
-                top_docs = docs
-                chain_type = "stuff"
 
-            if self.verbose:
-                print("Chain Type selected:", chain_type)
+def _read_columnar(path: str, columnar_format: str):
+    """Reads a Parquet/Feather file memory-mapped with pyarrow"""
+    if columnar_format == "feather":
+        from pyarrow import feather
+        return feather.read_table(path, memory_map=True).to_pandas()
+    from pyarrow import parquet
+    return parquet.read_table(path, memory_map=True).to_pandas()
 
-            response = get_answer(llm=self.llm, query=query, docs=top_docs, chain_type=chain_type, language=self.response_language)
-            
-            answer = response['output_text']
-            
-            try:
-                split_regex = re.compile(f"sources?:?\\W*", re.IGNORECASE)
-                answer_text = split_regex.split(answer)[0]
-                sources_list = split_regex.split(answer)[1].replace(" ","").split(",")
-
-                sources_html = '<br><u>Sources</u>: '
-                for index, value in enumerate(sources_list):
-                    url = value + os.environ["DATASOURCE_SAS_TOKEN"]
-                    sources_html +='<sup><a href="'+ url + '">[' + str(index+1) + ']</a></sup>'
-                    
-                answer = answer_text + sources_html
-
-            except Exception as e:
-                print(e)
-                
-            return answer
 
-        
-        except Exception as e:
-            print(e)
-    
-    async def _arun(self, query: str) -> str:
-        """Use the tool asynchronously."""
-        raise NotImplementedError("DocSearchTool does not support async")
-    
+def _write_columnar(df, path: str, columnar_format: str) -> None:
+    """Writes a DataFrame with its index (e.g. from index_col), so reading it back gives the same frame"""
+    import pyarrow
 
-class CSVTabularTool(BaseTool):
-    """Tool CSV agent"""
-    
-    name = "@csvfile"
-    description = "useful when the questions includes the term: @csvfile.\n"
+    table = pyarrow.Table.from_pandas(df)
+    tmp_path = path + ".tmp"
+    if columnar_format == "feather":
+        from pyarrow import feather
+        feather.write_feather(table, tmp_path)
+    else:
+        from pyarrow import parquet
+        parquet.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
 
-    path: str
-    llm: AzureChatOpenAI
-    
-    def _run(self, query: str) -> str:
-        
-        try:
-            agent = create_csv_agent(self.llm, self.path, verbose=self.verbose, callback_manager=self.callbacks,)
-            for i in range(5):
-                try:
-                    response = agent.run(CSV_PROMPT_PREFIX + query + CSV_PROMPT_SUFFIX) 
-                    break
-                except:
-                    response = "Error too many failed retries"
-                    continue
-
-            return response
-        except Exception as e:
-            print(e)
-            response = e
-            return response
-    
-    async def _arun(self, query: str) -> str:
-        """Use the tool asynchronously."""
-        raise NotImplementedError("CSVTabularTool does not support async")
-        
-        
-class SQLDbTool(BaseTool):
-    """Tool SQLDB Agent"""
-    
-    name = "@covidstats"
-    description = "useful when the questions includes the term: @covidstats.\n"
 
-    llm: AzureChatOpenAI
-    
-    def _run(self, query: str) -> str:
-        db_config = {
-            'drivername': 'mssql+pyodbc',
-            'username': os.environ["SQL_SERVER_USERNAME"] +'@'+ os.environ["SQL_SERVER_ENDPOINT"],
-            'password': os.environ["SQL_SERVER_PASSWORD"],
-            'host': os.environ["SQL_SERVER_ENDPOINT"],
-            'port': 1433,
-            'database': os.environ["SQL_SERVER_DATABASE"],
-            'query': {'driver': 'ODBC Driver 17 for SQL Server'}
-        }
-
-        db_url = URL.create(**db_config)
-        db = SQLDatabase.from_uri(db_url)
-        toolkit = SQLDatabaseToolkit(db=db, llm=self.llm)
-        agent_executor = create_sql_agent(
-            prefix=MSSQL_AGENT_PREFIX,
-            format_instructions = MSSQL_AGENT_FORMAT_INSTRUCTIONS,
-            llm=self.llm,
-            toolkit=toolkit,
-            callback_manager=self.callbacks,
-            verbose=self.verbose
-        )
-
-        for i in range(2):
-            try:
-                response = agent_executor.run(query) 
-                break
-            except Exception as e:
-                response = str(e)
-                continue
+def load_csv_dataframe(path: str, columnar_format: Optional[str] = None, pandas_kwargs: Optional[dict] = None):
+    """Returns the parsed DataFrame of a CSV file, cached until the file changes.
 
-        return response
-        
-    
-    async def _arun(self, query: str) -> str:
-        """Use the tool asynchronously."""
-        raise NotImplementedError("SQLDbTool does not support async")
-        
-        
-        
-class ChatGPTTool(BaseTool):
-    """Tool for a ChatGPT clone"""
-    
-    name = "@chatgpt"
-    description = "useful when the questions includes the term: @chatgpt.\n"
+    With columnar_format="parquet" or "feather" the parsed data is also written next to
+    the CSV on first load and read back memory-mapped on later loads (including after a
+    restart), as long as it is newer than the CSV.
+    """
+    if columnar_format not in (None, "parquet", "feather"):
+        raise ValueError(f"Unsupported columnar_format: {columnar_format}")
 
-    llm: AzureChatOpenAI
-    
-    def _run(self, query: str) -> str:
+    key = _csv_cache_key(path, columnar_format, pandas_kwargs)
+
+    def load():
+        import pandas as pd
+
+        if columnar_format is None:
+            return pd.read_csv(path, **(pandas_kwargs or {}))
+
+        columnar_path = _columnar_path(path, columnar_format, pandas_kwargs)
+        if os.path.exists(columnar_path) and os.stat(columnar_path).st_mtime_ns >= key[1]:
+            return _read_columnar(columnar_path, columnar_format)
+        df = pd.read_csv(path, **(pandas_kwargs or {}))
         try:
-            chatgpt_chain = LLMChain(
-                llm=self.llm, 
-                prompt=CHATGPT_PROMPT,
-                callback_manager=self.callbacks,
-                verbose=self.verbose
-            )
+            _write_columnar(df, columnar_path, columnar_format)
+        except Exception:
+            logger.warning("Could not write %s", columnar_path, exc_info=True)
+        return df
 
-            response = chatgpt_chain.run(query)
+    return _dataframe_cache.get_or_set(key, load)
 
-            return response
-        except Exception as e:
-            print(e)
-            
-    async def _arun(self, query: str) -> str:
-        """Use the tool asynchronously."""
-        raise NotImplementedError("ChatGPTTool does not support async")
-        
 
-# class BingSearchTool(BaseTool):
-#     """Tool for a Bing Search Wrapper"""
-    
-#     name = "@bing"
-#     description = "useful when the questions includes the term: @bing.\n"
 
-#     llm: AzureChatOpenAI
-#     k: int = 5
-    
-#     def _run(self, query: str) -> str:
-#         try:
-#             bing = BingSearchAPIWrapper(k=self.k)
-#             context = str(bing.results(query,num_results=self.k))
-#             chatgpt_chain = LLMChain(
-#                 llm=self.llm, 
-#                 prompt=PromptTemplate(input_variables=["context","question"],template='Only using the following pieces of texts with its corresponding titles and links: \n "{context}".\n Answer this question: {question}.\n\n If the answer to the question is not in the above pieces of texts, say "The answer is not in the context provided". Do not make up an answer. If you can provide the answer based on the pieces of texts, please also provide the link along with the answer. Nothing else.'),
-#                 callback_manager=self.callbacks,
-#                 verbose=self.verbose
-#             )
-
-#             response = chatgpt_chain({"question": query, "context": context})['text']
-
-#             return response
-        
-#         except Exception as e:
-#             print(e)
-            
-#     async def _arun(self, query: str) -> str:
-#         """Use the tool asynchronously."""
-#         raise NotImplementedError("ChatGPTTool does not support async")
-    
-    
-class BingSearchResults(BaseTool):
-    """Tool for a Bing Search Wrapper"""
+def get_sql_db_url() -> URL:
+    """Builds the SQLAlchemy URL of the Azure SQL database from the environment"""
+    from sqlalchemy.engine.url import URL
 
-    name = "@bing"
-    description = "useful when the questions includes the term: @bing.\n"
+    db_config = {
+        'drivername': 'mssql+pyodbc',
+        'username': os.environ["SQL_SERVER_USERNAME"] +'@'+ os.environ["SQL_SERVER_ENDPOINT"],
+        'password': os.environ["SQL_SERVER_PASSWORD"],
+        'host': os.environ["SQL_SERVER_ENDPOINT"],
+        'port': 1433,
+        'database': os.environ["SQL_SERVER_DATABASE"],
+        'query': {'driver': 'ODBC Driver 17 for SQL Server'}
+    }
+    return URL.create(**db_config)
 
-    k: int = 5
 
-    def _run(self, query: str) -> str:
-        bing = BingSearchAPIWrapper(k=self.k)
-        return bing.results(query,num_results=self.k)
-    
-    async def _arun(self, query: str) -> str:
-        """Use the tool asynchronously."""
-        raise NotImplementedError("BingSearchResults does not support async")
-            
+_SQL_LITERAL_REGEX = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+_SQL_IDENTIFIER_REGEX = re.compile(r"[a-z_][a-z0-9_$#@]*")
+_SQL_READ_ONLY_REGEX = re.compile(r"^\(*\s*(select|with)\b")
+# Statements that change data or schema, also after a WITH (CTE) or as SELECT ... INTO
+_SQL_WRITE_REGEX = re.compile(r"\b(insert|update|delete|merge|into|create|alter|drop|truncate|exec|execute)\b")
+_WHITESPACE_REGEX = re.compile(r"\s+")
 
-class BingSearchTool(BaseTool):
-    """Tool for a Bing Search Wrapper"""
-    
-    name = "@bing"
-    description = "useful when the questions includes the term: @bing.\n"
-    
-    llm: AzureChatOpenAI
-    k: int = 5
-    
-    def _run(self, tool_input: Union[str, Dict],) -> str:
-        try:
-            tools = [BingSearchResults(k=self.k)]
-            parsed_input = self._parse_input(tool_input)
-
-            agent_executor = initialize_agent(tools=tools, 
-                                              llm=self.llm, 
-                                              agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, 
-                                              agent_kwargs={'prefix':BING_PROMPT_PREFIX},
-                                              callback_manager=self.callbacks,
-                                              verbose=self.verbose)
-            
-            for i in range(3):
-                try:
-                    response = agent_executor.run(parsed_input) 
-                    break
-                except Exception as e:
-                    response = str(e)
-                    continue
 
-            return response
-        
-        except Exception as e:
-            print(e)
-    
-    async def _arun(self, query: str) -> str:
-        """Use the tool asynchronously."""
-        raise NotImplementedError("BingSearchTool does not support async")
\ No newline at end of file
+def normalize_sql(command: str) -> str:
+    """Folds whitespace runs to one space and lowercases a SQL statement, leaving quoted literals untouched"""
+    parts = _SQL_LITERAL_REGEX.split(command.strip().rstrip(";").strip())
+    # re.split with a capture group puts the literals at the odd positions
+    return "".join(part if i % 2 else _WHITESPACE_REGEX.sub(" ", part).lower() for i, part in enumerate(parts))
+
+
+def is_read_only_sql(normalized_command: str) -> bool:
+    """True for a SELECT (or WITH ... SELECT) that writes nothing, judged outside literals"""
+    code = " ".join(_SQL_LITERAL_REGEX.split(normalized_command)[::2])
+    return bool(_SQL_READ_ONLY_REGEX.match(code)) and not _SQL_WRITE_REGEX.search(code)
+
+
+def sql_identifiers(normalized_command: str) -> set:
+    """Returns the (lowercase) identifiers used outside literals in a normalized SQL statement"""
+    code = " ".join(_SQL_LITERAL_REGEX.split(normalized_command)[::2])
+    return set(_SQL_IDENTIFIER_REGEX.findall(code))
+
+
+# Engines are process-wide, one per database URL (the reflected databases are in tools.py)
+_sql_engines = dict()
+_sql_lock = threading.Lock()
+
+
+def get_sql_engine(db_url: Union[str, URL], pool_size: int = 5, max_overflow: int = 10,
+                   pool_recycle: int = 1800) -> Engine:
+    """Returns a long-lived, pooled engine for the given URL (created once per URL)"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.engine.url import make_url
+
+    db_url = make_url(db_url)
+    key = str(db_url)
+    with _sql_lock:
+        if key not in _sql_engines:
+            engine_args = {"pool_pre_ping": True}
+            # SQLite stand-ins use SingletonThreadPool/NullPool, which do not take sizing arguments
+            if db_url.get_backend_name() != "sqlite":
+                engine_args.update(pool_size=pool_size, max_overflow=max_overflow, pool_recycle=pool_recycle)
+            _sql_engines[key] = create_engine(db_url, **engine_args)
+        return _sql_engines[key]
+
+
+# Tool and LLM metrics, exposed by the backend on /metrics
+TOOL_LATENCY = Histogram("tool_duration_seconds", "Duration of tool runs", ["tool"])
+TOOL_ERRORS = Counter("tool_errors_total", "Failed tool runs and attempts", ["tool"])
+LLM_RETRIES = Counter("llm_retries_total", "OpenAI calls retried by LangChain after throttling or errors", ["reason"])
+EXTRACTIVE_ANSWERS = Counter("extractive_answers_total", "Questions that were (hit) or were not (miss) answered with an extractive answer of Azure Search", ["source", "outcome"])
+logging.getLogger("langchain").addHandler(RetryLogCounter(LLM_RETRIES))
+
+register_cache("dataframes", _dataframe_cache)
+register_cache("query_embeddings", _query_embedding_cache)
+register_cache("search_results", _search_results_cache)
+register_cache("sentence_embeddings", _sentence_embedding_cache)
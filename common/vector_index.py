@@ -0,0 +1,353 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set
+
+import numpy as np
+
+
+# Below this many vectors an exact search over the memory-mapped vectors is both faster to build and good enough
+MIN_VECTORS_FOR_IVF = 10000
+MAX_TRAINING_VECTORS = 100000
+
+# File naming the version directory readers open, swapped atomically when a build finishes
+CURRENT_FILE = "CURRENT"
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def default_embed_documents(texts: List[str]) -> List[List[float]]:
+    from langchain.embeddings import OpenAIEmbeddings
+    return OpenAIEmbeddings(deployment="text-embedding-ada-002", chunk_size=1).embed_documents(texts)
+
+
+def current_version_path(path: str) -> Optional[str]:
+    """Directory holding the files of the index at `path`, or None if it was never built.
+
+    Builds write a new version directory and then point CURRENT at it; indexes written
+    before versioning keep their files directly in `path`.
+    """
+    try:
+        with open(os.path.join(path, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return os.path.join(path, f.read().strip())
+    except FileNotFoundError:
+        return path if os.path.exists(os.path.join(path, "index.faiss")) else None
+
+
+class _Version:
+    """The opened files of one version of a LocalVectorIndex"""
+
+    def __init__(self, path: str, nprobe: Optional[int] = None):
+        import faiss
+
+        self.path = path
+        self.db = sqlite3.connect(os.path.join(path, "chunks.db"), check_same_thread=False)
+        meta = dict(self.db.execute("SELECT key, value FROM meta").fetchall())
+        self.count = int(meta["count"])
+        dimension = int(meta.get("dimension") or 0)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(chunks)")}
+        # Indexes built before the doc_id and location columns only have them in the metadata
+        self.id_column = "doc_id" if "doc_id" in columns else "json_extract(metadata, '$.id')"
+        self.location_column = "location" if "location" in columns else "json_extract(metadata, '$.metadata_storage_path')"
+
+        self.index = None
+        if os.path.exists(os.path.join(path, "index.faiss")):
+            self.index = faiss.read_index(os.path.join(path, "index.faiss"), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            if hasattr(self.index, "nprobe"):
+                self.index.nprobe = nprobe or int(meta.get("nprobe", 16))
+        self.vectors = None
+        if self.count:
+            self.vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r",
+                                     shape=(self.count, dimension))
+
+    def search(self, query: np.ndarray, k: int) -> List[tuple]:
+        if self.index is not None:
+            similarities, ids = self.index.search(query[None, :], k)
+            return [(float(similarity), int(faiss_id)) for similarity, faiss_id in zip(similarities[0], ids[0])
+                    if faiss_id >= 0]
+        if self.vectors is None:
+            return []
+        # Small corpus: exact search straight over the memory-mapped vectors
+        similarities = self.vectors @ query
+        top = np.argpartition(-similarities, k - 1)[:k] if k < len(similarities) else np.arange(len(similarities))
+        top = top[np.argsort(-similarities[top], kind="stable")]
+        return [(float(similarities[i]), int(i)) for i in top]
+
+
+class LocalVectorIndex:
+    """Persistent ANN index over corpus chunks, opened lazily and memory-mapped.
+
+    Each build writes a version directory under `path`, which holds:
+    - index.faiss: inner-product IVF index whose inverted lists are memory-mapped (only for
+      corpora of at least MIN_VECTORS_FOR_IVF chunks; smaller ones are searched exactly)
+    - vectors.f32: the normalized float32 vectors, memory-mapped, row i being faiss id i
+    - chunks.db: SQLite table with the metadata of each chunk by faiss id and content hash
+
+    CURRENT names the version directory to open. Open indexes check it every
+    `reload_interval` seconds and switch to a newer build.
+    """
+
+    def __init__(self, path: str, nprobe: Optional[int] = None, reload_interval: float = 5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._nprobe = nprobe
+        self._version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _open(self) -> Optional[_Version]:
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is not None and now - self._checked_at < self.reload_interval:
+                return self._version
+            self._checked_at = now
+            version_path = current_version_path(self.path)
+            if version_path is None:
+                self._version = None
+            elif self._version is None or self._version.path != version_path:
+                self._version = _Version(version_path, self._nprobe)
+            return self._version
+
+    def __len__(self) -> int:
+        version = self._open()
+        return version.count if version is not None else 0
+
+    def _rows(self, version: _Version, query: str, args: Sequence[Any]) -> List[tuple]:
+        with self._lock:
+            return version.db.execute(query, args).fetchall()
+
+    def _rows_in(self, version: _Version, query: str, values: Sequence[Any]) -> List[tuple]:
+        """Runs `query`, whose IN list is written {}, in batches of `values`"""
+        rows = []
+        for start in range(0, len(values), 500):
+            batch = values[start:start + 500]
+            rows.extend(self._rows(version, query.format(",".join("?" * len(batch))), batch))
+        return rows
+
+    def search(self, vector: List[float], k: int = 10) -> List[Dict[str, Any]]:
+        """Returns the metadata of the `k` chunks most similar to `vector`, with their similarity"""
+        version = self._open()
+        if version is None or not k:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        results = []
+        for similarity, faiss_id in version.search(query, k):
+            rows = self._rows(version, "SELECT metadata FROM chunks WHERE faiss_id = ?", (faiss_id,))
+            if rows:
+                results.append({**json.loads(rows[0][0]), "similarity": similarity})
+        return results
+
+    def similarities(self, vector: List[float], texts: List[str]) -> List[Optional[float]]:
+        """Cosine similarity of `vector` to each text from the stored vectors, None for texts not in the index"""
+        hashes = [content_hash(text) for text in texts]
+        vectors = self.vectors_by_hash(hashes)
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        return [float(vectors[h] @ query) if h in vectors else None for h in hashes]
+
+    def vectors_by_hash(self, hashes: Sequence[str]) -> Dict[str, np.ndarray]:
+        """Stored vectors of the chunks with these content hashes, by hash"""
+        version = self._open()
+        if version is None or not version.count:
+            return {}
+        rows = self._rows_in(version, "SELECT content_hash, faiss_id FROM chunks WHERE content_hash IN ({})", list(set(hashes)))
+        return {text_hash: version.vectors[faiss_id] for text_hash, faiss_id in rows}
+
+    def contains_ids(self, ids: Sequence[str]) -> Set[str]:
+        """The document ids among `ids` that have a chunk in the index"""
+        version = self._open()
+        if version is None:
+            return set()
+        return {row[0] for row in self._rows_in(version, f"SELECT {version.id_column} FROM chunks "
+                                                         f"WHERE {version.id_column} IN ({{}})", list(ids))}
+
+    def locations(self) -> Set[str]:
+        """metadata_storage_path of every file with chunks in the index"""
+        version = self._open()
+        if version is None:
+            return set()
+        return {row[0] for row in self._rows(version, f"SELECT DISTINCT {version.location_column} FROM chunks", ())}
+
+    def iter_chunks(self, batch_size: int = 1000) -> Iterable[tuple]:
+        """Yields (content_hash, metadata JSON, vector) for every chunk of the index"""
+        version = self._open()
+        if version is None:
+            return
+        for start in range(0, version.count, batch_size):
+            rows = self._rows(version, "SELECT faiss_id, content_hash, metadata FROM chunks "
+                                       "WHERE faiss_id >= ? AND faiss_id < ? ORDER BY faiss_id", (start, start + batch_size))
+            for faiss_id, text_hash, metadata in rows:
+                yield text_hash, metadata, version.vectors[faiss_id]
+
+
+class LocalVectorIndexBuilder:
+    """Builds a LocalVectorIndex from cogsrch-index-files documents (dicts with id and content).
+
+    Vectors are appended to disk as they are embedded, so memory does not grow with the
+    corpus; `finalize()` trains the index and writes it. The build goes to a new version
+    directory that replaces the previous one atomically, so open readers are not disturbed.
+    Chunks already in the previous version are not embedded again, and `keep_previous()`
+    carries over the files that were not parsed in this run (incremental ingestion).
+    """
+
+    def __init__(self, path: str, embed_documents: Callable[[List[str]], List[List[float]]] = default_embed_documents,
+                 batch_size: int = 16):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.embed_documents = embed_documents
+        self.batch_size = batch_size
+        self.count = 0
+        self.dimension = None
+        self.previous = LocalVectorIndex(path, reload_interval=float("inf"))
+        self._pending = []
+        self._seen = set()
+        self._replaced_locations = set()
+        # Built in a directory of its own, which becomes a version directory once complete
+        self._build_id = uuid.uuid4().hex[:8]
+        self.build_path = os.path.join(path, f".build-{self._build_id}")
+        os.makedirs(self.build_path)
+        self._vectors_file = open(os.path.join(self.build_path, "vectors.f32"), "ab")
+        self._db = sqlite3.connect(os.path.join(self.build_path, "chunks.db"))
+        self._db.execute("CREATE TABLE chunks (faiss_id INTEGER PRIMARY KEY, content_hash TEXT, metadata TEXT, "
+                         "doc_id TEXT, location TEXT)")
+        self._db.execute("CREATE INDEX chunks_content_hash ON chunks (content_hash)")
+        self._db.execute("CREATE INDEX chunks_doc_id ON chunks (doc_id)")
+        self._db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def add(self, document: Dict[str, Any]) -> None:
+        text_hash = content_hash(document["content"])
+        if text_hash in self._seen:
+            return
+        self._seen.add(text_hash)
+        self._pending.append(document)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def add_file(self, location: str, documents: List[Dict[str, Any]]) -> None:
+        """Adds the chunks of a parsed file, which replace its chunks in the previous version"""
+        self._replaced_locations.add(location)
+        for document in documents:
+            self.add(document)
+
+    def _write(self, vectors: np.ndarray, rows: List[tuple]) -> None:
+        self.dimension = vectors.shape[1]
+        self._vectors_file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        self._db.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?)",
+                             [(self.count + i,) + row for i, row in enumerate(rows)])
+        self.count += len(rows)
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        hashes = [content_hash(document["content"]) for document in self._pending]
+        reused = self.previous.vectors_by_hash(hashes)
+        missing = [i for i, text_hash in enumerate(hashes) if text_hash not in reused]
+        embedded = None
+        if missing:
+            embedded = np.asarray(self.embed_documents([self._pending[i]["content"] for i in missing]), dtype=np.float32)
+            embedded /= np.maximum(np.linalg.norm(embedded, axis=1, keepdims=True), 1e-12)
+        dimension = embedded.shape[1] if embedded is not None else len(next(iter(reused.values())))
+        vectors = np.empty((len(hashes), dimension), dtype=np.float32)
+        if embedded is not None:
+            vectors[missing] = embedded
+        for i, text_hash in enumerate(hashes):
+            if text_hash in reused:
+                vectors[i] = reused[text_hash]
+
+        rows = []
+        for document, text_hash in zip(self._pending, hashes):
+            metadata = {key: document.get(key) for key in ("id", "title", "content", "language",
+                                                           "metadata_storage_name", "metadata_storage_path")}
+            rows.append((text_hash, json.dumps(metadata), metadata["id"], metadata["metadata_storage_path"]))
+        self._write(vectors, rows)
+        self._pending = []
+
+    def keep_previous(self, skip_locations: Iterable[str] = ()) -> None:
+        """Copies the chunks of the previous version, except those of the files added with
+        add_file() and of `skip_locations` (removed files)"""
+        self.flush()
+        skip_locations = self._replaced_locations.union(skip_locations)
+        vectors, rows = [], []
+        for text_hash, metadata, vector in self.previous.iter_chunks():
+            parsed = json.loads(metadata)
+            if parsed.get("metadata_storage_path") in skip_locations or text_hash in self._seen:
+                continue
+            self._seen.add(text_hash)
+            vectors.append(vector)
+            rows.append((text_hash, metadata, parsed.get("id"), parsed.get("metadata_storage_path")))
+            if len(rows) >= 1000:
+                self._write(np.asarray(vectors), rows)
+                vectors, rows = [], []
+        if rows:
+            self._write(np.asarray(vectors), rows)
+
+    def finalize(self, nlist: Optional[int] = None, nprobe: int = 16) -> None:
+        """Embeds what is left, trains the index on a sample of the vectors, writes it and makes it current"""
+        import faiss
+
+        self.flush()
+        self._vectors_file.close()
+        if self.count >= MIN_VECTORS_FOR_IVF:
+            vectors = np.memmap(os.path.join(self.build_path, "vectors.f32"), dtype=np.float32, mode="r",
+                                shape=(self.count, self.dimension))
+            # faiss wants ~39 training points per centroid
+            nlist = nlist or min(int(4 * np.sqrt(self.count)), self.count // 39)
+            index = faiss.IndexIVFFlat(faiss.IndexFlatIP(self.dimension), self.dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+            sample = np.random.default_rng(0).choice(self.count, size=min(self.count, MAX_TRAINING_VECTORS), replace=False)
+            index.train(np.ascontiguousarray(vectors[np.sort(sample)]))
+            for start in range(0, self.count, 100000):
+                index.add(np.ascontiguousarray(vectors[start:start + 100000]))
+            faiss.write_index(index, os.path.join(self.build_path, "index.faiss"))
+            del vectors
+
+        self._db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                             [("dimension", str(self.dimension or 0)), ("count", str(self.count)), ("nprobe", str(nprobe))])
+        self._db.commit()
+        self._db.close()
+
+        version = f"v-{time.strftime('%Y%m%d%H%M%S')}-{self._build_id}"
+        version_path = os.path.join(self.path, version)
+        os.rename(self.build_path, version_path)
+        previous_path = current_version_path(self.path)
+        tmp_path = os.path.join(self.path, f"{CURRENT_FILE}.{self._build_id}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(tmp_path, os.path.join(self.path, CURRENT_FILE))
+        self._remove_old_versions(keep={version_path, previous_path})
+
+    def _remove_old_versions(self, keep: Set[str]) -> None:
+        # The version replaced now is kept for readers still switching over; older ones are
+        # removed (POSIX keeps the files of readers that have them mapped until they close them)
+        for name in os.listdir(self.path):
+            version_path = os.path.join(self.path, name)
+            if name.startswith("v-") and os.path.isdir(version_path) and version_path not in keep:
+                shutil.rmtree(version_path, ignore_errors=True)
+        if self.path not in keep:
+            # Files of an index built before versioning
+            for name in ("vectors.f32", "index.faiss", "chunks.db"):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+
+_local_vector_indexes = dict()
+_local_vector_indexes_lock = threading.Lock()
+
+
+def get_local_vector_index(path: str) -> Optional[LocalVectorIndex]:
+    """Returns the process-wide LocalVectorIndex at `path` (opened on first search), or None if it was never built"""
+    if current_version_path(path) is None:
+        return None
+    with _local_vector_indexes_lock:
+        if path not in _local_vector_indexes:
+            _local_vector_indexes[path] = LocalVectorIndex(path)
+        return _local_vector_indexes[path]
@@ -0,0 +1,60 @@
+import os
+import re
+import sys
+
+import pytest
+import tiktoken
+
+# The tests import the shared code as the notebooks do: from common.<module> import ...
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubEncoding:
+    """Offline stand-in for a tiktoken encoding: one token per word, each with the whitespace
+    before it, so decoding gives back the exact text (and its offsets)"""
+
+    _TOKEN_REGEX = re.compile(r"\s*\S+|\s+")
+
+    def __init__(self):
+        self._ids = dict()
+        self._pieces = []
+        self.encode_calls = 0
+
+    def encode(self, text, **kwargs):
+        self.encode_calls += 1
+        tokens = []
+        for piece in self._TOKEN_REGEX.findall(text):
+            if piece not in self._ids:
+                self._ids[piece] = len(self._pieces)
+                self._pieces.append(piece)
+            tokens.append(self._ids[piece])
+        return tokens
+
+    def decode(self, tokens):
+        return "".join(self._pieces[token] for token in tokens)
+
+    def decode_with_offsets(self, tokens):
+        starts, position = [], 0
+        for token in tokens:
+            starts.append(position)
+            position += len(self._pieces[token])
+        return self.decode(tokens), starts
+
+
+@pytest.fixture
+def stub_encoding(monkeypatch):
+    """Replaces tiktoken.get_encoding, which downloads the BPE files on first use"""
+    encoding = StubEncoding()
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: encoding)
+    return encoding
+
+
+@pytest.fixture
+def standins():
+    """Local HTTP stand-in for Azure Search, Azure OpenAI and Bing (benchmarks/standins.py), without latency"""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+    from standins import StandInServer
+
+    server = StandInServer(latency_scale=0).start()
+    yield server
+    server.stop()
@@ -0,0 +1,104 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from common import batch_qa
+from common.batch_qa import BatchAnswerer, answered_ids, read_questions
+
+
+def search_results(query):
+    return [{"value": [{"id": query, "title": "paper", "pages": [f"Text about {query}."], "language": "en",
+                        "@search.rerankerScore": 3.0, "@search.captions": [{"text": "caption"}],
+                        "metadata_storage_name": "paper.pdf", "metadata_storage_path": "https://blob/paper.pdf"}]}]
+
+
+@pytest.fixture
+def services(monkeypatch, stub_encoding):
+    """Stands in for Azure Search and the answer LLM; questions in `failing` raise in the search"""
+    state = SimpleNamespace(failing=set(), searched=[], search_seconds=0.0)
+
+    def get_search_results(query, indexes, k):
+        state.searched.append(query)
+        time.sleep(state.search_seconds)
+        if query in state.failing:
+            raise ConnectionError("search unavailable")
+        return search_results(query)
+
+    def get_answer(llm, docs, query, language, chain_type):
+        return {"output_text": f"Answer to {query}. Sources: https://blob/paper.pdf"}
+
+    monkeypatch.setattr(batch_qa, "get_search_results", get_search_results)
+    monkeypatch.setattr(batch_qa, "get_answer", get_answer)
+    return state
+
+
+@pytest.fixture
+def answerer():
+    return BatchAnswerer(SimpleNamespace(deployment_name="gpt-35-turbo"), ["cogsrch-index-files"],
+                         search_concurrency=2, answer_concurrency=2)
+
+
+def items(*questions):
+    return [{"id": question, "question": question} for question in questions]
+
+
+def records(path):
+    """Output records, without the partial line of an interrupted run"""
+    parsed = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                parsed.append(json.loads(line))
+            except ValueError:
+                continue
+    return parsed
+
+
+def test_answer_record(services, answerer):
+    record = answerer.answer(items("what is rag")[0])
+    assert record["answer"] == "Answer to what is rag." and record["sources"] == ["https://blob/paper.pdf"]
+    assert record["chain_type"] == "stuff" and record["error"] is None
+    assert {"search", "order", "tokens", "answer", "total"} <= set(record["timings"])
+
+
+def test_run_resumes_and_retries_only_the_failed_questions(services, answerer, tmp_path):
+    output = str(tmp_path / "answers.jsonl")
+    services.failing = {"q2"}
+    stats = answerer.run(items("q1", "q2", "q3"), output, verbose=False)
+    assert stats == {"skipped": 0, "answered": 2, "errors": 1, "seconds": stats["seconds"]}
+    assert answered_ids(output) == {"q1", "q3"}
+
+    # An interrupted run leaves a partial last line, which is ignored
+    with open(output, "a", encoding="utf-8") as f:
+        f.write('{"id": "q4", "ques')
+    services.failing, services.searched = set(), []
+    stats = answerer.run(items("q1", "q2", "q3", "q4"), output, verbose=False)
+    assert stats["skipped"] == 2 and stats["answered"] == 2 and stats["errors"] == 0
+    assert sorted(services.searched) == ["q2", "q4"]
+    assert answered_ids(output) == {"q1", "q2", "q3", "q4"}
+    assert [record["id"] for record in records(output) if record["error"]] == ["q2"]
+
+
+def test_total_time_includes_the_waits_for_a_slot(services, tmp_path):
+    services.search_seconds = 0.2
+    answerer = BatchAnswerer(SimpleNamespace(deployment_name="gpt-35-turbo"), ["cogsrch-index-files"],
+                             search_concurrency=1, answer_concurrency=1)
+    output = str(tmp_path / "answers.jsonl")
+    answerer.run(items("q1", "q2", "q3"), output, verbose=False)
+    timings = [record["timings"] for record in records(output)]
+    # One search at a time: the last question waited for the other two
+    assert max(t["total"] for t in timings) >= 0.55
+    assert all(t["total"] >= t["search"] + t["answer"] for t in timings)
+
+
+def test_read_questions(tmp_path):
+    text = tmp_path / "questions.txt"
+    text.write_text("What is RAG?\n\n  Why chunk?  \n")
+    assert [item["question"] for item in read_questions(str(text))] == ["What is RAG?", "Why chunk?"]
+
+    jsonl = tmp_path / "questions.jsonl"
+    jsonl.write_text('{"id": 7, "question": "a"}\n{"question": "b"}\n')
+    ids = [item["id"] for item in read_questions(str(jsonl))]
+    assert ids[0] == "7" and ids[1] == batch_qa.question_id("b")
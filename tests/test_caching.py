@@ -0,0 +1,211 @@
+import multiprocessing
+import threading
+import time
+import uuid
+
+import pytest
+
+from common.caching import SingleFlight, SQLiteCache, TTLCache, make_cache
+
+
+def test_ttl_cache_evicts_the_least_recently_used_entry():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache and cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_ttl_cache_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = TTLCache(ttl=10)
+    cache.set("default", 1)
+    cache.set("short", 2, ttl=1)
+    now[0] += 5
+    assert cache.get("default") == 1 and cache.get("short") is None
+    now[0] += 5
+    assert cache.get("default") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_ttl_cache_invalidate_and_get_or_set():
+    cache = TTLCache()
+    cache.set(("sql", "covid"), 1)
+    cache.set(("sql", "other"), 2)
+    assert cache.invalidate(lambda key: key[1] == "covid") == 1
+    assert cache.get_or_set(("sql", "covid"), lambda: 3) == 3
+    assert cache.get_or_set(("sql", "covid"), lambda: 4) == 3
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "cache.sqlite3")
+
+
+def test_sqlite_cache_is_shared_by_the_processes(cache_path):
+    cache = SQLiteCache(cache_path, "search_results")
+    cache.set(("index", "what is rag", 5), {"value": [1, 2]})
+
+    def worker():
+        # A process with its own instance of the cache, as each gunicorn worker has
+        other = SQLiteCache(cache_path, "search_results")
+        assert other.get(("index", "what is rag", 5)) == {"value": [1, 2]}
+        other.set(("index", "why chunk", 5), {"value": [3]})
+
+    process = multiprocessing.get_context("fork").Process(target=worker)
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert cache.get(("index", "why chunk", 5)) == {"value": [3]}
+    assert len(cache) == 2 and (cache.hits, cache.misses) == (1, 0)
+    # Caches in the same file are kept apart by name
+    assert SQLiteCache(cache_path, "bing").get(("index", "why chunk", 5)) is None
+
+
+def test_sqlite_cache_entries_expire(cache_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    cache = SQLiteCache(cache_path, "bing", ttl=10)
+    cache.set("default", 1)
+    cache.set("short", 2, ttl=1)
+    now[0] += 5
+    assert cache.get("default") == 1 and cache.get("short") is None and len(cache) == 1
+    now[0] += 5
+    assert cache.get("default") is None and cache.pop("default") is None
+
+
+def test_sqlite_cache_evicts_the_least_recently_used_entry(cache_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    cache = SQLiteCache(cache_path, "embeddings", maxsize=2)
+    for key in ("a", "b"):
+        cache.set(key, key.upper())
+        now[0] += 2
+    assert cache.get("a") == "A"
+    now[0] += 2
+    cache.set("c", "C")
+    assert "b" not in cache and cache.get("a") == "A" and cache.get("c") == "C"
+
+
+def test_sqlite_cache_invalidate_matches_the_original_keys(cache_path):
+    cache = SQLiteCache(cache_path, "sql_queries")
+    # Keys of CachedSQLDatabase: (normalized SQL, fetch, tables read)
+    cache.set(("select * from covid", "all", frozenset({"covid"})), "rows")
+    cache.set(("select * from covid join states", "all", frozenset({"covid", "states"})), "rows")
+    cache.set(("select * from other", "all", frozenset({"other"})), "rows")
+    assert cache.invalidate(lambda key: "covid" in key[2]) == 2
+    assert len(cache) == 1
+    assert cache.get_or_set(("select * from other", "all", frozenset({"other"})), lambda: "new") == "rows"
+    assert cache.pop(("select * from other", "all", frozenset({"other"}))) == "rows" and len(cache) == 0
+
+
+def test_make_cache(cache_path, monkeypatch):
+    monkeypatch.delenv("SHARED_CACHE_PATH", raising=False)
+    assert isinstance(make_cache("local"), TTLCache)
+    monkeypatch.setenv("SHARED_CACHE_PATH", cache_path)
+    cache = make_cache("shared", maxsize=3, ttl=60)
+    assert isinstance(cache, SQLiteCache) and cache.shared and (cache.maxsize, cache.ttl) == (3, 60)
+
+
+def run_concurrently(flight, key, func, callers):
+    results, errors = [], []
+
+    def call():
+        try:
+            results.append(flight.do(key, func))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def test_single_flight_shares_one_call_between_concurrent_callers():
+    flight, calls, release = SingleFlight(), [], threading.Event()
+
+    def slow():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    threads, results, errors = run_concurrently(flight, "key", slow, callers=5)
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert results == ["result"] * 5 and errors == []
+
+    # Once the call is done the next caller runs it again
+    assert flight.do("key", lambda: "again") == "again"
+
+
+def test_single_flight_shares_the_error():
+    flight, release = SingleFlight(), threading.Event()
+
+    def failing():
+        release.wait(5)
+        raise RuntimeError("service unavailable")
+
+    threads, results, errors = run_concurrently(flight, "key", failing, callers=3)
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == [] and len(errors) == 3 and len({id(e) for e in errors}) == 1
+
+
+@pytest.fixture
+def bing_calls(monkeypatch):
+    from common.utils import BingSearchResults
+
+    calls = []
+
+    def search(self, query):
+        calls.append(query)
+        time.sleep(0.1)
+        return [{"snippet": f"about {query}", "link": "https://example.com"}]
+
+    monkeypatch.setattr(BingSearchResults, "_search", search)
+    return calls
+
+
+def test_bing_results_are_cached_by_normalized_query(bing_calls):
+    from common.utils import BingSearchResults
+
+    query = f"Weather {uuid.uuid4().hex}"
+    tool = BingSearchResults(k=3)
+    first = tool.run(query)
+    assert tool.run("  " + query.lower() + " ") == first
+    assert bing_calls == [query]
+
+    # k is part of the key
+    BingSearchResults(k=5).run(query)
+    assert len(bing_calls) == 2
+
+
+def test_bing_results_expire_after_the_cache_ttl(bing_calls):
+    from common.utils import BingSearchResults
+
+    query = f"news {uuid.uuid4().hex}"
+    tool = BingSearchResults(cache_ttl=0)
+    tool.run(query)
+    tool.run(query)
+    assert len(bing_calls) == 2
+
+
+def test_concurrent_identical_bing_queries_make_one_call(bing_calls):
+    from common.utils import BingSearchResults
+
+    query = f"stocks {uuid.uuid4().hex}"
+    tool = BingSearchResults()
+    threads = [threading.Thread(target=tool.run, args=(query,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert bing_calls == [query]
@@ -0,0 +1,81 @@
+import math
+
+import pandas as pd
+import pytest
+
+from common.chunked_csv import ChunkedCSVDataset
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame({
+        "state": ["TX", "CA", "TX", "NY", "CA", "TX", "NY"],
+        "date": ["2020-07-01", "2020-07-02", "2020-07-15", "2020-08-01", "2020-07-20", "2020-07-31", "2020-07-05"],
+        "death": [1, 2, 3, 4, 5, 6, 7],
+    })
+
+
+@pytest.fixture
+def dataset(tmp_path, frame):
+    path = str(tmp_path / "covid.csv")
+    frame.to_csv(path, index=False)
+    # Chunks of two rows so every operation has to combine partial results
+    return ChunkedCSVDataset(path, chunksize=2)
+
+
+JULY = [("date", ">=", "2020-07-01"), ("date", "<=", "2020-07-31")]
+
+
+def test_columns_and_head(dataset):
+    assert dataset.columns == ["state", "date", "death"]
+    assert dataset.head(3)["death"].tolist() == [1, 2, 3]
+
+
+def test_select_filters_across_chunks(dataset, frame):
+    selected = dataset.select(["state", "death"], filters=[("state", "in", ["TX", "NY"])] + JULY)
+    expected = frame[frame.state.isin(["TX", "NY"]) & frame.date.between("2020-07-01", "2020-07-31")]
+    assert list(selected.columns) == ["state", "death"]
+    assert selected["death"].tolist() == expected["death"].tolist() == [1, 3, 6, 7]
+
+
+def test_select_stops_at_the_limit(dataset):
+    assert dataset.select(filters=[("state", "!=", "CA")], limit=3)["death"].tolist() == [1, 3, 4]
+
+
+def test_select_without_matches_keeps_the_columns(dataset):
+    selected = dataset.select(["state"], filters=[("state", "==", "WA")])
+    assert selected.empty and list(selected.columns) == ["state"]
+
+
+def test_select_rejects_unknown_columns_and_operators(dataset):
+    with pytest.raises(KeyError):
+        dataset.select(["population"])
+    with pytest.raises(ValueError):
+        dataset.select(["state"], filters=[("death", "~", 1)])
+
+
+def test_aggregate_without_group_by_matches_pandas(dataset, frame):
+    result = dataset.aggregate({"death": ["sum", "count", "min", "max", "mean"]}, filters=JULY)
+    july = frame[frame.date.between("2020-07-01", "2020-07-31")]["death"]
+    assert result.to_dict() == {"death_sum": july.sum(), "death_count": july.count(), "death_min": july.min(),
+                                "death_max": july.max(), "death_mean": july.mean()}
+
+
+def test_aggregate_with_group_by_matches_pandas(dataset, frame):
+    result = dataset.aggregate({"death": ["sum", "mean"]}, group_by="state")
+    expected = frame.groupby("state")["death"].agg(["sum", "mean"])
+    assert result["death_sum"].to_dict() == expected["sum"].to_dict()
+    assert result["death_mean"].to_dict() == pytest.approx(expected["mean"].to_dict())
+
+
+def test_aggregate_without_matches(dataset):
+    result = dataset.aggregate({"death": ["sum", "mean"]}, filters=[("state", "==", "WA")])
+    assert result["death_sum"] == 0 and math.isnan(result["death_mean"])
+
+    grouped = dataset.aggregate({"death": "sum"}, filters=[("state", "==", "WA")], group_by="state")
+    assert grouped.empty and list(grouped.columns) == ["death_sum"]
+
+
+def test_aggregate_rejects_unknown_aggregations(dataset):
+    with pytest.raises(ValueError):
+        dataset.aggregate({"death": "median"})
@@ -0,0 +1,46 @@
+from common.utils import chunk_offsets
+
+
+def chunks(text, offsets):
+    return [text[start:end] for start, end in offsets]
+
+
+def test_short_text_is_one_chunk_without_surrounding_whitespace():
+    text = "  Hello world.  \n"
+    assert chunks(text, chunk_offsets(text, chunk_size=100)) == ["Hello world."]
+
+
+def test_empty_and_blank_text_have_no_chunks():
+    assert chunk_offsets("", chunk_size=10) == []
+    assert chunk_offsets(" \n\n ", chunk_size=10) == []
+
+
+def test_chunks_end_at_the_highest_priority_separator():
+    text = "First paragraph, part one.\n\nSecond paragraph here."
+    assert chunks(text, chunk_offsets(text, chunk_size=40)) == ["First paragraph, part one.", "Second paragraph here."]
+
+
+def test_punctuation_stays_with_its_chunk():
+    text = "One sentence here. Another sentence there."
+    assert chunks(text, chunk_offsets(text, chunk_size=25)) == ["One sentence here.", "Another sentence there."]
+
+
+def test_chunks_fit_and_cover_every_word():
+    text = " ".join(f"word{i}" for i in range(200))
+    offsets = chunk_offsets(text, chunk_size=50)
+    assert all(end - start <= 50 for start, end in offsets)
+    assert " ".join(chunks(text, offsets)).split() == text.split()
+    assert offsets == sorted(offsets)
+
+
+def test_text_without_separators_is_cut_at_the_size():
+    text = "x" * 25
+    assert chunks(text, chunk_offsets(text, chunk_size=10)) == ["x" * 10, "x" * 10, "x" * 5]
+
+
+def test_chunk_size_in_tokens(stub_encoding):
+    # The stub encoding has one token per word
+    text = "a b c d e. f g h i j k l"
+    pieces = chunks(text, chunk_offsets(text, chunk_size=6, encoding_name="cl100k_base"))
+    assert pieces == ["a b c d e.", "f g h i j", "k l"]
+    assert all(len(stub_encoding.encode(piece)) <= 6 for piece in pieces)
@@ -0,0 +1,84 @@
+import pytest
+from langchain.docstore.document import Document
+
+from common.compression import (SPAN_SEPARATOR, bm25_scores, compress_docs, compression_tokens_from_env,
+                                split_sentences)
+
+
+CHUNK = ("The index is rebuilt every night. Queries are served from a replica. "
+         "Rebuilding the index takes about two hours on the largest cluster. "
+         "Billing is monthly.")
+
+
+@pytest.mark.parametrize("value, tokens", [(None, None), ("", None), ("0", None), ("250", 250)])
+def test_compression_tokens_from_env(monkeypatch, value, tokens):
+    if value is None:
+        monkeypatch.delenv("COMPRESSION_TOKENS_PER_DOC", raising=False)
+    else:
+        monkeypatch.setenv("COMPRESSION_TOKENS_PER_DOC", value)
+    assert compression_tokens_from_env() == tokens
+
+
+def test_doc_search_tool_reads_the_compression_settings_when_created(monkeypatch):
+    from langchain.chat_models import AzureChatOpenAI
+    from common.utils import DocSearchTool
+
+    llm = AzureChatOpenAI(deployment_name="gpt-35-turbo", openai_api_key="stand-in",
+                          openai_api_base="http://127.0.0.1:9", openai_api_version="2023-05-15")
+    monkeypatch.setenv("COMPRESSION_TOKENS_PER_DOC", "300")
+    monkeypatch.setenv("COMPRESSION_EMBEDDINGS", "1")
+    tool = DocSearchTool(llm=llm, indexes=["index"])
+    assert (tool.compression_tokens, tool.compression_embeddings) == (300, True)
+    monkeypatch.delenv("COMPRESSION_TOKENS_PER_DOC")
+    monkeypatch.delenv("COMPRESSION_EMBEDDINGS")
+    tool = DocSearchTool(llm=llm, indexes=["index"])
+    assert (tool.compression_tokens, tool.compression_embeddings) == (None, False)
+
+
+def test_split_sentences():
+    assert split_sentences("One. Two?  Three!\n\nFour\nfive") == ["One.", "Two?", "Three!", "Four", "five"]
+
+
+def test_bm25_favours_rare_query_words():
+    scores = bm25_scores("how long does rebuilding the index take", split_sentences(CHUNK))
+    assert max(range(len(scores)), key=scores.__getitem__) == 2
+    assert scores[3] == 0
+
+
+def test_docs_within_budget_are_unchanged(stub_encoding):
+    doc = Document(page_content=CHUNK, metadata={"source": "a"})
+    assert compress_docs([doc], "index", max_tokens_per_doc=100)[0] is doc
+
+
+def test_keeps_the_best_sentences_in_order_with_metadata(stub_encoding):
+    doc = Document(page_content=CHUNK, metadata={"source": "a", "score": 1})
+    compressed = compress_docs([doc], "how long does rebuilding the index take", max_tokens_per_doc=17)[0]
+    assert compressed.page_content == ("The index is rebuilt every night." + SPAN_SEPARATOR
+                                       + "Rebuilding the index takes about two hours on the largest cluster.")
+    assert compressed.metadata == doc.metadata and compressed.metadata is not doc.metadata
+
+
+def test_doc_without_matching_sentences_keeps_its_beginning(stub_encoding):
+    doc = Document(page_content=CHUNK, metadata={})
+    compressed = compress_docs([doc], "kubernetes autoscaling", max_tokens_per_doc=12)[0]
+    assert compressed.page_content == "The index is rebuilt every night. Queries are served from a replica."
+
+
+def test_single_long_sentence_is_truncated(stub_encoding):
+    doc = Document(page_content="word " * 50 + "end.", metadata={})
+    compressed = compress_docs([doc], "word", max_tokens_per_doc=10)[0]
+    assert len(stub_encoding.encode(compressed.page_content)) == 10
+
+
+def test_embeddings_score_sentences_of_every_doc_in_one_call(stub_encoding):
+    calls = []
+
+    def embed_texts(texts):
+        calls.append(list(texts))
+        return [[1.0, 0.0] if "Billing" in text else [0.0, 1.0] for text in texts]
+
+    docs = [Document(page_content=CHUNK, metadata={}), Document(page_content="Short one.", metadata={})]
+    compressed = compress_docs(docs, "invoices", max_tokens_per_doc=5,
+                               embed_query=lambda query: [1.0, 0.1], embed_texts=embed_texts)
+    assert len(calls) == 1 and len(calls[0]) == 5
+    assert [doc.page_content for doc in compressed] == ["Billing is monthly.", "Short one."]
@@ -0,0 +1,108 @@
+import logging
+import os
+
+import pandas as pd
+import pytest
+
+from common import utils
+from common.utils import load_csv_dataframe
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    utils._dataframe_cache.clear()
+    yield
+    utils._dataframe_cache.clear()
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = str(tmp_path / "covid.csv")
+    pd.DataFrame({"state": ["TX", "CA", "NY"], "death": [10, 20, 30]}).to_csv(path, index=False)
+    return path
+
+
+def rewrite(path, df):
+    """Rewrites the CSV with a later mtime, as an edit of the file would"""
+    mtime_ns = os.stat(path).st_mtime_ns
+    df.to_csv(path, index=False)
+    os.utime(path, ns=(mtime_ns + 10 ** 9, mtime_ns + 10 ** 9))
+
+
+def fail_read_csv(*args, **kwargs):
+    raise AssertionError("the CSV should not be parsed again")
+
+
+def test_dataframe_is_parsed_once_until_the_file_changes(csv_path):
+    df = load_csv_dataframe(csv_path)
+    assert load_csv_dataframe(csv_path) is df
+
+    rewrite(csv_path, pd.DataFrame({"state": ["WA"], "death": [1]}))
+    assert load_csv_dataframe(csv_path)["state"].tolist() == ["WA"]
+
+
+def test_pandas_kwargs_are_part_of_the_key(csv_path):
+    assert list(load_csv_dataframe(csv_path).columns) == ["state", "death"]
+    assert list(load_csv_dataframe(csv_path, pandas_kwargs={"usecols": ["death"]}).columns) == ["death"]
+
+
+@pytest.mark.parametrize("columnar_format", ["parquet", "feather"])
+def test_columnar_copy_is_read_back_after_a_restart(csv_path, monkeypatch, columnar_format):
+    df = load_csv_dataframe(csv_path, columnar_format=columnar_format)
+    assert os.path.exists(csv_path + "." + columnar_format)
+
+    # A new process: empty in-memory cache, the CSV must not be parsed again
+    utils._dataframe_cache.clear()
+    monkeypatch.setattr(pd, "read_csv", fail_read_csv)
+    pd.testing.assert_frame_equal(load_csv_dataframe(csv_path, columnar_format=columnar_format), df)
+
+
+def test_columnar_copy_keeps_the_index_and_is_named_after_the_kwargs(csv_path, monkeypatch):
+    kwargs = {"index_col": "state"}
+    df = load_csv_dataframe(csv_path, columnar_format="parquet", pandas_kwargs=kwargs)
+    assert df.index.name == "state"
+    columnar_files = [name for name in os.listdir(os.path.dirname(csv_path)) if name.endswith(".parquet")]
+    assert len(columnar_files) == 1 and columnar_files[0] != "covid.csv.parquet"
+
+    utils._dataframe_cache.clear()
+    monkeypatch.setattr(pd, "read_csv", fail_read_csv)
+    pd.testing.assert_frame_equal(load_csv_dataframe(csv_path, columnar_format="parquet", pandas_kwargs=kwargs), df)
+
+
+def test_stale_columnar_copy_is_not_used(csv_path):
+    load_csv_dataframe(csv_path, columnar_format="parquet")
+    rewrite(csv_path, pd.DataFrame({"state": ["WA"], "death": [1]}))
+    utils._dataframe_cache.clear()
+    assert load_csv_dataframe(csv_path, columnar_format="parquet")["state"].tolist() == ["WA"]
+
+
+def test_failed_columnar_write_is_logged_and_the_csv_used(csv_path, monkeypatch, caplog):
+    def fail_write(*args):
+        raise OSError("read-only file system")
+
+    monkeypatch.setattr(utils, "_write_columnar", fail_write)
+    with caplog.at_level(logging.WARNING, logger=utils.logger.name):
+        df = load_csv_dataframe(csv_path, columnar_format="parquet")
+    assert len(df) == 3
+    assert "Could not write" in caplog.text
+
+
+def test_unsupported_columnar_format(csv_path):
+    with pytest.raises(ValueError):
+        load_csv_dataframe(csv_path, columnar_format="orc")
+
+
+def test_every_agent_run_gets_fresh_locals_and_its_own_dataframe(csv_path):
+    from langchain.chat_models import AzureChatOpenAI
+    from common.utils import CSVTabularTool
+
+    llm = AzureChatOpenAI(deployment_name="gpt-35-turbo", openai_api_key="stand-in",
+                          openai_api_base="http://127.0.0.1:9", openai_api_version="2023-05-15")
+    tool = CSVTabularTool(path=csv_path, llm=llm)
+    first_locals = tool.get_agent_executor().tools[0].locals
+    first_locals["df"].drop(index=[0, 1], inplace=True)
+    first_locals["leftover"] = 1
+
+    second_locals = tool.get_agent_executor().tools[0].locals
+    assert len(second_locals["df"]) == 3 and "leftover" not in second_locals
+    assert len(load_csv_dataframe(csv_path)) == 3
@@ -0,0 +1,47 @@
+from langchain.docstore.document import Document
+
+from common.dedup import SimHashIndex, dedup_docs, hamming_distance, simhash
+
+
+TEXT = ("The model was trained on a large corpus of scientific papers and evaluated on question answering, "
+        "summarization and citation recommendation tasks, where it outperformed the previous baselines by a wide margin "
+        "while using fewer parameters and less training compute than comparable systems")
+
+
+def test_simhash_ignores_case_and_punctuation():
+    assert simhash(TEXT) == simhash(TEXT.upper().replace(",", " ;"))
+
+
+def test_simhash_of_near_duplicates_is_close():
+    edited = TEXT.replace("large corpus", "big corpus")
+    other = "Quarterly revenue grew in every region thanks to strong demand for cloud services and new enterprise contracts"
+    assert hamming_distance(simhash(TEXT), simhash(edited)) <= 8
+    assert hamming_distance(simhash(TEXT), simhash(other)) > 8
+
+
+def test_simhash_of_text_without_words_is_zero():
+    assert simhash("") == 0
+    assert simhash(" ... ") == 0
+
+
+def test_index_finds_fingerprints_within_the_distance():
+    index = SimHashIndex(max_distance=3)
+    index.add(0b1011, "a")
+    assert index.find(0b1011) == "a"
+    assert index.find(0b0100) is None
+    assert index.find(0b1011 ^ (1 << 63) ^ (1 << 20) ^ (1 << 40)) == "a"
+    assert index.find(0b1011 ^ (1 << 63) ^ (1 << 20) ^ (1 << 40) ^ (1 << 5)) is None
+
+
+def test_add_if_new_returns_the_existing_key():
+    index = SimHashIndex(max_distance=3)
+    assert index.add_if_new(12345, "first") is None
+    assert index.add_if_new(12345 ^ 1, "second") == "first"
+    assert index.find(12345 ^ 1) == "first"
+
+
+def test_dedup_docs_keeps_the_first_copy_in_order():
+    docs = [Document(page_content=TEXT, metadata={"source": "a"}),
+            Document(page_content="Something else entirely about the weather in spring", metadata={"source": "b"}),
+            Document(page_content=TEXT.replace("large corpus", "big corpus"), metadata={"source": "c"})]
+    assert [doc.metadata["source"] for doc in dedup_docs(docs)] == ["a", "b"]
@@ -0,0 +1,93 @@
+import pytest
+from langchain.chat_models import AzureChatOpenAI
+
+from common import tools
+from common.utils import EXTRACTIVE_ANSWERS, DocSearchTool, get_extractive_answers
+
+
+def result(id, reranker_score=3.0, language="en"):
+    return {"id": id, "title": f"Title of {id}", "pages": [f"Text of {id}."], "language": language,
+            "@search.rerankerScore": reranker_score, "@search.captions": [{"text": "caption"}],
+            "metadata_storage_name": f"{id}.pdf", "metadata_storage_path": f"https://blob/{id}.pdf"}
+
+
+def answer(key, score, text=None):
+    return {"key": key, "score": score, "text": text or f"Answer from {key}.", "highlights": None}
+
+
+def search_results(results, answers):
+    return {"value": results, "@search.answers": answers}
+
+
+def test_answers_are_filtered_by_score_and_sorted():
+    agg_search_results = [
+        search_results([result("a"), result("b", reranker_score=1.5), result("c")],
+                       [answer("a", 0.92), answer("b", 0.99), answer("c", 0.5), answer("missing", 0.99)]),
+        search_results([result("d")], [answer("d", 0.97)]),
+    ]
+    answers = get_extractive_answers(agg_search_results, min_score=0.9, min_reranker_score=2)
+    assert [a["text"] for a in answers] == ["Answer from d.", "Answer from a."]
+    assert answers[0] == {"text": "Answer from d.", "score": 0.97, "title": "Title of d", "name": "d.pdf",
+                          "location": "https://blob/d.pdf", "language": "en"}
+
+
+def test_answers_are_filtered_by_language():
+    agg_search_results = [search_results([result("en", language="en-us"), result("es", language="es"),
+                                          result("unknown", language=None)],
+                                         [answer("en", 0.95), answer("es", 0.96), answer("unknown", 0.97)])]
+    assert [a["name"] for a in get_extractive_answers(agg_search_results, language="en")] == ["en.pdf"]
+    assert [a["name"] for a in get_extractive_answers(agg_search_results, language="es")] == ["es.pdf"]
+    assert len(get_extractive_answers(agg_search_results)) == 3
+
+
+def test_results_without_answers():
+    assert get_extractive_answers([{"value": [result("a")]}, {"value": [], "@search.answers": None}]) == []
+
+
+@pytest.fixture
+def llm():
+    return AzureChatOpenAI(deployment_name="gpt-35-turbo", openai_api_key="stand-in",
+                           openai_api_base="http://127.0.0.1:9", openai_api_version="2023-05-15")
+
+
+@pytest.fixture
+def searched(monkeypatch, stub_encoding):
+    """The tool's search returns an answer scoring 0.95 from an English document; the LLM answer is stubbed"""
+    monkeypatch.setenv("DATASOURCE_SAS_TOKEN", "?sas")
+    monkeypatch.delenv("EXTRACTIVE_ANSWER_THRESHOLD", raising=False)
+    llm_calls = []
+
+    def get_answer(llm, docs, query, language, chain_type):
+        llm_calls.append(query)
+        return {"output_text": "Generated answer. Sources: https://blob/a.pdf"}
+
+    monkeypatch.setattr(tools, "get_search_results", lambda query, indexes, k: [
+        search_results([result("a")], [answer("a", 0.95, "Extractive answer.")])])
+    monkeypatch.setattr(tools, "get_answer", get_answer)
+    return llm_calls
+
+
+def test_doc_search_tool_answers_with_the_extractive_answer(llm, searched):
+    hits = EXTRACTIVE_ANSWERS.value(source="DocSearchTool", outcome="hit")
+    tool = DocSearchTool(llm=llm, indexes=["index"], extractive_answer_th=0.9)
+    assert tool.run("what is a?") == 'Extractive answer.<br><u>Sources</u>: <sup><a href="https://blob/a.pdf?sas">[1]</a></sup>'
+    assert searched == []
+    assert EXTRACTIVE_ANSWERS.value(source="DocSearchTool", outcome="hit") == hits + 1
+
+
+def test_doc_search_tool_uses_the_llm_below_the_threshold_or_in_another_language(llm, searched):
+    DocSearchTool(llm=llm, indexes=["index"], extractive_answer_th=0.99).run("what is a?")
+    DocSearchTool(llm=llm, indexes=["index"], extractive_answer_th=0.9, response_language="Spanish").run("what is b?")
+    DocSearchTool(llm=llm, indexes=["index"]).run("what is c?")
+    assert searched == ["what is a?", "what is b?", "what is c?"]
+
+
+def test_doc_search_tool_reads_the_thresholds_when_created(llm, monkeypatch):
+    monkeypatch.setenv("EXTRACTIVE_ANSWER_THRESHOLD", "0.8")
+    monkeypatch.setenv("EXTRACTIVE_ANSWER_RERANKER_THRESHOLD", "3")
+    tool = DocSearchTool(llm=llm, indexes=["index"])
+    assert (tool.extractive_answer_th, tool.extractive_reranker_th) == (0.8, 3.0)
+    monkeypatch.delenv("EXTRACTIVE_ANSWER_THRESHOLD")
+    monkeypatch.delenv("EXTRACTIVE_ANSWER_RERANKER_THRESHOLD")
+    tool = DocSearchTool(llm=llm, indexes=["index"])
+    assert (tool.extractive_answer_th, tool.extractive_reranker_th) == (None, 2.0)
@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loaded_modules(code, path):
+    """Top-level packages loaded by `code` in a fresh interpreter with `path` first on sys.path"""
+    script = f"import sys; sys.path.insert(0, {path!r}); {code}; print(' '.join(sorted({{m.split('.')[0] for m in sys.modules}})))"
+    completed = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True)
+    return set(completed.stdout.split())
+
+
+@pytest.mark.parametrize("code, path", [
+    ("import common.utils, common.dedup, common.compression", ROOT),  # the notebooks
+    ("import utils, dedup, compression", os.path.join(ROOT, "common")),  # the apps
+])
+def test_utils_does_not_load_langchain(code, path):
+    assert not {"langchain", "sqlalchemy", "openai"} & loaded_modules(code, path)
+
+
+def test_tools_are_loaded_on_first_access():
+    code = "from common.utils import DocSearchTool, get_sql_database; from common import tools; assert DocSearchTool is tools.DocSearchTool"
+    assert "langchain" in loaded_modules(code, ROOT)
@@ -0,0 +1,131 @@
+import os
+
+import pytest
+
+from common.dedup import SimHashIndex, simhash
+from common.ingest import IngestManifest, document_key, drop_near_duplicates, file_location
+
+
+BASE_URL = "https://account.blob.core.windows.net/docs"
+
+
+def make_documents(location, contents):
+    return [{"id": document_key(location, f"page-{i}"), "title": "paper", "content": content, "pages": [content],
+             "language": "en", "metadata_storage_name": "paper.txt", "metadata_storage_path": location}
+            for i, content in enumerate(contents)]
+
+
+def actions_by_type(actions):
+    return ({action["id"] for action in actions if action["@search.action"] == "mergeOrUpload"},
+            {action["id"] for action in actions if action["@search.action"] == "delete"})
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / "data"
+    root.mkdir()
+    (root / "paper.txt").write_text("first version")
+    (root / "notes.txt").write_text("some notes")
+    return str(root)
+
+
+@pytest.fixture
+def manifest_path(tmp_path):
+    return str(tmp_path / "manifest.json")
+
+
+def ingest(manifest, root, contents_by_name, failed_keys=()):
+    """Runs one incremental pass over `root`, returning the actions it would send"""
+    paths = sorted(os.path.join(root, name) for name in os.listdir(root))
+    changed, removed = manifest.plan(paths, root, BASE_URL)
+    actions = []
+    for location in removed:
+        actions += manifest.actions_for_removed(location)
+    for path in changed:
+        location = file_location(path, root, BASE_URL)
+        actions += manifest.actions_for_file(path, location, make_documents(location, contents_by_name[os.path.basename(path)]))
+    manifest.commit(failed_keys)
+    manifest.save()
+    return changed, removed, actions
+
+
+def test_file_location():
+    assert file_location(os.path.join("data", "a", "b.pdf"), "data", BASE_URL + "/") == BASE_URL + "/a/b.pdf"
+    assert file_location(os.path.join("data", "a", "b.pdf"), "data") == "a/b.pdf"
+
+
+def test_second_run_skips_unchanged_files(root, manifest_path):
+    contents = {"paper.txt": ["chunk one", "chunk two"], "notes.txt": ["notes"]}
+    changed, removed, actions = ingest(IngestManifest(manifest_path), root, contents)
+    assert len(changed) == 2 and removed == [] and len(actions) == 3
+
+    changed, removed, actions = ingest(IngestManifest(manifest_path), root, contents)
+    assert (changed, removed, actions) == ([], [], [])
+
+
+def test_changed_file_uploads_only_changed_chunks_and_deletes_stale_ones(root, manifest_path):
+    ingest(IngestManifest(manifest_path), root, {"paper.txt": ["chunk one", "chunk two", "chunk three"], "notes.txt": ["notes"]})
+    with open(os.path.join(root, "paper.txt"), "w") as f:
+        f.write("second version, longer")
+
+    location = file_location(os.path.join(root, "paper.txt"), root, BASE_URL)
+    old_ids = [document["id"] for document in make_documents(location, ["", "", ""])]
+    changed, removed, actions = ingest(IngestManifest(manifest_path), root, {"paper.txt": ["chunk one", "chunk 2"]})
+    assert changed == [os.path.join(root, "paper.txt")]
+    assert actions_by_type(actions) == ({old_ids[1]}, {old_ids[2]})
+
+
+def test_removed_file_deletes_its_chunks(root, manifest_path):
+    ingest(IngestManifest(manifest_path), root, {"paper.txt": ["chunk one"], "notes.txt": ["a", "b"]})
+    os.remove(os.path.join(root, "notes.txt"))
+
+    manifest = IngestManifest(manifest_path)
+    changed, removed, actions = ingest(manifest, root, {})
+    location = BASE_URL + "/notes.txt"
+    assert changed == [] and removed == [location]
+    assert actions_by_type(actions) == (set(), {document["id"] for document in make_documents(location, ["a", "b"])})
+    assert location not in manifest.files
+
+
+def test_failed_files_are_retried_on_the_next_run(root, manifest_path):
+    contents = {"paper.txt": ["chunk one"], "notes.txt": ["notes"]}
+    location = BASE_URL + "/notes.txt"
+    failed_id = make_documents(location, ["notes"])[0]["id"]
+    ingest(IngestManifest(manifest_path), root, contents, failed_keys=[failed_id])
+
+    changed, _, actions = ingest(IngestManifest(manifest_path), root, contents)
+    assert changed == [os.path.join(root, "notes.txt")]
+    assert actions_by_type(actions) == ({failed_id}, set())
+
+
+def test_new_settings_reparse_every_file_but_keep_ids_to_delete(root, manifest_path):
+    ingest(IngestManifest(manifest_path, {"chunk_size": 800}), root, {"paper.txt": ["one", "two"], "notes.txt": ["notes"]})
+
+    manifest = IngestManifest(manifest_path, {"chunk_size": 400})
+    changed, _, actions = ingest(manifest, root, {"paper.txt": ["one"], "notes.txt": ["notes"]})
+    assert len(changed) == 2
+    location = BASE_URL + "/paper.txt"
+    # Chunks that come out identical are already in the index
+    assert actions_by_type(actions) == (set(), {make_documents(location, ["one", "two"])[1]["id"]})
+    assert all("hash" in entry for entry in manifest.files.values())
+
+
+def test_touched_but_identical_file_is_unchanged(root, manifest_path):
+    ingest(IngestManifest(manifest_path), root, {"paper.txt": ["one"], "notes.txt": ["notes"]})
+    path = os.path.join(root, "paper.txt")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    assert IngestManifest(manifest_path).is_unchanged(path, BASE_URL + "/paper.txt")
+
+
+def test_seed_and_drop_near_duplicates(root, manifest_path):
+    text = "a long enough paragraph about retrieval augmented generation with search indexes and embeddings"
+    ingest(IngestManifest(manifest_path), root, {"paper.txt": [text], "notes.txt": ["notes"]})
+
+    dedup = SimHashIndex(max_distance=3)
+    IngestManifest(manifest_path).seed(dedup, skip_locations=[BASE_URL + "/notes.txt"])
+    assert dedup.find(simhash(text)) is not None
+    documents = make_documents(BASE_URL + "/copy.txt", [text, "something different"])
+    assert [document["content"] for document in drop_near_duplicates(documents, dedup)] == ["something different"]
+    assert drop_near_duplicates(documents, None) == documents
@@ -0,0 +1,53 @@
+from typing import Any, List, Optional
+
+from langchain.llms.base import LLM
+from langchain.llms.fake import FakeListLLM
+from langchain.schema import AIMessage, HumanMessage
+
+from common.memory import MESSAGE_OVERHEAD_TOKENS, TokenBudgetMemory
+
+
+class FailingLLM(LLM):
+    @property
+    def _llm_type(self) -> str:
+        return "failing"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None) -> str:
+        raise RuntimeError("summary service unavailable")
+
+
+def turn(memory, i):
+    # Each message is 3 stub tokens plus the message overhead
+    memory.save_context({"input": f"question number {i}"}, {"output": f"answer number {i}"})
+
+
+def test_recent_messages_are_kept_verbatim(stub_encoding):
+    memory = TokenBudgetMemory(llm=FakeListLLM(responses=["summary"]), max_token_limit=100, return_messages=True)
+    turn(memory, 1)
+    assert memory.buffer == [HumanMessage(content="question number 1"), AIMessage(content="answer number 1")]
+    assert memory.buffer_tokens == 2 * (3 + MESSAGE_OVERHEAD_TOKENS)
+
+
+def test_older_messages_are_folded_into_the_summary(stub_encoding):
+    memory = TokenBudgetMemory(llm=FakeListLLM(responses=["They talked."] * 10), max_token_limit=15, return_messages=True)
+    for i in range(3):
+        turn(memory, i)
+    assert memory.wait_for_summary(timeout=10)
+    assert memory.summary == "They talked."
+    messages = memory.buffer
+    assert messages[0].content == "They talked."
+    assert [message.content for message in messages[1:]] == ["question number 2", "answer number 2"]
+
+
+def test_pending_messages_are_capped_when_the_summary_fails(stub_encoding):
+    memory = TokenBudgetMemory(llm=FailingLLM(), max_token_limit=14, max_pending_token_limit=28)
+    for i in range(20):
+        turn(memory, i)
+        memory.wait_for_summary(timeout=10)
+    assert memory._pending_tokens <= 28
+    assert memory.summary == ""
+
+
+def test_max_prompt_tokens_is_the_worst_case():
+    memory = TokenBudgetMemory(llm=FakeListLLM(responses=[]), max_token_limit=1000)
+    assert memory.max_prompt_tokens == 3 * 1000 + MESSAGE_OVERHEAD_TOKENS
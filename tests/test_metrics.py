@@ -0,0 +1,195 @@
+import logging
+import multiprocessing
+
+import pytest
+
+from common import metrics
+from common.caching import TTLCache
+from common.metrics import Counter, Gauge, Histogram, RetryLogCounter, register_cache, render
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    """An empty registry, so the metrics of the imported modules are not rendered"""
+    monkeypatch.setattr(metrics, "_metrics", [])
+    monkeypatch.setattr(metrics, "_caches", {})
+    monkeypatch.setattr(metrics, "_cache_baselines", {})
+    monkeypatch.setattr(metrics, "_shared", None)
+    monkeypatch.delenv("SHARED_METRICS_PATH", raising=False)
+
+
+def samples(text):
+    return [line for line in text.splitlines() if line and not line.startswith("#")]
+
+
+def test_counter_samples_by_label():
+    counter = Counter("bot_turns_total", "Bot turns", ["outcome"])
+    counter.inc(outcome="ok")
+    counter.inc(2, outcome="ok")
+    counter.inc(outcome="error")
+    assert counter.value(outcome="ok") == 3
+    text = render()
+    assert "# HELP bot_turns_total Bot turns\n# TYPE bot_turns_total counter" in text
+    assert samples(text) == ['bot_turns_total{outcome="ok"} 3', 'bot_turns_total{outcome="error"} 1']
+
+
+def test_label_values_are_escaped():
+    counter = Counter("errors_total", "Errors", ["error"])
+    counter.inc(error='Bad "input"\\path\nnext line')
+    assert samples(render()) == ['errors_total{error="Bad \\"input\\"\\\\path\\nnext line"} 1']
+
+
+def test_gauges():
+    gauge = Gauge("in_flight", "In flight")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    Gauge("queue_depth", "Queue depth", function=lambda: 7)
+    Gauge("broken", "Fails at scrape time", function=lambda: 1 / 0)
+    assert gauge.value() == 1
+    assert samples(render()) == ["in_flight 1", "queue_depth 7"]
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency_seconds", "Latency", ["tool"], buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, tool="docsearch")
+    assert samples(render()) == [
+        'latency_seconds_bucket{tool="docsearch",le="0.1"} 2',
+        'latency_seconds_bucket{tool="docsearch",le="1.0"} 3',
+        'latency_seconds_bucket{tool="docsearch",le="+Inf"} 4',
+        'latency_seconds_count{tool="docsearch"} 4',
+        'latency_seconds_sum{tool="docsearch"} 3.65',
+    ]
+
+
+def test_histogram_time_observes_failed_calls_too():
+    histogram = Histogram("call_seconds", "Calls")
+
+    @histogram.time()
+    def failing():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        failing()
+    assert "call_seconds_count 1" in samples(render())
+
+
+def test_cache_hits_misses_and_entries():
+    cache = TTLCache()
+    register_cache("search_results", cache)
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("b")
+    assert samples(render()) == ['cache_hits_total{cache="search_results"} 1',
+                                 'cache_misses_total{cache="search_results"} 1',
+                                 'cache_entries{cache="search_results"} 1']
+
+
+def test_retry_log_counter():
+    counter = Counter("llm_retries_total", "Retries", ["reason"])
+    logger = logging.getLogger("test_retry_log_counter")
+    handler = RetryLogCounter(counter)
+    logger.addHandler(handler)
+    try:
+        logger.warning("Retrying langchain.chat_models.openai... as it raised RateLimitError: throttled.")
+        logger.warning("Retrying langchain.chat_models.openai... as it raised Timeout: timed out.")
+        logger.warning("Something else")
+    finally:
+        logger.removeHandler(handler)
+    assert counter.value(reason="throttled") == 1 and counter.value(reason="error") == 1
+
+
+@pytest.fixture
+def shared_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "metrics.sqlite3")
+    monkeypatch.setenv("SHARED_METRICS_PATH", path)
+    return path
+
+
+def fork(target, *args):
+    process = multiprocessing.get_context("fork").Process(target=target, args=args)
+    process.start()
+    return process
+
+
+def test_metrics_are_summed_over_the_processes(shared_path):
+    counter = Counter("bot_turns_total", "Bot turns", ["status"])
+    gauge = Gauge("bot_in_flight_turns", "In flight")
+    histogram = Histogram("latency_seconds", "Latency", buckets=(1.0,))
+    cache = TTLCache()
+    register_cache("search_results", cache)
+    counter.inc(2, status="ok")
+    gauge.inc()
+    histogram.observe(0.5)
+    cache.get("a")
+
+    def worker():
+        # Starts from zero: the values inherited from the parent are reported by the parent
+        counter.inc(status="ok")
+        gauge.inc(5)
+        histogram.observe(3.0)
+        cache.get("a")
+        metrics.flush()
+
+    process = fork(worker)
+    process.join()
+    assert process.exitcode == 0
+    # The counts of a process that exited are kept, its gauges are not
+    assert counter.total(status="ok") == 3 and gauge.total() == 1
+    assert samples(render()) == [
+        'bot_turns_total{status="ok"} 3',
+        "bot_in_flight_turns 1",
+        'latency_seconds_bucket{le="1.0"} 1',
+        'latency_seconds_bucket{le="+Inf"} 2',
+        "latency_seconds_count 2",
+        "latency_seconds_sum 3.5",
+        'cache_hits_total{cache="search_results"} 0',
+        'cache_misses_total{cache="search_results"} 2',
+        'cache_entries{cache="search_results"} 0',
+    ]
+
+
+def test_gauges_of_running_processes_are_summed(shared_path):
+    gauge = Gauge("bot_in_flight_turns", "In flight")
+    gauge.inc()
+    context = multiprocessing.get_context("fork")
+    flushed, done = context.Event(), context.Event()
+
+    def worker():
+        gauge.inc(2)
+        metrics.flush()
+        flushed.set()
+        done.wait(10)
+
+    process = fork(worker)
+    try:
+        assert flushed.wait(10)
+        assert gauge.total() == 3 and gauge.value() == 1
+    finally:
+        done.set()
+        process.join()
+    assert gauge.total() == 1
+
+
+def test_entries_of_a_shared_cache_are_counted_once(shared_path, tmp_path):
+    from common.caching import SQLiteCache
+
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite3"), "bing")
+    register_cache("bing", cache)
+    cache.set("a", 1)
+    context = multiprocessing.get_context("fork")
+    flushed, done = context.Event(), context.Event()
+
+    def worker():
+        metrics.flush()
+        flushed.set()
+        done.wait(10)
+
+    process = fork(worker)
+    try:
+        assert flushed.wait(10)
+        assert 'cache_entries{cache="bing"} 1' in samples(render())
+    finally:
+        done.set()
+        process.join()
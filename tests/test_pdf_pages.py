@@ -0,0 +1,55 @@
+from io import BytesIO
+
+import pytest
+from fpdf import FPDF
+
+from common.utils import iter_pdf_pages, normalize_pdf_text, parse_pdf
+
+
+NUM_PAGES = 11
+
+
+@pytest.fixture(scope="module")
+def pdf_bytes():
+    pdf = FPDF()
+    pdf.set_font("helvetica", size=12)
+    for i in range(1, NUM_PAGES + 1):
+        pdf.add_page()
+        pdf.cell(text=f"Page number {i}")
+    return bytes(pdf.output())
+
+
+@pytest.fixture(scope="module")
+def pdf_path(tmp_path_factory, pdf_bytes):
+    path = tmp_path_factory.mktemp("pdf") / "pages.pdf"
+    path.write_bytes(pdf_bytes)
+    return str(path)
+
+
+EXPECTED = [(i, f"Page number {i}") for i in range(1, NUM_PAGES + 1)]
+
+
+def test_normalize_pdf_text():
+    assert normalize_pdf_text(" multi-\nple lines\nof text\n\n\n\nNext ") == "multiple lines of text\n\nNext"
+
+
+def test_pages_in_process(pdf_bytes):
+    assert list(iter_pdf_pages(BytesIO(pdf_bytes))) == EXPECTED
+    assert parse_pdf(BytesIO(pdf_bytes)) == [text for _, text in EXPECTED]
+
+
+@pytest.mark.parametrize("source", ["path", "bytes", "file"])
+def test_pages_in_a_process_pool_keep_the_page_order(pdf_path, pdf_bytes, source):
+    file = {"path": pdf_path, "bytes": pdf_bytes, "file": BytesIO(pdf_bytes)}[source]
+    assert list(iter_pdf_pages(file, workers=2, pages_per_task=3)) == EXPECTED
+
+
+def test_unordered_pages_are_all_yielded_once(pdf_path):
+    pages = list(iter_pdf_pages(pdf_path, workers=3, ordered=False, pages_per_task=2))
+    assert sorted(pages) == EXPECTED
+
+
+def test_closing_the_generator_early_stops_the_pool(pdf_path):
+    pages = iter_pdf_pages(pdf_path, workers=2, pages_per_task=1)
+    assert next(pages) == EXPECTED[0]
+    pages.close()
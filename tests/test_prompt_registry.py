@@ -0,0 +1,68 @@
+import warnings
+
+import pytest
+from langchain.prompts import PromptTemplate
+
+from common import prompts
+from common.prompt_registry import PROMPTS, PromptRegistry
+
+
+def prompt(words):
+    return PromptTemplate(template="{question}" + " word" * words, input_variables=["question"])
+
+
+@pytest.fixture
+def registry():
+    registry = PromptRegistry()
+    registry.register("answer", [("full", prompt(30)), ("compact", prompt(10)), ("minimal", prompt(3))])
+    return registry
+
+
+def test_tokens_are_computed_once_without_input_variables(registry, stub_encoding):
+    assert registry.tokens("answer", "full") == 30
+    assert registry.tokens("answer", "full") == 30
+    assert stub_encoding.encode_calls == 1
+
+
+def test_precompute(registry, stub_encoding):
+    assert registry.precompute() == {"answer": {"full": 30, "compact": 10, "minimal": 3}}
+
+
+@pytest.mark.parametrize("budget, variant", [(1000, "full"), (30, "full"), (29, "compact"), (5, "minimal"),
+                                             (0, "minimal"), (-50, "minimal")])
+def test_select_returns_the_richest_variant_that_fits(registry, stub_encoding, budget, variant):
+    selected, template = registry.select("answer", budget)
+    assert selected == variant
+    assert template is registry.get("answer", variant)
+
+
+def test_register_again_resets_the_costs(registry, stub_encoding):
+    registry.tokens("answer", "full")
+    registry.register("answer", [("full", prompt(5))])
+    assert registry.variants("answer") == ["full"]
+    assert registry.tokens("answer", "full") == 5
+
+
+def test_register_needs_a_variant():
+    with pytest.raises(ValueError):
+        PromptRegistry().register("empty", [])
+
+
+@pytest.mark.parametrize("name", ["combine", "combine_chat", "chatbot_prefix"])
+def test_prompt_families_get_shorter(name, stub_encoding):
+    # A fresh registry so the costs are not taken from another test or encoding
+    registry = PromptRegistry()
+    for family in ["combine", "combine_chat", "chatbot_prefix"]:
+        registry.register(family, [(variant, PROMPTS.get(family, variant)) for variant in PROMPTS.variants(family)])
+    costs = [registry.tokens(name, variant) for variant in registry.variants(name)]
+    assert costs == sorted(costs, reverse=True) and len(set(costs)) == len(costs)
+    assert registry.select(name, costs[0])[0] == "full"
+
+
+def test_prompts_compile_without_invalid_escape_warnings():
+    with open(prompts.__file__, encoding="utf-8") as f:
+        source = f.read()
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        compile(source, prompts.__file__, "exec")
+    assert r"$$\sqrt{{3x-1}}" in prompts.CUSTOM_CHATBOT_PREFIX and r"\$199.99" in prompts.CUSTOM_CHATBOT_PREFIX_COMPACT
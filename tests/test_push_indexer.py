@@ -0,0 +1,50 @@
+import pytest
+
+from common.ingest import PushIndexer
+
+
+def make_actions(count):
+    return [{"@search.action": "mergeOrUpload", "id": f"doc-{i}", "content": f"content {i}"} for i in range(count)]
+
+
+@pytest.fixture
+def indexer(standins):
+    return PushIndexer(standins.url, "cogsrch-index-files", "stand-in", "2021-04-30-Preview",
+                       batch_size=4, concurrency=2, max_retries=3, backoff=0, verbose=False)
+
+
+def test_uploads_every_action_in_batches(standins, indexer):
+    summary = indexer.run(make_actions(10))
+    assert summary["succeeded"] == 10 and summary["failed"] == 0 and summary["batches"] == 3
+    assert sorted(standins.indexed_keys) == sorted(f"doc-{i}" for i in range(10))
+
+
+def test_throttled_batches_are_sent_again(standins, indexer):
+    standins.throttle_next["index"] = 2
+    summary = indexer.run(make_actions(4))
+    assert summary["succeeded"] == 4 and summary["retries"] == 8
+    assert standins.throttled["index"] == 2 and standins.requests["index"] == 3
+
+
+def test_only_the_failed_actions_of_a_multi_status_response_are_retried(standins, indexer):
+    standins.index_failures = {"doc-1": 1, "doc-3": 2}
+    assert indexer.upload_batch(make_actions(4)) == []
+    assert indexer.stats["succeeded"] == 4 and indexer.stats["retries"] == 2 + 1
+    assert standins.indexed_keys.count("doc-1") == 1 and standins.indexed_keys.count("doc-0") == 1
+
+
+def test_actions_failing_after_the_last_retry_are_reported(standins, indexer):
+    standins.index_failures = {"doc-2": 10}
+    assert indexer.upload_batch(make_actions(3)) == ["doc-2"]
+    assert indexer.failed_keys == ["doc-2"]
+    assert indexer.stats["succeeded"] == 2 and indexer.stats["failed"] == 1
+    assert standins.requests["index"] == 1 + indexer.max_retries
+
+
+def test_batches_respect_the_request_size_limit(indexer, monkeypatch):
+    import common.ingest as ingest
+
+    monkeypatch.setattr(ingest, "MAX_BATCH_BYTES", 200)
+    batches = list(indexer.iter_batches(make_actions(10)))
+    assert [action for batch in batches for action in batch] == make_actions(10)
+    assert all(len(batch) <= 4 for batch in batches) and len(batches) > 3
@@ -0,0 +1,130 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine
+
+from common.utils import (CachedSQLDatabase, get_sql_database, get_sql_engine, is_read_only_sql, normalize_sql,
+                          sql_identifiers)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "covid.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE covid (state TEXT, death INTEGER)")
+    connection.execute("CREATE TABLE other (x INTEGER)")
+    connection.executemany("INSERT INTO covid VALUES (?, ?)", [("TX", 10), ("CA", 20)])
+    connection.commit()
+    connection.close()
+    return path
+
+
+def change_outside(db_path, statement):
+    """Changes the database without going through CachedSQLDatabase"""
+    connection = sqlite3.connect(db_path)
+    connection.execute(statement)
+    connection.commit()
+    connection.close()
+
+
+@pytest.fixture
+def db(db_path):
+    return CachedSQLDatabase(create_engine(f"sqlite:///{db_path}"))
+
+
+def test_engine_and_database_are_created_once_per_url(db_path):
+    url = f"sqlite:///{db_path}"
+    assert get_sql_engine(url) is get_sql_engine(url)
+    assert get_sql_database(url) is get_sql_database(url)
+    assert set(get_sql_database(url).get_usable_table_names()) == {"covid", "other"}
+
+
+def test_table_info_is_cached_until_the_schema_is_invalidated(db, db_path):
+    info = db.get_table_info(["covid"])
+    assert "CREATE TABLE covid" in info and "TX" in info
+    change_outside(db_path, "UPDATE covid SET state = 'NY' WHERE state = 'TX'")
+    assert db.get_table_info(["covid"]) == info
+
+    db.invalidate_schema()
+    assert "NY" in db.get_table_info(["covid"])
+
+
+def test_invalidate_schema_reflects_new_tables(db, db_path):
+    assert "added" not in db.get_usable_table_names()
+    change_outside(db_path, "CREATE TABLE added (y INTEGER)")
+    assert "added" not in db.get_usable_table_names()
+    db.invalidate_schema()
+    assert "added" in db.get_usable_table_names()
+
+
+def test_schema_is_reflected_again_after_the_ttl(db_path):
+    db = CachedSQLDatabase(create_engine(f"sqlite:///{db_path}"), schema_ttl=0)
+    change_outside(db_path, "CREATE TABLE added (y INTEGER)")
+    assert "added" in db.get_usable_table_names()
+
+
+def test_normalize_sql_folds_whitespace_and_case_outside_literals():
+    assert normalize_sql("SELECT  [Death]\n\tFROM  T ;") == "select [death] from t"
+    assert normalize_sql("SELECT  'A  B'  FROM T") == "select 'A  B' from t"
+
+
+def test_normalize_sql_keeps_the_space_before_a_literal():
+    # A column aliased N and a Unicode literal must not share a cache key
+    assert normalize_sql("SELECT N 'x'") != normalize_sql("SELECT N'x'")
+
+
+def test_sql_identifiers_ignores_literals():
+    identifiers = sql_identifiers(normalize_sql("SELECT a FROM covid WHERE state = 'other_table'"))
+    assert {"a", "covid", "state"} <= identifiers
+    assert "other_table" not in identifiers
+
+
+@pytest.mark.parametrize("command, read_only", [
+    ("SELECT * FROM t", True),
+    ("(SELECT 1)", True),
+    ("WITH c AS (SELECT 1 AS a) SELECT * FROM c", True),
+    ("SELECT 'delete' FROM t", True),
+    ("WITH c AS (SELECT 1 AS a) DELETE FROM t WHERE a IN (SELECT a FROM c)", False),
+    ("WITH c AS (SELECT 1 AS a) UPDATE t SET a = 2", False),
+    ("SELECT a INTO t2 FROM t", False),
+    ("INSERT INTO t VALUES (1)", False),
+    ("DROP TABLE t", False),
+])
+def test_is_read_only_sql(command, read_only):
+    assert is_read_only_sql(normalize_sql(command)) == read_only
+
+
+def test_reads_are_cached_by_normalized_text(db, db_path):
+    assert db.run("SELECT count(*) FROM covid") == "[(2,)]"
+    change_outside(db_path, "INSERT INTO covid VALUES ('NY', 30)")
+    assert db.run("select  COUNT(*)\nfrom covid;") == "[(2,)]"
+
+
+def test_invalidate_tables_drops_only_the_results_of_those_tables(db, db_path):
+    db.run("SELECT count(*) FROM covid")
+    db.run("SELECT count(*) FROM other")
+    change_outside(db_path, "INSERT INTO covid VALUES ('NY', 30)")
+    change_outside(db_path, "INSERT INTO other VALUES (1)")
+
+    assert db.invalidate_tables(["COVID"]) == 1
+    assert db.run("SELECT count(*) FROM covid") == "[(3,)]"
+    assert db.run("SELECT count(*) FROM other") == "[(0,)]"
+
+
+def test_writes_invalidate_the_tables_they_touch(db):
+    db.run("SELECT count(*) FROM covid")
+    db.run("INSERT INTO covid VALUES ('NY', 30)")
+    assert db.run("SELECT count(*) FROM covid") == "[(3,)]"
+
+
+def test_with_delete_is_not_cached_and_invalidates(db):
+    db.run("SELECT count(*) FROM covid")
+    db.run("WITH c AS (SELECT 'TX' AS state) DELETE FROM covid WHERE state IN (SELECT state FROM c)")
+    assert db.run("SELECT count(*) FROM covid") == "[(1,)]"
+
+
+def test_long_results_are_not_cached(db_path):
+    db = CachedSQLDatabase(create_engine(f"sqlite:///{db_path}"), max_cached_result_chars=5)
+    assert db.run("SELECT state FROM covid ORDER BY state") == "[('CA',), ('TX',)]"
+    change_outside(db_path, "DELETE FROM covid WHERE state = 'CA'")
+    assert db.run("SELECT state FROM covid ORDER BY state") == "[('TX',)]"
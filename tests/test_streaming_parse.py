@@ -0,0 +1,117 @@
+import threading
+import time
+from io import BytesIO
+
+import docx
+import pytest
+
+from common.utils import (iter_docx_blocks, iter_file_docs, iter_text_to_docs, iter_txt_blocks, parse_docx,
+                          parse_txt, prefetch, text_to_docs)
+
+
+# Paragraphs of varied length, runs of blank lines and multi-byte characters
+PARAGRAPHS = [" ".join(f"wörd{i}-{j}." if j % 7 == 6 else f"wörd{i}-{j}" for j in range(i % 23 + 1))
+              for i in range(120)]
+TEXT = "".join(paragraph + "\n" * (i % 3 + 1) + " " * (i % 2) for i, paragraph in enumerate(PARAGRAPHS))
+
+
+def docx_bytes(paragraphs):
+    document = docx.Document()
+    document.sections[0].header.paragraphs[0].text = "Header text"
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    document.add_paragraph("")
+    file = BytesIO()
+    document.save(file)
+    return file.getvalue()
+
+
+def summary(docs):
+    return [(doc.page_content, doc.metadata) for doc in docs]
+
+
+@pytest.mark.parametrize("block_size", [16, 100, 1000, 65536])
+def test_txt_blocks_join_to_parse_txt(block_size):
+    data = TEXT.encode("utf-8")
+    assert "".join(iter_txt_blocks(BytesIO(data), block_size=block_size)) == parse_txt(BytesIO(data))
+
+
+def test_txt_blocks_are_bounded():
+    blocks = list(iter_txt_blocks(BytesIO(TEXT.encode("utf-8")), block_size=100))
+    assert len(blocks) > 10
+    # A block is cut at the last paragraph break, or before the trailing whitespace past 4 * block_size
+    assert all(len(block) <= 5 * 100 for block in blocks)
+
+
+@pytest.mark.parametrize("block_size", [16, 200, 65536])
+def test_docx_blocks_join_to_parse_docx(block_size):
+    data = docx_bytes(PARAGRAPHS)
+    assert "".join(iter_docx_blocks(BytesIO(data), block_size=block_size)) == parse_docx(BytesIO(data))
+
+
+@pytest.mark.parametrize("chunk_size", [40, 300])
+@pytest.mark.parametrize("block_size", [16, 100, 1000])
+def test_blocks_are_chunked_like_the_whole_text(block_size, chunk_size):
+    blocks = ((1, block) for block in iter_txt_blocks(BytesIO(TEXT.encode("utf-8")), block_size=block_size))
+    assert summary(iter_text_to_docs(blocks, chunk_size=chunk_size)) == \
+        summary(text_to_docs(parse_txt(BytesIO(TEXT.encode("utf-8"))), chunk_size=chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", [5, 50])
+@pytest.mark.parametrize("block_size", [16, 100, 1000])
+def test_blocks_are_chunked_like_the_whole_text_in_tokens(stub_encoding, block_size, chunk_size):
+    blocks = ((1, block) for block in iter_txt_blocks(BytesIO(TEXT.encode("utf-8")), block_size=block_size))
+    expected = text_to_docs(parse_txt(BytesIO(TEXT.encode("utf-8"))), chunk_size=chunk_size, encoding_name="cl100k_base")
+    assert summary(iter_text_to_docs(blocks, chunk_size=chunk_size, encoding_name="cl100k_base")) == summary(expected)
+
+
+def test_docx_file_docs_match_text_to_docs():
+    data = docx_bytes(PARAGRAPHS)
+    docs = iter_file_docs(BytesIO(data), "report.docx", block_size=64, chunk_size=120)
+    assert summary(docs) == summary(text_to_docs(parse_docx(BytesIO(data)), chunk_size=120))
+
+
+def test_pages_are_numbered_and_chunked_on_their_own():
+    docs = list(iter_text_to_docs(["First page. " * 10, "Second page."], chunk_size=50))
+    assert [doc.metadata["page"] for doc in docs] == [1, 1, 1, 2]
+    assert docs[-1].metadata == {"page": 2, "chunk": 0, "source": "2-0"}
+
+
+def test_prefetch_yields_every_item_in_order():
+    assert list(prefetch(iter(range(1000)), maxsize=4)) == list(range(1000))
+
+
+def test_prefetch_reraises_the_producer_error():
+    def failing():
+        yield 1
+        raise ValueError("bad file")
+
+    items = prefetch(failing())
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
+
+
+def test_prefetch_stays_at_most_maxsize_ahead():
+    produced = []
+
+    def producer():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    items = prefetch(producer(), maxsize=3)
+    assert next(items) == 0
+    time.sleep(0.3)
+    # The queue holds three items and the producer waits on the fourth
+    assert len(produced) <= 1 + 3 + 1
+
+
+def test_prefetch_producer_stops_when_the_consumer_does():
+    # Other tests leave daemon threads (e.g. the metrics flusher) that may exit meanwhile
+    threads_before = set(threading.enumerate())
+    items = prefetch(iter(range(100)), maxsize=2)
+    next(items)
+    items.close()
+    time.sleep(0.5)
+    assert set(threading.enumerate()) <= threads_before
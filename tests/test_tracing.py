@@ -0,0 +1,111 @@
+import io
+import json
+import uuid
+
+import pytest
+from langchain.schema import LLMResult
+
+from common import tracing
+from common.callbacks import TracingCallbackHandler
+from common.tracing import JsonLinesExporter, current_trace_id, span, start_span, trace, traced
+
+
+@pytest.fixture
+def spans(monkeypatch):
+    """Finished spans, collected by an exporter registered for the test only"""
+    finished = []
+    monkeypatch.setattr(tracing, "_exporters", [finished.append])
+    return finished
+
+
+def test_spans_nest_within_a_trace(spans):
+    with trace("conversation-1") as trace_id:
+        assert current_trace_id() == "conversation-1" == trace_id
+        with span("DocSearchTool", tool="docsearch"):
+            with span("search_index", index="files") as inner:
+                inner.set_attribute("results", 3)
+    assert current_trace_id() is None
+
+    inner, outer = spans
+    assert inner["name"] == "search_index" and outer["name"] == "DocSearchTool"
+    assert inner["traceId"] == outer["traceId"] == "conversation-1"
+    assert inner["parentSpanId"] == outer["spanId"] and outer["parentSpanId"] is None
+    assert inner["attributes"] == {"index": "files", "results": 3}
+    assert outer["startTimeUnixNano"] <= inner["startTimeUnixNano"] <= inner["endTimeUnixNano"] <= outer["endTimeUnixNano"]
+    assert outer["status"] == {"code": "OK"}
+
+
+def test_spans_outside_a_trace_get_their_own_trace_id(spans):
+    with span("first"):
+        pass
+    with span("second"):
+        pass
+    assert spans[0]["traceId"] != spans[1]["traceId"]
+
+
+def test_errors_are_recorded_and_raised(spans):
+    with pytest.raises(ValueError):
+        with span("get_answer"):
+            raise ValueError("bad prompt")
+    assert spans[0]["status"] == {"code": "ERROR", "message": "ValueError: bad prompt"}
+
+
+def test_traced_functions(spans):
+    @traced("order_search_results")
+    def order(results):
+        with span("inner"):
+            return sorted(results)
+
+    assert order([2, 1]) == [1, 2]
+    assert [s["name"] for s in spans] == ["inner", "order_search_results"]
+    assert spans[0]["parentSpanId"] == spans[1]["spanId"]
+    assert order.__name__ == "order"
+
+
+def test_nothing_is_recorded_without_exporters(monkeypatch):
+    monkeypatch.setattr(tracing, "_exporters", [])
+    assert start_span("llm") is None
+    with span("search") as current:
+        current.set_attribute("ignored", True)
+
+
+def test_a_failing_exporter_does_not_break_the_request(monkeypatch, capsys):
+    def failing(record):
+        raise IOError("disk full")
+
+    finished = []
+    monkeypatch.setattr(tracing, "_exporters", [failing, finished.append])
+    with span("search"):
+        pass
+    assert len(finished) == 1
+    assert "Could not export span" in capsys.readouterr().err
+
+
+def test_json_lines_exporter(monkeypatch):
+    stream = io.StringIO()
+    monkeypatch.setattr(tracing, "_exporters", [JsonLinesExporter(stream)])
+    with span("search", index="files"):
+        pass
+    record = json.loads(stream.getvalue())
+    assert record["name"] == "search" and record["attributes"] == {"index": "files"} and record["durationMs"] >= 0
+
+
+def test_llm_calls_are_spans_under_the_current_span(spans):
+    handler = TracingCallbackHandler()
+    with trace("conversation-2"):
+        with span("get_answer"):
+            run_id = uuid.uuid4()
+            handler.on_llm_start({"kwargs": {"deployment_name": "gpt-35-turbo"}}, ["prompt"], run_id=run_id)
+            usage = {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}
+            handler.on_llm_end(LLMResult(generations=[], llm_output={"token_usage": usage}), run_id=run_id)
+
+            failed_run_id = uuid.uuid4()
+            handler.on_llm_start({"kwargs": {}}, ["prompt"], run_id=failed_run_id)
+            handler.on_llm_error(TimeoutError("timed out"), run_id=failed_run_id)
+
+    llm, failed, parent = spans
+    assert llm["name"] == "llm" and llm["parentSpanId"] == parent["spanId"] and llm["traceId"] == "conversation-2"
+    assert llm["attributes"] == {"llm.model": "gpt-35-turbo", "llm.prompts": 1, "llm.prompt_tokens": 100,
+                                 "llm.completion_tokens": 20, "llm.total_tokens": 120}
+    assert failed["status"]["code"] == "ERROR"
+    assert handler._spans == {}
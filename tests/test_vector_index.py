@@ -0,0 +1,234 @@
+import functools
+import hashlib
+import os
+import shutil
+
+import faiss
+import numpy as np
+import pytest
+
+from common import ingest, utils, vector_index
+from common.vector_index import (CURRENT_FILE, LocalVectorIndex, LocalVectorIndexBuilder, current_version_path,
+                                 get_local_vector_index)
+
+
+DIMENSION = 16
+
+
+def embedding(text):
+    seed = int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).normal(size=DIMENSION).tolist()
+
+
+class Embedder:
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, texts):
+        self.texts.extend(texts)
+        return [embedding(text) for text in texts]
+
+
+def document(location, number, content=None):
+    return {"id": f"{location}-{number}", "title": location, "content": content or f"chunk {number} of {location}",
+            "language": "en", "metadata_storage_name": location, "metadata_storage_path": location}
+
+
+def build(path, documents, embedder=None, batch_size=4):
+    builder = LocalVectorIndexBuilder(path, embed_documents=embedder or Embedder(), batch_size=batch_size)
+    for doc in documents:
+        builder.add(doc)
+    builder.finalize()
+    return builder
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "vectors")
+
+
+def test_search_finds_the_nearest_chunks(path):
+    documents = [document("a.pdf", i) for i in range(30)]
+    build(path, documents)
+    index = LocalVectorIndex(path)
+    assert len(index) == 30
+    results = index.search(embedding("chunk 7 of a.pdf"), k=3)
+    assert results[0]["id"] == "a.pdf-7" and results[0]["similarity"] == pytest.approx(1.0)
+    assert [r["similarity"] for r in results] == sorted((r["similarity"] for r in results), reverse=True)
+
+    # Small corpora are searched exactly over the memory-mapped vectors, without index.faiss
+    version_path = current_version_path(path)
+    assert not os.path.exists(os.path.join(version_path, "index.faiss"))
+    assert isinstance(index._open().vectors, np.memmap)
+
+
+def test_large_corpora_get_a_memory_mapped_ivf_index(path, monkeypatch):
+    monkeypatch.setattr(vector_index, "MIN_VECTORS_FOR_IVF", 100)
+    build(path, [document("a.pdf", i) for i in range(200)], batch_size=64)
+    assert os.path.exists(os.path.join(current_version_path(path), "index.faiss"))
+    assert LocalVectorIndex(path).search(embedding("chunk 150 of a.pdf"), k=1)[0]["id"] == "a.pdf-150"
+
+
+def test_duplicate_content_is_indexed_once(path):
+    build(path, [document("a.pdf", 1, "same text"), document("b.pdf", 1, "same text")])
+    assert len(LocalVectorIndex(path)) == 1
+
+
+def test_similarities_and_lookups(path):
+    build(path, [document("a.pdf", i) for i in range(5)])
+    index = LocalVectorIndex(path)
+    similarities = index.similarities(embedding("chunk 2 of a.pdf"), ["chunk 2 of a.pdf", "not indexed"])
+    assert similarities[0] == pytest.approx(1.0) and similarities[1] is None
+    assert index.contains_ids(["a.pdf-1", "b.pdf-1"]) == {"a.pdf-1"}
+    assert index.locations() == {"a.pdf"}
+
+
+def test_rebuild_swaps_versions_under_open_readers(path):
+    build(path, [document("a.pdf", i) for i in range(5)])
+    reader = LocalVectorIndex(path, reload_interval=0)
+    old_version = current_version_path(path)
+    assert reader.search(embedding("chunk 1 of a.pdf"), k=1)[0]["id"] == "a.pdf-1"
+
+    builder = LocalVectorIndexBuilder(path, embed_documents=Embedder())
+    builder.add(document("b.pdf", 1))
+    builder.flush()
+    # A build in progress is not visible
+    assert current_version_path(path) == old_version and len(reader) == 5
+    builder.finalize()
+
+    assert current_version_path(path) != old_version
+    assert reader.search(embedding("chunk 1 of b.pdf"), k=1)[0]["id"] == "b.pdf-1"
+    # The replaced version stays for readers still using it; older ones are removed
+    assert os.path.isdir(old_version)
+    build(path, [document("c.pdf", 1)])
+    assert not os.path.exists(old_version)
+    assert len([name for name in os.listdir(path) if name.startswith("v-")]) == 2
+
+
+def test_index_written_before_versioning_is_still_opened(path):
+    build(path, [document("a.pdf", i) for i in range(5)])
+    version_path = current_version_path(path)
+    legacy_path = path + "-legacy"
+    shutil.copytree(version_path, legacy_path)
+    # Files directly in the directory, with a flat index.faiss
+    flat = faiss.IndexFlatIP(DIMENSION)
+    flat.add(np.fromfile(os.path.join(legacy_path, "vectors.f32"), dtype=np.float32).reshape(5, DIMENSION))
+    faiss.write_index(flat, os.path.join(legacy_path, "index.faiss"))
+
+    index = get_local_vector_index(legacy_path)
+    assert index.search(embedding("chunk 4 of a.pdf"), k=1)[0]["id"] == "a.pdf-4"
+    assert index.contains_ids(["a.pdf-4"]) == {"a.pdf-4"}
+    assert get_local_vector_index(legacy_path + "-missing") is None
+
+    # The next build replaces the old files with a version directory
+    build(legacy_path, [document("b.pdf", 1)])
+    build(legacy_path, [document("b.pdf", 2)])
+    assert not os.path.exists(os.path.join(legacy_path, "index.faiss"))
+    assert os.path.exists(os.path.join(legacy_path, CURRENT_FILE))
+
+
+def test_chunks_already_indexed_are_not_embedded_again(path):
+    build(path, [document("a.pdf", i) for i in range(5)])
+    embedder = Embedder()
+    build(path, [document("a.pdf", i) for i in range(7)], embedder)
+    assert embedder.texts == ["chunk 5 of a.pdf", "chunk 6 of a.pdf"]
+    assert LocalVectorIndex(path).similarities(embedding("chunk 1 of a.pdf"), ["chunk 1 of a.pdf"])[0] == pytest.approx(1.0)
+
+
+def test_keep_previous_carries_over_the_files_not_parsed_again(path):
+    build(path, [document(location, i) for location in ("kept.pdf", "changed.pdf", "removed.pdf") for i in range(3)])
+    builder = LocalVectorIndexBuilder(path, embed_documents=Embedder())
+    builder.add_file("changed.pdf", [document("changed.pdf", 0, "new content")])
+    builder.keep_previous(skip_locations=["removed.pdf"])
+    builder.finalize()
+
+    index = LocalVectorIndex(path)
+    assert index.locations() == {"kept.pdf", "changed.pdf"}
+    assert index.contains_ids([f"kept.pdf-{i}" for i in range(3)] + ["changed.pdf-1"]) == {f"kept.pdf-{i}" for i in range(3)}
+    assert len(index) == 4
+
+
+def test_ingest_with_manifest_and_vector_index(tmp_path, standins, monkeypatch):
+    root = tmp_path / "data"
+    root.mkdir()
+    (root / "kept.txt").write_text("Kept file. " * 20)
+    (root / "changed.txt").write_text("First version. " * 20)
+    embedder = Embedder()
+    monkeypatch.setattr(ingest, "LocalVectorIndexBuilder", functools.partial(LocalVectorIndexBuilder, embed_documents=embedder))
+    index_path = str(tmp_path / "vectors")
+    argv = [str(root), "--endpoint", standins.url, "--api-key", "stand-in", "--api-version", "2021-04-30-Preview",
+            "--workers", "1", "--chunk-size", "100", "--manifest", str(tmp_path / "manifest.json"),
+            "--vector-index", index_path]
+
+    assert ingest.main(argv) == 0
+    assert LocalVectorIndex(index_path).locations() == {"kept.txt", "changed.txt"}
+
+    (root / "changed.txt").write_text("Second version. " * 20)
+    embedder.texts.clear()
+    assert ingest.main(argv) == 0
+    index = LocalVectorIndex(index_path)
+    assert index.locations() == {"kept.txt", "changed.txt"}
+    assert all(text.startswith("Second version") for text in embedder.texts)
+    assert index.search(embedding(embedder.texts[0]), k=1)[0]["content"].startswith("Second version")
+
+    # A new vector index gets the chunks of the unchanged files too, without uploading them again
+    uploaded = len(standins.indexed_keys)
+    shutil.rmtree(index_path)
+    assert ingest.main(argv) == 0
+    assert LocalVectorIndex(index_path).locations() == {"kept.txt", "changed.txt"}
+    assert len(standins.indexed_keys) == uploaded
+
+
+def search_result(id, location, pages, score=3.0):
+    return {"id": id, "title": location, "pages": pages, "language": "en", "@search.rerankerScore": score,
+            "@search.captions": [{"text": pages[0][:20]}], "metadata_storage_name": location,
+            "metadata_storage_path": location}
+
+
+def hybrid(path, monkeypatch, search_results, query):
+    monkeypatch.setattr(utils, "embed_query", embedding)
+    return utils.hybrid_search_results(query, ["index"], k=5, reranker_threshold=1, vector_index=LocalVectorIndex(path),
+                                       vector_k=2, agg_search_results=[{"value": search_results}])
+
+
+def test_hybrid_results_fuse_the_same_chunk_id(path, monkeypatch):
+    build(path, [document("a.pdf", i) for i in range(5)])
+    results = hybrid(path, monkeypatch, [search_result("a.pdf-3", "a.pdf", ["chunk 3 of a.pdf"])], "chunk 3 of a.pdf")
+    assert list(results)[0] == "a.pdf-3"
+    assert sum(chunk == "chunk 3 of a.pdf" for value in results.values() for chunk in value["chunks"]) == 1
+
+
+def test_hybrid_results_fuse_whole_file_documents_by_location(path, monkeypatch):
+    # Indexed by the notebooks: one document per file, with ids unknown to the vector index
+    build(path, [document("a.pdf", i) for i in range(5)] + [document("b.pdf", i) for i in range(5)])
+    pages = [f"page {i} of a.pdf" for i in range(3)]
+    search_results = [search_result("YS5wZGY=", "a.pdf", pages)]
+    results = hybrid(path, monkeypatch, search_results, "chunk 3 of a.pdf")
+    assert list(results)[0] == "YS5wZGY="
+    assert results["YS5wZGY="]["chunks"] == pages
+    assert search_results[0]["pages"] == pages
+
+
+def test_hybrid_results_fuse_identical_chunk_text(path, monkeypatch):
+    build(path, [document("a.pdf", i) for i in range(5)])
+    results = hybrid(path, monkeypatch, [search_result("other-key", "elsewhere/a.pdf", ["chunk 2 of a.pdf"])],
+                     "chunk 2 of a.pdf")
+    assert list(results)[0] == "other-key" and len(results) == 2
+
+
+def test_hybrid_results_add_chunks_of_other_files(path, monkeypatch):
+    build(path, [document("a.pdf", i) for i in range(5)])
+    results = hybrid(path, monkeypatch, [search_result("z.pdf-0", "z.pdf", ["unrelated"])], "chunk 4 of a.pdf")
+    assert "a.pdf-4" in results and results["a.pdf-4"]["chunks"] == ["chunk 4 of a.pdf"]
+    assert "z.pdf-0" in results
+
+
+def test_doc_search_tool_reads_the_vector_index_path_when_created(monkeypatch):
+    from langchain.chat_models import AzureChatOpenAI
+
+    llm = AzureChatOpenAI(deployment_name="gpt-35-turbo", openai_api_key="stand-in",
+                          openai_api_base="http://127.0.0.1:9", openai_api_version="2023-05-15")
+    monkeypatch.setenv("LOCAL_VECTOR_INDEX_PATH", "/data/vectors")
+    assert utils.DocSearchTool(llm=llm, indexes=["index"]).vector_index_path == "/data/vectors"
+    monkeypatch.delenv("LOCAL_VECTOR_INDEX_PATH")
+    assert utils.DocSearchTool(llm=llm, indexes=["index"]).vector_index_path is None